@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for chebi2gene.
+
+The sparql endpoint is replaced by an in-memory rdflib graph filled with
+synthetic ChEBI, Rhea, UniProt and iTAG data, queried either directly or
+through a local HTTP server standing in for the sparql endpoint, with an
+optional latency added to each query.
+
+Workloads of requests are then replayed against the routes of the web
+application and, for each route, the latency percentiles, the number of
+queries sent per request and the throughput are reported.
+
+Example:
+
+    python bench.py --compounds 500 --latency 0.02 --concurrency 8
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+
+import rdflib
+
+import chebi2gene
+import webapp
+
+
+BP = rdflib.Namespace('http://www.biopax.org/release/biopax-level2.owl#')
+RHEA = rdflib.Namespace('http://www.ebi.ac.uk/rhea#')
+UNIPROT = rdflib.Namespace('http://purl.uniprot.org/core/')
+UNIPROT_ID = rdflib.Namespace('http://purl.uniprot.org/uniprot/')
+OBO = rdflib.Namespace('http://purl.obolibrary.org/obo#')
+GENE = rdflib.Namespace('http://pbr.wur.nl/GENE#')
+POS = rdflib.Namespace('http://pbr.wur.nl/POSITION#')
+
+ORGANISMS = ['Arabidopsis thaliana', 'Solanum lycopersicum', 'Zea mays',
+    'Oryza sativa', 'Escherichia coli', 'Homo sapiens']
+WORDS = ['acid', 'beta', 'carotene', 'lycopene', 'oxide', 'methyl',
+    'phosphate', 'glucose', 'amine', 'ester', 'alcohol', 'cyclase']
+
+
+def build_graph(compounds, reactions, proteins, genes, seed=42):
+    """ Returns a rdflib graph with synthetic data following the
+    structure of the graphs queried by chebi2gene.
+
+    @param compounds, an integer, the number of compounds.
+    @param reactions, an integer, the number of reactions per compound.
+    @param proteins, an integer, the number of proteins per reaction.
+    @param genes, an integer, the maximum number of tomato genes per
+    protein.
+    @param seed, an integer, seed of the random generator so that the
+    same arguments give the same data.
+    @return, a tuple (graph, names) where names is the list of the names
+    of the compounds.
+    """
+    rand = random.Random(seed)
+    graph = rdflib.Graph()
+    add = graph.add
+    # Proteins are shared between reactions, as in Rhea
+    n_proteins = max(1, compounds * reactions * proteins / 3)
+    names = []
+    react_id = 10000
+    for chebi_id in range(1, compounds + 1):
+        name = '%s-%s %s' % (rand.choice(WORDS), chebi_id,
+            rand.choice(WORDS))
+        names.append(name)
+        compound = rdflib.URIRef(
+            'http://purl.obolibrary.org/obo/CHEBI_%s' % chebi_id)
+        add((compound, rdflib.RDFS.label, rdflib.Literal(name)))
+        for cnt in range(rand.randint(1, 3)):
+            add((compound, OBO.Synonym, rdflib.Literal('%s %s %s' % (
+                rand.choice(WORDS), rand.choice(WORDS), chebi_id))))
+        participant = RHEA['cmp%s' % chebi_id]
+        add((participant, BP.XREF, RHEA['CHEBI:%s' % chebi_id]))
+        for cnt in range(reactions):
+            react_id += 1
+            side = RHEA['%s_left' % react_id]
+            add((side, BP.PARTICIPANTS, participant))
+            reaction = RHEA['%s' % react_id]
+            add((reaction, BP.LEFT, side))
+            for prot in rand.sample(xrange(n_proteins),
+                    min(proteins, n_proteins)):
+                add((reaction, BP.XREF,
+                    RHEA['rel/controller/UNIPROT:P%05d' % prot]))
+
+    for prot in range(n_proteins):
+        protein = UNIPROT_ID['P%05d' % prot]
+        organism = rdflib.URIRef('http://purl.uniprot.org/taxonomy/%s'
+            % (prot % len(ORGANISMS)))
+        add((protein, UNIPROT.organism, organism))
+        add((organism, UNIPROT.scientificName,
+            rdflib.Literal(ORGANISMS[prot % len(ORGANISMS)])))
+        for cnt in range(rand.randint(0, 2)):
+            annot = rdflib.BNode()
+            add((protein, UNIPROT.annotation, annot))
+            add((annot, rdflib.RDFS.seeAlso,
+                rdflib.URIRef('http://pathway/%s/%s' % (prot, cnt))))
+            add((annot, rdflib.RDFS.comment, rdflib.Literal(
+                'Pathway %s; %s biosynthesis.' % (cnt, rand.choice(WORDS)))))
+        for cnt in range(rand.randint(0, genes)):
+            gene = GENE['Solyc%05dg%s' % (prot, cnt)]
+            position = POS['%s_%s' % (prot, cnt)]
+            start = rand.randint(1, 90000000)
+            add((gene, GENE.Protein, protein))
+            add((gene, GENE.Position, position))
+            add((gene, GENE.Description, rdflib.Literal(
+                '%s %s, putative' % (rand.choice(WORDS), rand.choice(WORDS)))))
+            add((gene, GENE.FeatureName, rdflib.Literal(
+                'Solyc%02dg%06d.1.1' % (rand.randint(1, 12),
+                    prot * 10 + cnt))))
+            add((position, POS.Scaffold, rdflib.URIRef(
+                'http://pbr.wur.nl/SCAFFOLD#SL2.31ch%02d'
+                % rand.randint(0, 12))))
+            add((position, POS.Start, rdflib.Literal(str(start))))
+            add((position, POS.Stop, rdflib.Literal(str(start + 1500))))
+    return graph, names
+
+
+class LatencyTransport(object):
+    """ Transport adding a fixed latency to each query sent to another
+    transport and counting the queries.
+    """
+
+    def __init__(self, transport, latency=0):
+        """ Constructor.
+
+        @param transport, the transport actually running the queries.
+        @param latency, a float, the number of seconds added to each
+        query.
+        """
+        self.transport = transport
+        self.latency = latency
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def post(self, url, body):
+        """ Waits for the latency and runs the query. """
+        with self._lock:
+            self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.transport.post(url, body)
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """ HTTP server handling each request in its own thread. """
+    daemon_threads = True
+
+
+def start_http_endpoint(transport):
+    """ Starts a local HTTP server answering the sparql queries POSTed to
+    it with the given transport.
+
+    @return, a tuple (server, url of the endpoint).
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """ Answers the sparql queries. """
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            """ Runs the query POSTed. """
+            body = self.rfile.read(int(self.headers['content-length']))
+            output = transport.post(None, body)
+            if isinstance(output, unicode):
+                output = output.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def log_message(self, *args):
+            """ Keeps the output of the benchmark clean. """
+            pass
+
+    server = _ThreadedHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%s/sparql' % server.server_port
+
+
+def percentile(values, percent):
+    """ Returns the given percentile of a sorted list of values. """
+    if not values:
+        return 0
+    idx = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def run_workload(urls, concurrency):
+    """ Requests the given urls from the web application with the given
+    number of concurrent clients.
+
+    @return, a tuple (sorted list of latencies, wall time, errors).
+    """
+    latencies = []
+    errors = []
+    todo = list(urls)
+    lock = threading.Lock()
+    app = webapp.create_app()
+
+    def _client():
+        """ Requests urls until there are none left. """
+        client = app.test_client()
+        while True:
+            with lock:
+                if not todo:
+                    return
+                url = todo.pop()
+            start = time.time()
+            response = client.get(url)
+            # Consume the streamed responses
+            response.get_data()
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors.append(url)
+
+    start = time.time()
+    threads = [threading.Thread(target=_client)
+        for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), time.time() - start, errors
+
+
+def main(argv):
+    """ Runs the benchmark. """
+    parser = argparse.ArgumentParser(description='Benchmark chebi2gene '
+        'against a synthetic dataset.')
+    parser.add_argument('--compounds', type=int, default=200,
+        help='Number of compounds (default: 200)')
+    parser.add_argument('--reactions', type=int, default=3,
+        help='Number of reactions per compound (default: 3)')
+    parser.add_argument('--proteins', type=int, default=4,
+        help='Number of proteins per reaction (default: 4)')
+    parser.add_argument('--genes', type=int, default=3,
+        help='Maximum number of genes per protein (default: 3)')
+    parser.add_argument('--latency', type=float, default=0.01,
+        help='Seconds added to each query (default: 0.01)')
+    parser.add_argument('--requests', type=int, default=50,
+        help='Number of requests per route (default: 50)')
+    parser.add_argument('--concurrency', type=int, default=4,
+        help='Number of concurrent clients (default: 4)')
+    parser.add_argument('--routes', default='chebi,csv,search',
+        help='Comma separated routes to benchmark among chebi, csv, '
+        'search and fullsearch (default: chebi,csv,search)')
+    parser.add_argument('--engine', choices=['stepwise', 'joined'],
+        help='Query engine to use (default: the configured one)')
+    parser.add_argument('--http', action='store_true',
+        help='Query a local HTTP endpoint instead of the graph directly')
+    parser.add_argument('--cache', action='store_true',
+        help='Keep the configured query and page caches (disabled by '
+        'default)')
+    parser.add_argument('--seed', type=int, default=42,
+        help='Seed of the random generator (default: 42)')
+    parser.add_argument('--json', action='store_true',
+        help='Print the results as JSON')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    graph, names = build_graph(args.compounds, args.reactions,
+        args.proteins, args.genes, seed=args.seed)
+    print >> sys.stderr, 'Built %s triples in %.2fs' % (
+        len(graph), time.time() - start)
+
+    endpoint = LatencyTransport(chebi2gene.RdflibTransport(graph),
+        args.latency)
+    server = None
+    if args.http:
+        server, chebi2gene.SERVER = start_http_endpoint(endpoint)
+    else:
+        chebi2gene.TRANSPORT = endpoint
+    if not args.cache:
+        chebi2gene.CACHE = chebi2gene.QueryCache()
+        chebi2gene.PAGE_CACHE = chebi2gene.LRUCache(size=0)
+    if args.engine:
+        chebi2gene.QUERY_ENGINE = args.engine
+    chebi2gene.INDEX = None
+    chebi2gene.SEARCH_INDEX = None
+    chebi2gene.REQUEST_LOG = False
+    # The routes print their requests on stdout, they go to stderr while
+    # running so that stdout only has the report
+    report = sys.stdout
+    sys.stdout = sys.stderr
+
+    rand = random.Random(args.seed)
+    workloads = {
+        'chebi': lambda: '/chebi/%s' % rand.randint(1, args.compounds),
+        'csv': lambda: '/csv/%s' % rand.randint(1, args.compounds),
+        'search': lambda: '/search/%s' % rand.choice(WORDS),
+        'fullsearch': lambda: '/fullsearch/%s' % rand.choice(WORDS),
+    }
+    results = []
+    try:
+        for route in args.routes.split(','):
+            urls = [workloads[route]() for _ in range(args.requests)]
+            queries = endpoint.queries
+            latencies, elapsed, errors = run_workload(urls, args.concurrency)
+            results.append({
+                'route': route,
+                'requests': len(latencies),
+                'errors': len(errors),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else 0,
+                'queries_per_request': float(endpoint.queries - queries) /
+                    max(1, len(latencies)),
+                'throughput': len(latencies) / elapsed if elapsed else 0,
+            })
+    finally:
+        sys.stdout = report
+    if server is not None:
+        chebi2gene.TRANSPORT.close()
+        server.shutdown()
+        server.server_close()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+        return
+    print '%-10s %8s %6s %8s %8s %8s %8s %9s %9s' % ('route', 'requests',
+        'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries/r',
+        'req/s')
+    for result in results:
+        print '%-10s %8d %6d %8.1f %8.1f %8.1f %8.1f %9.1f %9.1f' % (
+            result['route'], result['requests'], result['errors'],
+            result['p50'] * 1000, result['p90'] * 1000,
+            result['p99'] * 1000, result['max'] * 1000,
+            result['queries_per_request'], result['throughput'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
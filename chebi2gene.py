@@ -4,44 +4,101 @@
 Small web application to retrieve information from uniprot and itag for
 a given compound.
 
+This module retrieves the information and runs the commands, the pages
+are served by the application of `webapp`. It does not import Flask, nor
+rdflib until RDF dumps are loaded, so that it starts quickly.
+
 The idea is that for one compound we are able to find out in which
 reactions it is involved and what are the proteins involved in these
 reactions. For each of these proteins we can find if there are genes and
 genes from tomato associated with them.
 """
 
-from flask import Flask, Response, render_template, request, redirect, url_for
-from flaskext.wtf import Form, TextField
-
+import argparse
+import array
+import bisect
+import collections
 import ConfigParser
-import datetime
+import contextlib
+import cPickle
+import csv
+import errno
+import fcntl
+import hashlib
+import httplib
+import itertools
 import json
 import os
-import rdflib
+import Queue
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
 import urllib
+import urlparse
+import zlib
+
+from multiprocessing.pool import ThreadPool
 
 
 CONFIG = ConfigParser.ConfigParser()
 CONFIG.readfp(open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
     'chebi2gene.cfg')))
-# Address of the sparql server to query.
-SERVER = CONFIG.get('chebi2gene', 'sparql_server')
 
-# Create the application.
-APP = Flask(__name__)
-APP.secret_key = CONFIG.get('chebi2gene', 'secret_key')
 
+def _config(option, default=None, section='chebi2gene'):
+    """ Returns the value of an option of the configuration file or the
+    given default if the option is not set.
 
-# Stores in which graphs are the different source of information.
-GRAPHS = {option: CONFIG.get('graph', option) for option in CONFIG.options('graph')}
-print GRAPHS
+    @param option, a string, the name of the option to retrieve.
+    @param default, the value to return if the option is not set.
+    @param section, a string, the section of the configuration file in
+    which the option is looked for. Defaults to `chebi2gene`.
+    @return, the value of the option as a string or the default value.
+    """
+    if CONFIG.has_option(section, option):
+        return CONFIG.get(section, option)
+    return default
 
 
-class ChebiIDForm(Form):
-    """ Simple text field form to input the chebi identifier or the
-    name of the protein.
+def _config_boolean(option, default=False, section='chebi2gene'):
+    """ Returns the value of a boolean option of the configuration file
+    or the given default if the option is not set.
     """
-    chebi_id = TextField('Chebi ID or molecule name')
+    if CONFIG.has_option(section, option):
+        return CONFIG.getboolean(section, option)
+    return default
+
+
+# Addresses of the replicas of the sparql server to query.
+SERVERS = tuple(CONFIG.get('chebi2gene', 'sparql_server').replace(',',
+    ' ').split())
+# Address of the sparql server to query, the queries sent to it are
+# balanced between its replicas.
+SERVER = SERVERS[0]
+# Maximum number of proteins sent to the sparql server in a single query.
+CHUNK_SIZE = int(_config('chunk_size', 50))
+# Maximum number of queries sent at the same time to one sparql server.
+MAX_REQUESTS = int(_config('max_requests', 4))
+# How the information of a compound is queried: `stepwise` (reactions,
+# then the information of their proteins) or `joined` (a single query).
+QUERY_ENGINE = _config('query_engine', 'stepwise')
+# Number of molecules shown per page of search results.
+SEARCH_LIMIT = int(_config('search_limit', 50))
+# Print the statistics of each request as a JSON line.
+REQUEST_LOG = _config_boolean('request_log', True)
+# Render the page of a compound with its reactions only, the information
+# of the proteins being loaded by the browser as they are shown.
+PROGRESSIVE_PAGE = _config_boolean('progressive_page', False)
+
+
+# Stores in which graphs are the different source of information.
+GRAPHS = {option: CONFIG.get('graph', option) for option in CONFIG.options('graph')}
+# Identifies the configured graphs, cached data is dropped when it changes.
+GRAPHS_VERSION = hashlib.sha1(json.dumps(sorted(GRAPHS.items()))).hexdigest()
 
 
 def convert_to_uniprot_id(data):
@@ -62,17 +119,32 @@ def convert_to_uniprot_id(data):
     return data
 
 
-def get_exact_chebi_from_search(name):
-    """ Search the chebi database for molecule having the given string
-    in their name. The data returned contains the chebi identifier, the
-    name and synonyms of the molecule in chebi.
+# Variables projected from the results of the queries on the names
+_NAMES_VARIABLES = ('id', 'name', 'syn')
 
-    @param name, a string, name of the molecule to search in chebi.
-    @return, a dictionary containing all the molecule found for having
-    the input string in their name. The data structure returned is like:
-    {string: {'name': string, 'syn': [String]}}, where the keys are the
-    chebi identifier and the values are dictionaries containing the
-    name of the molecules and a list of its synonym.
+
+def _molecules_from_rows(rows):
+    """ Builds the dictionary of molecules returned by the searches from
+    the (id, name, syn) rows of a query.
+    """
+    molecules = {}
+    for uri, name, syn in rows:
+        chebi_id = uri.rsplit('/', 1)[1].split('_')[1]
+        if chebi_id in molecules:
+            molecules[chebi_id]['syn'].append(syn)
+        else:
+            molecules[chebi_id] = {
+                                    'name': [name],
+                                    'syn': [syn]
+                                  }
+    return molecules
+
+
+def get_chebi_names():
+    """ Returns the names and synonyms of all the compounds of chebi.
+
+    @return, a dictionary as returned by get_exact_chebi_from_search,
+    containing all the compounds.
     """
     query = '''
     PREFIX rdfs:<http://www.w3.org/2000/01/rdf-schema#>
@@ -80,93 +152,510 @@ def get_exact_chebi_from_search(name):
     SELECT DISTINCT ?id ?name ?syn
     FROM <%(chebi)s>
     WHERE {
-      {
         ?id rdfs:label ?name .
         ?id obo:Synonym ?syn .
-        FILTER (
-            regex(?name, "%(search)s", "i")
-        )
+    } ORDER BY ?id ?name ?syn
+    ''' % {'chebi': GRAPHS['chebi']}
+    return _molecules_from_rows(_iter_all_rows(query, _NAMES_VARIABLES))
+
+
+def _page_molecules(molecules, limit=None, after=None):
+    """ Returns one page of the given molecules, sorted by identifier.
+
+    @param molecules, a dictionary of molecules as returned by the
+    searches.
+    @param limit, an integer, the maximum number of molecules returned.
+    @param after, a string, only the molecules whose identifier comes
+    after this one are returned.
+    @return, an OrderedDict of molecules.
+    """
+    chebi_ids = sorted(molecules, key=int)
+    if after:
+        chebi_ids = chebi_ids[bisect.bisect_right(
+            [int(chebi_id) for chebi_id in chebi_ids], int(after)):]
+    if limit:
+        chebi_ids = chebi_ids[:limit]
+    return collections.OrderedDict(
+        [(chebi_id, molecules[chebi_id]) for chebi_id in chebi_ids])
+
+
+class SearchIndex(object):
+    """ In-memory index of the names and synonyms of the compounds.
+
+    The case-folded names and synonyms are kept in a sorted array, used
+    for prefix searches, and indexed by their trigrams, used for
+    substring searches.
+    """
+
+    ngram = 3
+
+    def __init__(self, names):
+        """ Constructor.
+
+        @param names, a dictionary of all the molecules, as returned by
+        get_chebi_names.
+        """
+        self.names = names
+        terms = set()
+        for chebi_id, molecule in names.items():
+            terms.add((molecule['name'][0].lower(), chebi_id, False))
+            for syn in molecule['syn']:
+                terms.add((syn.lower(), chebi_id, True))
+        # (folded term, chebi identifier, is a synonym) sorted by term
+        self._terms = sorted(terms)
+        self._keys = [term[0] for term in self._terms]
+        ngrams = {}
+        for cnt, key in enumerate(self._keys):
+            for gram in set([key[idx:idx + self.ngram]
+                    for idx in range(len(key) - self.ngram + 1)]):
+                ngrams.setdefault(gram, array.array('i')).append(cnt)
+        self._ngrams = ngrams
+
+    def _candidates(self, folded):
+        """ Returns the positions of the terms which may contain the given
+        folded string.
+        """
+        if len(folded) < self.ngram:
+            return xrange(len(self._keys))
+        postings = []
+        for idx in range(len(folded) - self.ngram + 1):
+            gram = folded[idx:idx + self.ngram]
+            if gram not in self._ngrams:
+                return []
+            postings.append(self._ngrams[gram])
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+        return sorted(candidates)
+
+    def iter_prefix(self, prefix):
+        """ Returns the names and synonyms starting with the given prefix,
+        case insensitive.
+
+        @param prefix, a string.
+        @return, a generator of tuples (folded term, chebi identifier, is
+        a synonym) sorted by term.
+        """
+        folded = prefix.lower()
+        start = bisect.bisect_left(self._keys, folded)
+        for term in itertools.islice(self._terms, start, None):
+            if not term[0].startswith(folded):
+                break
+            yield term
+
+    def prefix(self, prefix, limit=10):
+        """ Returns at most `limit` names and synonyms starting with the
+        given prefix, as iter_prefix.
+        """
+        return list(itertools.islice(self.iter_prefix(prefix), limit))
+
+    def complete(self, prefix, limit=10):
+        """ Returns the compounds having a name or a synonym starting with
+        the given prefix, case insensitive.
+
+        @param prefix, a string.
+        @param limit, an integer, the maximum number of compounds
+        returned.
+        @return, a list of dictionaries with the `id` and `name` of the
+        compounds and the name or synonym which matched, as `match`,
+        sorted by match.
+        """
+        output = []
+        seen = set()
+        for folded, chebi_id, is_syn in self.iter_prefix(prefix):
+            if len(output) >= limit:
+                break
+            if chebi_id in seen:
+                continue
+            seen.add(chebi_id)
+            molecule = self.names[chebi_id]
+            match = molecule['name'][0]
+            if is_syn:
+                match = [syn for syn in molecule['syn']
+                    if syn.lower() == folded][0]
+            output.append({'id': chebi_id, 'name': molecule['name'][0],
+                'match': match})
+        return output
+
+    def save(self, path):
+        """ Stores the SearchIndex in the given file. """
+        with open(path + '.tmp', 'wb') as stream:
+            cPickle.dump(self, stream, cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the SearchIndex stored in the given file. """
+        with open(path, 'rb') as stream:
+            return cPickle.load(stream)
+
+    def search(self, name, extended=False, limit=None, after=None):
+        """ Returns the compounds whose name, or synonyms if `extended`,
+        contain the given string (case insensitive), as
+        get_exact_chebi_from_search and get_extended_chebi_from_search.
+
+        @param name, a string, the text to search.
+        @param extended, a boolean, whether to search in the synonyms.
+        @param limit, an integer, the maximum number of molecules
+        returned.
+        @param after, a string, only the molecules whose identifier comes
+        after this one are returned.
+        @return, an OrderedDict of molecules sorted by identifier.
+        """
+        folded = name.lower()
+        names = set()
+        syns = {}
+        for cnt in self._candidates(folded):
+            key, chebi_id, is_syn = self._terms[cnt]
+            if folded not in key:
+                continue
+            if not is_syn:
+                names.add(chebi_id)
+            elif extended:
+                syns.setdefault(chebi_id, set()).add(key)
+        molecules = {}
+        for chebi_id in names:
+            molecules[chebi_id] = self.names[chebi_id]
+        for chebi_id in syns:
+            if chebi_id not in molecules:
+                molecule = self.names[chebi_id]
+                molecules[chebi_id] = {'name': molecule['name'],
+                    'syn': [syn for syn in molecule['syn']
+                        if syn.lower() in syns[chebi_id]]}
+        return _page_molecules(molecules, limit=limit, after=after)
+
+
+_SEARCH_INDEX_LOCK = threading.Lock()
+
+
+def get_search_index():
+    """ Returns the SearchIndex, loading or building it on first use.
+
+    It is loaded from the `search_index_path` file if it exists, else
+    built from the local index if there is one, otherwise from the chebi
+    graph if `search_index` is enabled in the configuration.
+
+    @return, a SearchIndex or None if there is none to use.
+    """
+    global SEARCH_INDEX
+    if SEARCH_INDEX is None:
+        with _SEARCH_INDEX_LOCK:
+            if SEARCH_INDEX is None:
+                path = _config('search_index_path')
+                if path and os.path.exists(path):
+                    SEARCH_INDEX = SearchIndex.load(path)
+                elif get_index() is not None:
+                    SEARCH_INDEX = SearchIndex(get_index().names)
+                elif _config_boolean('search_index'):
+                    SEARCH_INDEX = SearchIndex(get_chebi_names())
+    return SEARCH_INDEX
+
+
+def has_search_index():
+    """ Returns whether get_search_index has a SearchIndex to return,
+    without loading or building it.
+    """
+    if SEARCH_INDEX is not None:
+        return True
+    path = _config('search_index_path')
+    if path and os.path.exists(path):
+        return True
+    return get_index() is not None or _config_boolean('search_index')
+
+
+def refresh_search_index():
+    """ Rebuilds the SearchIndex, to take into account new data. """
+    global SEARCH_INDEX
+    with _SEARCH_INDEX_LOCK:
+        SEARCH_INDEX = None
+        AUTOCOMPLETE_CACHE.clear()
+    return get_search_index()
+
+
+def get_chebi_completions(prefix, limit=10):
+    """ Returns the compounds having a name or a synonym starting with the
+    given prefix, as SearchIndex.complete. The answers for the frequent
+    prefixes are kept in `AUTOCOMPLETE_CACHE`.
+
+    @param prefix, a string.
+    @param limit, an integer, the maximum number of compounds returned.
+    @return, a list of dictionaries, empty if there is no SearchIndex.
+    """
+    index = get_search_index()
+    if index is None or not prefix.strip():
+        return []
+    key = (prefix.lower(), limit)
+    output = AUTOCOMPLETE_CACHE.get(key)
+    if output is None:
+        output = index.complete(prefix, limit=limit)
+        AUTOCOMPLETE_CACHE.set(key, output)
+    return output
+
+
+def _sparql_regex(text):
+    """ Returns the given text escaped to be matched literally by a regex
+    in a double-quoted string of a sparql query.
+    """
+    text = re.sub(r'([.\\?*+^$|()\[\]{}-])', r'\\\1', text)
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def _search_chebi(name, extended, limit=None, after=None):
+    """ Search the chebi database for molecule having the given string in
+    their name, or in their synonyms if `extended`, using the sparql
+    endpoint.
+
+    Only one page of molecules is asked to the sparql endpoint: a
+    sub-query selects the `limit` first molecules, in the order of their
+    numerical identifier, coming after `after` and only the names and
+    synonyms of these molecules are returned.
+
+    @return, an OrderedDict of molecules sorted by identifier or None if
+    the query failed.
+    """
+    condition = 'regex(?name, "%(search)s", "i")'
+    if extended:
+        condition += ' || regex(?syn, "%(search)s", "i")'
+    condition = condition % {'search': _sparql_regex(name)}
+    query = '''
+    PREFIX rdfs:<http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX obo:<http://purl.obolibrary.org/obo#>
+    PREFIX xsd:<http://www.w3.org/2001/XMLSchema#>
+    SELECT DISTINCT ?id ?name ?syn ?num
+    FROM <%(chebi)s>
+    WHERE {
+      {
+        SELECT DISTINCT ?id ?num
+        WHERE {
+          ?id rdfs:label ?name .
+          ?id obo:Synonym ?syn .
+          FILTER (
+            %(condition)s
+          )
+          BIND (xsd:integer(STRAFTER(STR(?id), "CHEBI_")) AS ?num)
+          %(after)s
+        } ORDER BY ?num
+        %(limit)s
       }
-    } ORDER BY ?id
-    ''' % {'search': name, 'chebi': GRAPHS['chebi']}
-    data_js = sparql_query(query, SERVER)
-    if not data_js:
+      ?id rdfs:label ?name .
+      ?id obo:Synonym ?syn .
+      FILTER (
+        %(condition)s
+      )
+    } ORDER BY ?num
+    ''' % {
+        'condition': condition,
+        'after': 'FILTER (?num > %d)' % int(after) if after else '',
+        'limit': 'LIMIT %d' % int(limit) if limit else '',
+        'chebi': GRAPHS['chebi']}
+    rows = sparql_select(query, SERVER, _NAMES_VARIABLES, family='search')
+    if rows is None:
         return
-    molecules = {}
-    for entry in data_js['results']['bindings']:
-        chebi_id = entry['id']['value'].rsplit('/', 1)[1].split('_')[1]
-        if chebi_id in molecules:
-            molecules[chebi_id]['syn'].append(entry['syn']['value'])
-        else:
-            molecules[chebi_id] = {
-                                    'name': [entry['name']['value']],
-                                    'syn': [entry['syn']['value']]
-                                  }
-    return molecules
+    return _page_molecules(_molecules_from_rows(rows))
+
+
+def get_exact_chebi_from_search(name, limit=None, after=None):
+    """ Search the chebi database for molecule having the given string
+    in their name. The data returned contains the chebi identifier, the
+    name and synonyms of the molecule in chebi.
+
+    @param name, a string, name of the molecule to search in chebi.
+    @param limit, an integer, the maximum number of molecules returned.
+    @param after, a string, only the molecules whose identifier comes
+    after this one are returned.
+    @return, a dictionary containing all the molecule found for having
+    the input string in their name. The data structure returned is like:
+    {string: {'name': string, 'syn': [String]}}, where the keys are the
+    chebi identifier and the values are dictionaries containing the
+    name of the molecules and a list of its synonym. The molecules are
+    sorted by identifier.
+    """
+    index = get_search_index()
+    if index is not None:
+        return index.search(name, limit=limit, after=after)
+    return _search_chebi(name, False, limit=limit, after=after)
 
 
-def get_extended_chebi_from_search(name):
+def get_extended_chebi_from_search(name, limit=None, after=None):
     """ Search the chebi database for molecule having the given string
     in their name or in their synonyms. The data returned contains the
     chebi identifier, the name and synonyms of the molecule in chebi.
 
     @param name, a string, name of the molecule to search in chebi.
+    @param limit, an integer, the maximum number of molecules returned.
+    @param after, a string, only the molecules whose identifier comes
+    after this one are returned.
     @return, a dictionary containing all the molecule found for having
     the input string in their name or in their synonyms.
     The data structure returned is like:
     {string: {'name': string, 'syn': [String]}}, where the keys are the
     chebi identifier and the values are dictionaries containing the
-    name of the molecules and a list of its synonym.
+    name of the molecules and a list of its synonym. The molecules are
+    sorted by identifier.
     """
-    query = '''
-    PREFIX rdfs:<http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX obo:<http://purl.obolibrary.org/obo#>
-    SELECT DISTINCT ?id ?name ?syn
-    FROM <%(chebi)s>
-    WHERE {
-      {
-        ?id rdfs:label ?name .
-        ?id obo:Synonym ?syn .
-        FILTER (
-            regex(?name, "%(search)s", "i")
-            || regex(?syn, "%(search)s", "i")
-        )
-      }
-    } ORDER BY ?id
-    ''' % {'search': name, 'chebi': GRAPHS['chebi']}
-    data_js = sparql_query(query, SERVER)
-    if not data_js:
-        return
-    molecules = {}
-    for entry in data_js['results']['bindings']:
-        chebi_id = entry['id']['value'].rsplit('/', 1)[1].split('_')[1]
-        if chebi_id in molecules:
-            molecules[chebi_id]['syn'].append(entry['syn']['value'])
-        else:
-            molecules[chebi_id] = {
-                                    'name': [entry['name']['value']],
-                                    'syn': [entry['syn']['value']]
-                                  }
-    return molecules
+    index = get_search_index()
+    if index is not None:
+        return index.search(name, extended=True, limit=limit, after=after)
+    return _search_chebi(name, True, limit=limit, after=after)
 
 
-def get_genes_of_proteins(data):
-    """ Returns the genes associated with proteins.
+# Table sharing the strings repeated across the results (scaffolds,
+# organisms and pathways) while an index is built or loaded
+_STRINGS = threading.local()
 
-    @param name, a dictionary where the keys are reactions identifier
+
+@contextlib.contextmanager
+def _interning():
+    """ Shares the repeated strings of the results read by the current
+    thread within the block, the table is dropped at its end so that it
+    does not grow for the whole life of the process.
+    """
+    _STRINGS.table = {}
+    try:
+        yield
+    finally:
+        del _STRINGS.table
+
+
+def _intern(value):
+    """ Returns the shared copy of the given string within _interning, or
+    the string itself.
+    """
+    table = getattr(_STRINGS, 'table', None)
+    if table is None or value is None:
+        return value
+    return table.setdefault(value, value)
+
+
+def _coordinate(value):
+    """ Returns a position on a scaffold as an integer when it is one. """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class Gene(object):
+    """ A tomato gene associated with a protein and its position on the
+    genome.
+
+    The fields can also be read as items (`gene['sca']`) so that genes
+    are rendered and exported as the dictionaries they replace.
+    """
+
+    __slots__ = ('name', 'sca', 'start', 'stop', 'desc')
+
+    def __init__(self, name, sca, start, stop, desc):
+        """ Constructor.
+
+        @param name, a string, the feature name of the gene.
+        @param sca, a string, the name of its scaffold.
+        @param start, an integer, where the gene starts on the scaffold.
+        @param stop, an integer, where the gene stops on the scaffold.
+        @param desc, a string, the description of the gene.
+        """
+        self.name = name
+        self.sca = _intern(sca)
+        self.start = _coordinate(start)
+        self.stop = _coordinate(stop)
+        self.desc = desc
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __getstate__(self):
+        return tuple([getattr(self, key) for key in self.__slots__])
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+        self.sca = _intern(self.sca)
+
+    def __eq__(self, other):
+        if not isinstance(other, Gene):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        return 'Gene(%s)' % ', '.join([repr(value)
+            for value in self.__getstate__()])
+
+    def as_dict(self):
+        """ Returns the gene as a dictionary. """
+        return dict([(key, getattr(self, key)) for key in self.__slots__])
+
+
+def unique_proteins(data):
+    """ Returns the list of the unique proteins identifier found in all
+    the reactions, in the order in which they first appear.
+
+    @param data, a dictionary where the keys are reactions identifier
     and the values lists of proteins identifier.
-    @return, a dictionary containing all the genes related with the
-    proteins specified.
-    The data structure returned is like:
-    {string: [String]}, where the keys are the uniprot identifier and
-    the values are list of gene identifier associated with the protein.
+    @return, a list of unique proteins identifier.
     """
-    genes = {}
+    seen = set()
+    proteins = []
     for key in data:
-        proteins = data[key]
-        # Let's make sure the identifiers are unique
-        proteins = list(set(proteins))
-        query = '''
+        for protein in data[key]:
+            if protein not in seen:
+                seen.add(protein)
+                proteins.append(protein)
+    return proteins
+
+
+def _chunks(items, size):
+    """ Split the given list in successive lists of at most `size`
+    elements.
+
+    @param items, the list to split.
+    @param size, an integer, the maximum number of elements per chunk.
+    @return, a list of lists.
+    """
+    size = max(1, size)
+    return [items[cnt:cnt + size] for cnt in range(0, len(items), size)]
+
+
+def _uniprot_uris(proteins):
+    """ Returns the list of uniprot URIs used in the `IN` filter of the
+    queries for the given proteins identifier.
+    """
+    return ',\n'.join(['<http://purl.uniprot.org/uniprot/%s>' % protein
+        for protein in proteins])
+
+
+def _protein_chunks(data, chunk_size=None):
+    """ Returns the unique proteins of all the reactions split in chunks
+    small enough to be sent in a single query.
+
+    @param data, a dictionary where the keys are reactions identifier
+    and the values lists of proteins identifier.
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a list of lists of proteins identifier.
+    """
+    return _chunks(unique_proteins(data), chunk_size or CHUNK_SIZE)
+
+
+# Variables projected from the results of the genes queries
+_GENES_VARIABLES = ('prot', 'name', 'sca', 'start', 'stop', 'desc')
+
+
+def _genes_query(proteins):
+    """ Returns the query retrieving the genes of the given proteins. """
+    return '''
         PREFIX gene:<http://pbr.wur.nl/GENE#>
         PREFIX pos:<http://pbr.wur.nl/POSITION#>
         SELECT DISTINCT ?prot ?name ?sca ?start ?stop ?desc
@@ -175,7 +664,7 @@ def get_genes_of_proteins(data):
             ?gene gene:Protein ?prot .
                 FILTER (
                 ?prot IN (
-<http://purl.uniprot.org/uniprot/%(prot)s>
+%(prot)s
                 )
             )
             ?gene gene:Position ?pos .
@@ -185,41 +674,60 @@ def get_genes_of_proteins(data):
             ?pos pos:Start ?start .
             ?pos pos:Stop ?stop .
         } ORDER BY ?name
-        ''' % {'prot': '>,\n<http://purl.uniprot.org/uniprot/'.join(
-            proteins), 'itag': GRAPHS['itag']}
-        data_js = sparql_query(query, SERVER)
-        for entry in data_js['results']['bindings']:
-            prot_id = entry['prot']['value'].rsplit('/', 1)[1]
-            gene = {}
-            for var in ['name', 'sca', 'start', 'stop', 'desc']:
-                gene[var] = entry[var]['value']
-
-            gene['sca'] = gene['sca'].rsplit('#', 1)[1]
+        ''' % {'prot': _uniprot_uris(proteins), 'itag': GRAPHS['itag']}
+
+
+def _genes_from_results(results):
+    """ Builds the genes dictionary returned by get_genes_of_proteins
+    from the rows of the genes queries.
+    """
+    genes = {}
+    for rows in results:
+        for prot, name, sca, start, stop, desc in _checked_rows(rows):
+            prot_id = prot.rsplit('/', 1)[1]
+            gene = Gene(name, sca.rsplit('#', 1)[1], start, stop, desc)
             if prot_id in genes:
                 genes[prot_id].append(gene)
             else:
                 genes[prot_id] = [gene]
-
     return genes
 
 
-def get_pathways_of_proteins(data):
-    """ Returns the pathways associated with proteins.
+def get_genes_of_proteins(data, chunk_size=None, use_cache=True):
+    """ Returns the genes associated with proteins.
+
+    The proteins of all the reactions are queried together, in chunks of
+    at most `chunk_size` proteins.
 
     @param name, a dictionary where the keys are reactions identifier
-    and the values lists of proteins.
-    @return, a dictionary containing all the pathways related with the
+    and the values lists of proteins identifier.
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @param use_cache, a boolean, whether the rows may be read from and
+    stored in the cache.
+    @return, a dictionary containing all the genes related with the
     proteins specified.
     The data structure returned is like:
     {string: [String]}, where the keys are the uniprot identifier and
-    the values are list of pathways associated with the protein.
+    the values are list of gene identifier associated with the protein.
     """
-    pathways = {}
-    for key in data:
-        proteins = data[key]
-        # Let's make sure the identifiers are unique
-        proteins = list(set(proteins))
-        query = '''
+    index = get_index()
+    if index is not None:
+        return index.of_proteins('genes', data)
+    return _genes_from_results(sparql_select_all(
+        [_genes_query(proteins)
+            for proteins in _protein_chunks(data, chunk_size)],
+        SERVER, _GENES_VARIABLES, family='genes', use_cache=use_cache))
+
+
+# Variables projected from the results of the pathways queries
+_PATHWAYS_VARIABLES = ('prot', 'desc')
+
+
+def _pathways_query(proteins):
+    """ Returns the query retrieving the pathways of the given proteins.
+    """
+    return '''
         PREFIX gene:<http://pbr.wur.nl/GENE#>
         PREFIX uniprot:<http://purl.uniprot.org/core/>
         PREFIX rdfs:<http://www.w3.org/2000/01/rdf-schema#>
@@ -231,41 +739,61 @@ def get_pathways_of_proteins(data):
             ?annot rdfs:comment ?desc .
             FILTER (
                 ?prot IN (
-<http://purl.uniprot.org/uniprot/%(prot)s>
+%(prot)s
                 )
             )
         }
-        ''' % {'prot':
-        '>,\n<http://purl.uniprot.org/uniprot/'.join(proteins),
+        ''' % {'prot': _uniprot_uris(proteins),
                 'uniprot': GRAPHS['uniprot']}
-        data_js = sparql_query(query, SERVER)
-        for entry in data_js['results']['bindings']:
-            prot_id = entry['prot']['value'].rsplit('/', 1)[1]
-            path = entry['desc']['value']
-            if prot_id in pathways and path not in pathways[prot_id]:
-                pathways[prot_id].append(path)
-            else:
-                pathways[prot_id] = [path]
+
+
+def _pathways_from_results(results):
+    """ Builds the pathways dictionary returned by
+    get_pathways_of_proteins from the rows of the pathways queries.
+    """
+    pathways = {}
+    for rows in results:
+        for prot, path in _checked_rows(rows):
+            prot_id = prot.rsplit('/', 1)[1]
+            paths = pathways.setdefault(prot_id, [])
+            if path not in paths:
+                paths.append(_intern(path))
     return pathways
 
 
-def get_organism_of_proteins(data):
-    """ Returns the all organism associated with the proteins.
+def get_pathways_of_proteins(data, chunk_size=None):
+    """ Returns the pathways associated with proteins.
+
+    The proteins of all the reactions are queried together, in chunks of
+    at most `chunk_size` proteins.
 
     @param name, a dictionary where the keys are reactions identifier
     and the values lists of proteins.
-    @return, a dictionary containing all the organism related with the
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a dictionary containing all the pathways related with the
     proteins specified.
     The data structure returned is like:
     {string: [String]}, where the keys are the uniprot identifier and
-    the values are list of organisms associated with the protein.
+    the values are list of pathways associated with the protein.
     """
-    organism = {}
-    for key in data:
-        proteins = data[key]
-        # Let's make sure the identifiers are unique
-        proteins = list(set(proteins))
-        query = '''
+    index = get_index()
+    if index is not None:
+        return index.of_proteins('pathways', data)
+    return _pathways_from_results(sparql_select_all(
+        [_pathways_query(proteins)
+            for proteins in _protein_chunks(data, chunk_size)],
+        SERVER, _PATHWAYS_VARIABLES, family='pathways'))
+
+
+# Variables projected from the results of the organism queries
+_ORGANISM_VARIABLES = ('prot', 'name')
+
+
+def _organism_query(proteins):
+    """ Returns the query retrieving the organisms of the given proteins.
+    """
+    return '''
         PREFIX uniprot:<http://purl.uniprot.org/core/>
         SELECT DISTINCT ?prot ?name
         FROM <%(uniprot)s>
@@ -274,90 +802,1864 @@ def get_organism_of_proteins(data):
             ?orga uniprot:scientificName ?name .
             FILTER (
                 ?prot IN (
-<http://purl.uniprot.org/uniprot/%(prot)s>
+%(prot)s
                 )
             )
         }
-        ''' % {'prot':
-            '>,\n<http://purl.uniprot.org/uniprot/'.join(proteins),
+        ''' % {'prot': _uniprot_uris(proteins),
                 'uniprot': GRAPHS['uniprot']}
-        data_js = sparql_query(query, SERVER)
-        for entry in data_js['results']['bindings']:
-            prot_id = entry['prot']['value'].rsplit('/', 1)[1]
-            orga = entry['name']['value']
-            if prot_id in organism and orga not in organism[prot_id]:
-                organism[prot_id].append(orga)
-            else:
-                organism[prot_id] = [orga]
+
+
+def _organism_from_results(results):
+    """ Builds the organism dictionary returned by
+    get_organism_of_proteins from the rows of the organism queries.
+    """
+    organism = {}
+    for rows in results:
+        for prot, orga in _checked_rows(rows):
+            prot_id = prot.rsplit('/', 1)[1]
+            orgas = organism.setdefault(prot_id, [])
+            if orga not in orgas:
+                orgas.append(_intern(orga))
     return organism
 
 
-def get_protein_of_chebi(chebi_id):
-    """ Returns the all protein associated with a compound.
+def get_organism_of_proteins(data, chunk_size=None):
+    """ Returns the all organism associated with the proteins.
 
-    @param name, a string, identifier of a compound on chebi.
-    @return, a dictionary containing all the proteins related with the
-    compound specified.
+    The proteins of all the reactions are queried together, in chunks of
+    at most `chunk_size` proteins.
+
+    @param name, a dictionary where the keys are reactions identifier
+    and the values lists of proteins.
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a dictionary containing all the organism related with the
+    proteins specified.
     The data structure returned is like:
-    {string: [String]}, where the keys are reaction identifiers and the
-    values are list of proteins associated with the reaction.
+    {string: [String]}, where the keys are the uniprot identifier and
+    the values are list of organisms associated with the protein.
     """
-    query = '''
-    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
-    SELECT DISTINCT ?react ?xref
-    FROM <%(rhea)s>
-    WHERE {
-      ?cmp bp:XREF <http://www.ebi.ac.uk/rhea#CHEBI:%(chebi_id)s> .
-      ?dir ?p ?cmp .
-      ?react ?p2 ?dir .
-      ?react bp:XREF ?xref .
-      FILTER (
-        regex(?xref, 'UNIPROT')
-      )
-    }
-    ''' % {'chebi_id': chebi_id, 'rhea': GRAPHS['rhea']}
-    data = sparql_query(query, SERVER)
-    if not data:
-        return
-    output = {}
-    for entry in data['results']['bindings']:
-        key = entry['react']['value'].split('#')[1]
-        if key in output:
-            output[key].append(entry['xref']['value'])
-        else:
-            output[key] = [entry['xref']['value']]
-    return output
+    index = get_index()
+    if index is not None:
+        return index.of_proteins('organisms', data)
+    return _organism_from_results(sparql_select_all(
+        [_organism_query(proteins)
+            for proteins in _protein_chunks(data, chunk_size)],
+        SERVER, _ORGANISM_VARIABLES, family='organisms'))
 
 
-def sparql_query(query, server, output_format='application/json'):
+def get_information_of_proteins(data, chunk_size=None):
+    """ Returns the pathways, genes and organisms associated with the
+    proteins.
+
+    The queries of the three lookups, and of all their chunks, are all
+    sent concurrently, so the time spent is roughly the one of the
+    slowest query rather than the sum of all of them.
+
+    @param data, a dictionary where the keys are reactions identifier
+    and the values lists of proteins.
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a tuple (pathways, genes, organisms) of dictionaries as
+    returned by get_pathways_of_proteins, get_genes_of_proteins and
+    get_organism_of_proteins.
+    """
+    index = get_index()
+    if index is not None:
+        return index.information(data)
+    return _query_information_of_proteins(_protein_chunks(data, chunk_size))
+
+
+def _query_information_of_proteins(chunks, use_cache=True):
+    """ Queries the pathways, genes and organisms of the given chunks of
+    proteins concurrently, as get_information_of_proteins.
+
+    @param use_cache, a boolean, whether the rows may be read from and
+    stored in the cache.
+    """
+    steps = [
+        ('pathways', _pathways_query, _PATHWAYS_VARIABLES,
+            _pathways_from_results),
+        ('genes', _genes_query, _GENES_VARIABLES, _genes_from_results),
+        ('organisms', _organism_query, _ORGANISM_VARIABLES,
+            _organism_from_results),
+    ]
+    queries = []
+    variables = []
+    families = []
+    for family, build_query, step_variables, _ in steps:
+        queries.extend([build_query(proteins) for proteins in chunks])
+        variables.extend([step_variables] * len(chunks))
+        families.extend([family] * len(chunks))
+    results = sparql_select_all(queries, SERVER, variables, family=families,
+        use_cache=use_cache)
+    output = []
+    for cnt, (_, _, _, parse_results) in enumerate(steps):
+        output.append(parse_results(
+            results[cnt * len(chunks):(cnt + 1) * len(chunks)]))
+    return tuple(output)
+
+
+def iter_information_of_proteins(data, chunk_size=None):
+    """ Returns the pathways, genes and organisms associated with the
+    proteins, chunk by chunk as soon as they are available.
+
+    The chunks are queried concurrently but returned in the order in
+    which their proteins first appear in the reactions.
+
+    @param data, a dictionary where the keys are reactions identifier
+    and the values lists of proteins.
+    @param chunk_size, an integer, the maximum number of proteins per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a generator of tuples (proteins, pathways, genes, organisms)
+    where proteins is the list of proteins of the chunk and the others
+    are dictionaries as returned by get_information_of_proteins.
+    """
+    index = get_index()
+    if index is not None:
+        yield (unique_proteins(data),) + index.information(data)
+        return
+    chunks = _protein_chunks(data, chunk_size)
+    if not chunks:
+        return
+
+    def _get_information(proteins):
+        """ Returns the information of one chunk of proteins. """
+        return (proteins,) + get_information_of_proteins(
+            {None: proteins}, len(proteins))
+
+    pool = ThreadPool(max(1, min(len(chunks), MAX_REQUESTS)))
+    try:
+        for information in pool.imap(_with_stats(_get_information),
+                chunks):
+            yield information
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class ProteinInformation(object):
+    """ Gives access to the pathways, genes and organisms of proteins,
+    retrieved chunk by chunk by iter_information_of_proteins only when
+    they are first needed.
+    """
+
+    def __init__(self, data, chunk_size=None, information=None):
+        """ Constructor.
+
+        @param data, a dictionary where the keys are reactions identifier
+        and the values lists of proteins, the proteins are retrieved in
+        the order in which they first appear in it.
+        @param chunk_size, an integer, the maximum number of proteins per
+        query. Defaults to the `chunk_size` set in the configuration.
+        @param information, a tuple (pathways, genes, organisms) if the
+        information of the proteins has already been retrieved.
+        """
+        self.pathways = {}
+        self.genes = {}
+        self.organisms = {}
+        self._fetched = set()
+        if information is not None:
+            self._chunks = (chunk for chunk in
+                [(unique_proteins(data),) + tuple(information)])
+        else:
+            self._chunks = iter_information_of_proteins(data, chunk_size)
+
+    def fetch(self, protein):
+        """ Makes sure the information of the given protein have been
+        retrieved, waiting for the chunks until the one containing it.
+        """
+        while protein not in self._fetched:
+            try:
+                chunk, pathways, genes, organisms = next(self._chunks)
+            except StopIteration:
+                self._fetched.add(protein)
+                return
+            self._fetched.update(chunk)
+            self.pathways.update(pathways)
+            self.genes.update(genes)
+            self.organisms.update(organisms)
+
+    def close(self):
+        """ Stops retrieving the information of the remaining proteins.
+        """
+        self._chunks.close()
+
+
+def get_protein_of_chebi(chebi_id):
+    """ Returns the all protein associated with a compound.
+
+    @param name, a string, identifier of a compound on chebi.
+    @return, a dictionary containing all the proteins related with the
+    compound specified.
+    The data structure returned is like:
+    {string: [String]}, where the keys are reaction identifiers and the
+    values are list of proteins associated with the reaction.
+    @raise QueryError, if the query fails.
+    """
+    index = get_index()
+    if index is not None:
+        return index.protein_of_chebi(chebi_id)
+    query = '''
+    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
+    SELECT DISTINCT ?react ?xref
+    FROM <%(rhea)s>
+    WHERE {
+      ?cmp bp:XREF <http://www.ebi.ac.uk/rhea#CHEBI:%(chebi_id)s> .
+      ?dir ?p ?cmp .
+      ?react ?p2 ?dir .
+      ?react bp:XREF ?xref .
+      FILTER (
+        regex(str(?xref), 'UNIPROT')
+      )
+    }
+    ''' % {'chebi_id': chebi_id, 'rhea': GRAPHS['rhea']}
+    rows = _checked_rows(sparql_select(query, SERVER, ('react', 'xref'),
+        family='reactions'))
+    output = {}
+    for react, xref in rows:
+        key = react.split('#')[1]
+        if key in output:
+            output[key].append(xref)
+        else:
+            output[key] = [xref]
+    return output
+
+
+def get_protein_of_chebis(chebi_ids, chunk_size=None):
+    """ Returns the all protein associated with several compounds.
+
+    The compounds are queried together, in chunks of at most
+    `chunk_size` compounds, and the chunks are sent concurrently.
+
+    @param chebi_ids, a list of strings, identifiers of compounds on
+    chebi.
+    @param chunk_size, an integer, the maximum number of compounds per
+    query. Defaults to the `chunk_size` set in the configuration.
+    @return, a dictionary containing all the proteins related with the
+    compounds specified.
+    The data structure returned is like:
+    {string: {string: [String]}}, where the keys are the chebi
+    identifiers and the values are dictionaries as returned by
+    get_protein_of_chebi. Compounds without reaction are left out.
+    """
+    index = get_index()
+    if index is not None:
+        return dict([(chebi_id, index.protein_of_chebi(chebi_id))
+            for chebi_id in chebi_ids if chebi_id in index.reactions])
+    queries = []
+    for chunk in _chunks(list(chebi_ids), chunk_size or CHUNK_SIZE):
+        queries.append('''
+    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
+    SELECT DISTINCT ?chebi ?react ?xref
+    FROM <%(rhea)s>
+    WHERE {
+      ?cmp bp:XREF ?chebi .
+      FILTER (
+        ?chebi IN (
+%(chebi)s
+        )
+      )
+      ?dir ?p ?cmp .
+      ?react ?p2 ?dir .
+      ?react bp:XREF ?xref .
+      FILTER (
+        regex(str(?xref), 'UNIPROT')
+      )
+    }
+    ''' % {'chebi': ',\n'.join(['<http://www.ebi.ac.uk/rhea#CHEBI:%s>'
+                % chebi_id for chebi_id in chunk]),
+            'rhea': GRAPHS['rhea']})
+    output = {}
+    for rows in sparql_select_all(queries, SERVER,
+            ('chebi', 'react', 'xref'), family='reactions'):
+        for chebi, react, xref in _checked_rows(rows):
+            chebi_id = chebi.rsplit(':', 1)[1]
+            key = react.split('#')[1]
+            output.setdefault(chebi_id, {}).setdefault(key, []).append(xref)
+    return output
+
+
+def _joined_information_of_chebi(chebi_id):
+    """ Returns the reactions of a compound and the pathways, genes and
+    organisms of their proteins using a single sparql query, which walks
+    from the compound to its reactions, their proteins and the
+    information of these proteins in the Rhea, UniProt and iTAG graphs.
+
+    @param chebi_id, a string, identifier of a compound on chebi.
+    @return, a tuple as returned by get_information_of_chebi.
+    """
+    query = '''
+    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
+    PREFIX gene:<http://pbr.wur.nl/GENE#>
+    PREFIX pos:<http://pbr.wur.nl/POSITION#>
+    PREFIX uniprot:<http://purl.uniprot.org/core/>
+    PREFIX rdfs:<http://www.w3.org/2000/01/rdf-schema#>
+    SELECT DISTINCT ?react ?xref ?kind ?desc ?name ?sca ?start ?stop
+    FROM <%(rhea)s>
+    FROM <%(uniprot)s>
+    FROM <%(itag)s>
+    WHERE {
+      ?cmp bp:XREF <http://www.ebi.ac.uk/rhea#CHEBI:%(chebi_id)s> .
+      ?dir ?p ?cmp .
+      ?react ?p2 ?dir .
+      ?react bp:XREF ?xref .
+      FILTER (
+        regex(str(?xref), 'UNIPROT')
+      )
+      BIND (IRI(CONCAT('http://purl.uniprot.org/uniprot/',
+        STRAFTER(STR(?xref), 'UNIPROT:'))) AS ?prot)
+      OPTIONAL {
+        {
+          ?prot uniprot:annotation ?annot .
+          ?annot rdfs:seeAlso ?url .
+          ?annot rdfs:comment ?desc .
+          BIND ('pathway' AS ?kind)
+        } UNION {
+          ?prot uniprot:organism ?orga .
+          ?orga uniprot:scientificName ?name .
+          BIND ('organism' AS ?kind)
+        } UNION {
+          ?gene gene:Protein ?prot .
+          ?gene gene:Position ?pos .
+          ?pos pos:Scaffold ?sca .
+          ?gene gene:Description ?desc .
+          ?gene gene:FeatureName ?name .
+          ?pos pos:Start ?start .
+          ?pos pos:Stop ?stop .
+          BIND ('gene' AS ?kind)
+        }
+      }
+    } ORDER BY ?react ?xref ?kind ?name ?desc
+    ''' % {'chebi_id': chebi_id, 'rhea': GRAPHS['rhea'],
+        'uniprot': GRAPHS['uniprot'], 'itag': GRAPHS['itag']}
+    rows = _checked_rows(sparql_select(query, SERVER, ('react', 'xref',
+        'kind', 'desc', 'name', 'sca', 'start', 'stop'), family='joined'))
+    if not rows:
+        return
+    proteins = {}
+    pathways, genes, organisms = {}, {}, {}
+    seen = set()
+    for react, xref, kind, desc, name, sca, start, stop in rows:
+        key = react.split('#')[1]
+        if (key, xref) not in seen:
+            seen.add((key, xref))
+            proteins.setdefault(key, []).append(xref)
+        prot_id = xref.rsplit(':', 1)[1].strip()
+        if kind == 'pathway':
+            paths = pathways.setdefault(prot_id, [])
+            if desc not in paths:
+                paths.append(_intern(desc))
+        elif kind == 'organism':
+            orgas = organisms.setdefault(prot_id, [])
+            if name not in orgas:
+                orgas.append(_intern(name))
+        elif kind == 'gene':
+            gene = Gene(name, sca.rsplit('#', 1)[1], start, stop, desc)
+            # A protein shared by several reactions comes back once per
+            # reaction
+            if gene not in genes.setdefault(prot_id, []):
+                genes[prot_id].append(gene)
+    return convert_to_uniprot_id(proteins), pathways, genes, organisms
+
+
+def get_information_of_chebi(chebi_id):
+    """ Returns the reactions of a compound and the pathways, genes and
+    organisms of their proteins.
+
+    With the `joined` query engine of the configuration, all of it is
+    retrieved with a single query, otherwise the reactions are retrieved
+    first and then the information of their proteins.
+
+    @param chebi_id, a string, identifier of a compound on chebi.
+    @return, a tuple (proteins, pathways, genes, organisms) where
+    proteins is a dictionary of the proteins identifier of each reaction
+    and the others are as returned by get_information_of_proteins, or
+    None if the compound has no reaction.
+    The concurrent calls for the same compound share a single retrieval.
+    """
+    if get_index() is not None:
+        return _information_of_chebi(chebi_id)
+    return COMPOUNDS_IN_FLIGHT.do((chebi_id, QUERY_ENGINE),
+        _information_of_chebi, chebi_id)[0]
+
+
+def _information_of_chebi(chebi_id):
+    """ Retrieves the information of a compound for
+    get_information_of_chebi.
+    """
+    if QUERY_ENGINE == 'joined' and get_index() is None:
+        return _joined_information_of_chebi(chebi_id)
+    proteins = get_protein_of_chebi(chebi_id)
+    if not proteins:
+        return
+    proteins = convert_to_uniprot_id(proteins)
+    return (proteins,) + get_information_of_proteins(proteins)
+
+
+def stream_information_of_chebi(chebi_id):
+    """ Returns the reactions of a compound and a ProteinInformation
+    giving access to the information of their proteins, retrieved chunk
+    by chunk unless the `joined` query engine is used.
+
+    @param chebi_id, a string, identifier of a compound on chebi.
+    @return, a tuple (proteins, information) or (None, None) if the
+    compound has no reaction.
+    """
+    if QUERY_ENGINE == 'joined' and get_index() is None:
+        output = _joined_information_of_chebi(chebi_id)
+        if not output:
+            return None, None
+        return output[0], ProteinInformation(output[0],
+            information=output[1:])
+    proteins = get_protein_of_chebi(chebi_id)
+    if not proteins:
+        return None, None
+    proteins = convert_to_uniprot_id(proteins)
+    return proteins, ProteinInformation(proteins)
+
+
+class ServerError(httplib.HTTPException):
+    """ Raised when the sparql endpoint still answers with a server error
+    (5xx status) once the retries are exhausted.
+    """
+
+
+def _closed_by_peer(error):
+    """ Returns whether the given error is the one of a request sent over
+    a connection that the endpoint had already closed, as it does with
+    the idle connections once its keep-alive timeout expires.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and not isinstance(error,
+        socket.timeout) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class HttpTransport(object):
+    """ Sends the queries to the sparql endpoints over persistent HTTP
+    connections.
+
+    The connections are kept open and pooled per endpoint, the responses
+    may be compressed with gzip or deflate and the requests failing with
+    a connection error or a 5xx status are retried with an exponential
+    backoff. An idle connection closed by the endpoint is replaced by a
+    new one right away.
+
+    Any object with a `post(url, body)` method returning the body of the
+    response can be used in place of it as `TRANSPORT`, the responses are
+    then read whole when a `stream(url, body)` method is missing.
+    """
+
+    # Number of bytes read at once from the streamed responses
+    stream_chunk_size = 64 * 1024
+
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    }
+
+    def __init__(self, connect_timeout=10, read_timeout=120, retries=2,
+            backoff=0.5, pool_size=None):
+        """ Constructor.
+
+        @param connect_timeout, a float, the number of seconds to wait for
+        the connection to the endpoint to be established.
+        @param read_timeout, a float, the number of seconds to wait for
+        data from the endpoint once connected.
+        @param retries, an integer, how many times a failed request is
+        sent again.
+        @param backoff, a float, the number of seconds to wait before the
+        first retry, doubled at each new retry.
+        @param pool_size, an integer, the maximum number of idle
+        connections kept per endpoint. Defaults to `max_requests`.
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size or max(1, MAX_REQUESTS)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key):
+        """ Returns an idle connection to the given (scheme, host) or a
+        new one if there are none.
+        """
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if pool:
+                return pool.pop()
+        return self._new_connection(key)
+
+    def _new_connection(self, key):
+        """ Returns a new, not yet connected, connection to the given
+        (scheme, host).
+        """
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host,
+                timeout=self.connect_timeout)
+        return httplib.HTTPConnection(host, timeout=self.connect_timeout)
+
+    def _release_connection(self, key, connection):
+        """ Puts back the given connection in the pool of idle
+        connections, or closes it if the pool is full.
+        """
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """ Closes all the idle connections. """
+        with self._lock:
+            pools = self._pools
+            self._pools = {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+    def post(self, url, body):
+        """ Sends the given body to the given url in a POST request and
+        returns the body of the response.
+
+        @param url, a string, the url of the sparql endpoint.
+        @param body, a string, the url-encoded parameters of the query.
+        @return, a string, the decompressed body of the response.
+        @raise ServerError, if the endpoint answers with a server error.
+        """
+        key, path = self._target(url)
+        attempt = 0
+        reconnect = False
+        while True:
+            if reconnect:
+                connection = self._new_connection(key)
+            else:
+                connection = self._get_connection(key)
+            reused = connection.sock is not None
+            reconnect = False
+            response = None
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                connection.sock.settimeout(self.read_timeout)
+                connection.request('POST', path, body, self.headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException) as error:
+                connection.close()
+                if reused and response is None and _closed_by_peer(error):
+                    # The endpoint closed the idle connection meanwhile,
+                    # a new one is opened at once without using a retry
+                    reconnect = True
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._release_connection(key, connection)
+                if response.status < 500:
+                    return _decompress(data,
+                        response.getheader('content-encoding'))
+                if attempt >= self.retries:
+                    raise ServerError('%s answered with status %s' % (
+                        url, response.status))
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def stream(self, url, body):
+        """ Sends the given body to the given url in a POST request and
+        returns the decompressed body of the response piece by piece, as
+        it is received.
+
+        The request is retried as in post until the response starts, an
+        error while reading the body is raised.
+
+        @param url, a string, the url of the sparql endpoint.
+        @param body, a string, the url-encoded parameters of the query.
+        @return, a generator of strings, the pieces of the body.
+        @raise ServerError, if the endpoint answers with a server error.
+        """
+        key, path = self._target(url)
+        attempt = 0
+        reconnect = False
+        while True:
+            if reconnect:
+                connection = self._new_connection(key)
+            else:
+                connection = self._get_connection(key)
+            reused = connection.sock is not None
+            reconnect = False
+            response = None
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                connection.sock.settimeout(self.read_timeout)
+                connection.request('POST', path, body, self.headers)
+                response = connection.getresponse()
+                if response.status < 500:
+                    break
+                response.read()
+            except (socket.error, httplib.HTTPException) as error:
+                connection.close()
+                if reused and response is None and _closed_by_peer(error):
+                    # The endpoint closed the idle connection meanwhile,
+                    # a new one is opened at once without using a retry
+                    reconnect = True
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._release_connection(key, connection)
+                if attempt >= self.retries:
+                    raise ServerError('%s answered with status %s' % (
+                        url, response.status))
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+        complete = False
+        try:
+            for data in _iter_decompressed(iter(
+                    lambda: response.read(self.stream_chunk_size), ''),
+                    response.getheader('content-encoding')):
+                yield data
+            complete = True
+        finally:
+            # A connection whose response was not read whole is unusable
+            if complete and not response.will_close:
+                self._release_connection(key, connection)
+            else:
+                connection.close()
+
+    @staticmethod
+    def _target(url):
+        """ Returns the (scheme, host) and the path of the given url. """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        return (parts.scheme, parts.netloc), path
+
+
+def _iter_decompressed(chunks, encoding):
+    """ Returns the given pieces of data decompressed according to the
+    given Content-Encoding, as _decompress does for the whole data.
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding not in ('gzip', 'deflate'):
+        for data in chunks:
+            yield data
+        return
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj()
+    first = True
+    for data in chunks:
+        try:
+            data = decompressor.decompress(data)
+        except zlib.error:
+            if encoding != 'deflate' or not first:
+                raise
+            # Some servers send raw deflate data without zlib header
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decompressor.decompress(data)
+        first = False
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _decompress(data, encoding):
+    """ Returns the given data decompressed according to the given
+    Content-Encoding.
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate data without zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+# Transport used to send the queries to the sparql endpoints.
+TRANSPORT = HttpTransport(
+    connect_timeout=float(_config('connect_timeout', 10)),
+    read_timeout=float(_config('read_timeout', 120)),
+    retries=int(_config('retries', 2)),
+    backoff=float(_config('retry_backoff', 0.5)))
+
+
+class LRUCache(object):
+    """ In-process cache keeping at most `size` entries, each for at most
+    `ttl` seconds, and evicting the least recently used entries first.
+    """
+
+    def __init__(self, size=1000, ttl=3600):
+        """ Constructor.
+
+        @param size, an integer, the maximum number of entries kept.
+        @param ttl, a float, the number of seconds an entry is kept.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value stored for the given key or None if there
+        is none or if it expired.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            # Re-insert the entry to mark it as the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """ Stores the given value for the given key. """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """ Removes all the entries of the cache. """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary. """
+        return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'entries': len(self._data)}
+
+
+class SqliteCache(object):
+    """ On-disk cache stored in a sqlite database, so that the entries
+    are shared by all the processes using the same file.
+
+    The entries are kept for at most `ttl` seconds and the whole cache
+    is emptied when it was filled for another version of the data.
+    """
+
+    def __init__(self, path, ttl=3600, version=''):
+        """ Constructor.
+
+        @param path, a string, the path to the sqlite database.
+        @param ttl, a float, the number of seconds an entry is kept.
+        @param version, a string, identifies the data the entries are
+        computed from. Entries stored for another version are removed.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                '(name TEXT PRIMARY KEY, value TEXT)')
+            row = connection.execute(
+                "SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != version:
+                connection.execute('DELETE FROM cache')
+                connection.execute('INSERT OR REPLACE INTO meta VALUES '
+                    "('version', ?)", (version,))
+
+    def _connection(self):
+        """ Returns the connection to the database of the current thread.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """ Returns the value stored for the given key or None if there
+        is none or if it expired.
+        """
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            if row is not None:
+                with connection:
+                    connection.execute('DELETE FROM cache WHERE key = ?',
+                        (key,))
+                self.evictions += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """ Stores the given value for the given key. """
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO cache VALUES '
+                '(?, ?, ?)', (key, json.dumps(value), time.time() + self.ttl))
+
+    def clear(self):
+        """ Removes all the entries of the cache. """
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM cache')
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary. """
+        entries = self._connection().execute(
+            'SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'entries': entries}
+
+
+class QueryCache(object):
+    """ Cache of the outputs of the sparql queries, made of an in-process
+    LRU cache in front of an optional on-disk cache shared between
+    processes.
+    """
+
+    def __init__(self, memory=None, disk=None):
+        """ Constructor.
+
+        @param memory, a LRUCache or None.
+        @param disk, a SqliteCache or None.
+        """
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key):
+        """ Returns the value stored for the given key or None. """
+        value = None
+        if self.memory is not None:
+            value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None and self.memory is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """ Stores the given value for the given key in all the backends.
+        """
+        for backend in (self.memory, self.disk):
+            if backend is not None:
+                backend.set(key, value)
+
+    def clear(self):
+        """ Removes all the entries of all the backends. """
+        for backend in (self.memory, self.disk):
+            if backend is not None:
+                backend.clear()
+
+    def stats(self):
+        """ Returns the counters of the backends as a dictionary. """
+        stats = {}
+        if self.memory is not None:
+            stats['memory'] = self.memory.stats()
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def _cache_key(query, server, output_format):
+    """ Returns the key under which the output of the given query is
+    cached. The query is normalized so that only its content matters,
+    not its indentation, and the key changes with the configured graphs.
+    """
+    query = '\n'.join([line.strip() for line in query.splitlines()
+        if line.strip()])
+    key = '\n'.join([GRAPHS_VERSION, server, output_format, query])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def _build_cache():
+    """ Returns the QueryCache set in the configuration. """
+    ttl = float(_config('cache_ttl', 3600))
+    size = int(_config('cache_size', 1000))
+    path = _config('cache_path')
+    memory = disk = None
+    if size > 0:
+        memory = LRUCache(size=size, ttl=ttl)
+    if path:
+        disk = SqliteCache(path, ttl=ttl, version=GRAPHS_VERSION)
+    return QueryCache(memory=memory, disk=disk)
+
+
+# Cache of the outputs of the sparql queries.
+CACHE = _build_cache()
+
+
+class SingleFlight(object):
+    """ Runs a function only once for all the threads asking for the
+    same key at the same time: the first one runs it while the others
+    wait for it to finish and share its result or its exception.
+    """
+
+    def __init__(self):
+        """ Constructor. """
+        # key: [event set once done, result, exception information]
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        """ Returns the result of function(*args, **kwargs), shared with
+        the other calls made for the same key while it runs.
+
+        @return, a tuple (result, shared) where shared is True if the
+        result was computed for another call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = [threading.Event(), None, None]
+        if shared:
+            call[0].wait()
+        else:
+            try:
+                call[1] = function(*args, **kwargs)
+            except Exception:
+                call[2] = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call[0].set()
+        if call[2] is not None:
+            raise call[2][0], call[2][1], call[2][2]
+        return call[1], shared
+
+
+# Queries being sent to the sparql endpoint, by cache key.
+QUERIES_IN_FLIGHT = SingleFlight()
+# Compounds whose information is being retrieved.
+COMPOUNDS_IN_FLIGHT = SingleFlight()
+# Directory of the lock files preventing several processes sharing the
+# on-disk cache from sending the same query at the same time.
+COALESCE_LOCK_DIR = _config('coalesce_lock_dir')
+# Number of lock files the queries are spread over.
+_LOCK_STRIPES = 256
+
+
+@contextlib.contextmanager
+def _file_lock(key):
+    """ Holds, across processes, the lock file of the given cache key.
+    The lock is polled so that a gevent process is not blocked.
+    """
+    path = os.path.join(COALESCE_LOCK_DIR, 'query-%02x.lock' % (
+        int(key[:8], 16) % _LOCK_STRIPES))
+    with open(path, 'a') as stream:
+        while True:
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError, err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+def _coalesced(key, use_cache, fetch, family):
+    """ Returns the output of the query cached under the given key,
+    calling `fetch` to run it once for all the threads asking for it at
+    the same time.
+
+    With a `coalesce_lock_dir` and an on-disk cache, the processes also
+    wait for each other and the query is only run if its output is not
+    in the cache once the lock is held.
+    """
+
+    def _run():
+        """ Runs the query unless another process just did. """
+        if not use_cache or not COALESCE_LOCK_DIR or CACHE.disk is None:
+            return fetch()
+        with _file_lock(key):
+            output = CACHE.get(key)
+            if output is not None:
+                return output
+            return fetch()
+
+    output, shared = QUERIES_IN_FLIGHT.do(key, _run)
+    if shared:
+        QUERY_COALESCED.inc(family)
+        stats = current_stats()
+        if stats is not None:
+            stats.add_coalesced(family)
+    return output
+
+
+# Upper bounds, in seconds, of the buckets of the histograms of durations
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+    10, 30)
+
+
+def _metric_labels(label, value):
+    """ Returns the labels of a metric in the Prometheus text format. """
+    return '%s="%s"' % (label, str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n'))
+
+
+class Counter(object):
+    """ Prometheus counter, one value per value of its label. """
+
+    def __init__(self, name, description, label):
+        """ Constructor.
+
+        @param name, a string, the name of the metric.
+        @param description, a string, the help text of the metric.
+        @param label, a string, the name of the label of the metric.
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, label, value=1):
+        """ Increments the counter of the given label. """
+        with self._lock:
+            self._values[label] += value
+
+    def render(self):
+        """ Returns the lines of the metric in the Prometheus text format.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s counter' % self.name]
+        with self._lock:
+            for label, value in sorted(self._values.items()):
+                lines.append('%s{%s} %r' % (self.name,
+                    _metric_labels(self.label, label), value))
+        return lines
+
+
+class Histogram(object):
+    """ Prometheus histogram, one per value of its label. """
+
+    def __init__(self, name, description, label, buckets=METRICS_BUCKETS):
+        """ Constructor.
+
+        @param name, a string, the name of the metric.
+        @param description, a string, the help text of the metric.
+        @param label, a string, the name of the label of the metric.
+        @param buckets, a sorted list of the upper bounds of the buckets.
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label: [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        """ Records a value for the given label. """
+        with self._lock:
+            if label not in self._values:
+                self._values[label] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = self._values[label]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            self._values[label][1] += value
+            self._values[label][2] += 1
+
+    def render(self):
+        """ Returns the lines of the metric in the Prometheus text format.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for label, (counts, total, count) in sorted(
+                    self._values.items()):
+                labels = _metric_labels(self.label, label)
+                cumulated = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulated += bucket
+                    lines.append('%s_bucket{%s,le="%r"} %d' % (
+                        self.name, labels, float(bound), cumulated))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    self.name, labels, count))
+                lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+                lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+# Metrics exposed on /metrics, the queries are labelled by family: the
+# kind of information they retrieve
+QUERY_SECONDS = Histogram('chebi2gene_query_seconds',
+    'Time spent waiting for the sparql endpoint per query.', 'family')
+QUERY_PARSE_SECONDS = Histogram('chebi2gene_query_parse_seconds',
+    'Time spent parsing the output of the sparql endpoint per query.',
+    'family')
+QUERY_BYTES = Counter('chebi2gene_query_bytes_total',
+    'Bytes received from the sparql endpoint.', 'family')
+QUERY_CACHE_HITS = Counter('chebi2gene_query_cache_hits_total',
+    'Queries answered from the cache.', 'family')
+QUERY_FAILURES = Counter('chebi2gene_query_failures_total',
+    'Queries which failed or returned an invalid output.', 'family')
+QUERY_COALESCED = Counter('chebi2gene_query_coalesced_total',
+    'Queries answered by the same query sent for another request.',
+    'family')
+ENDPOINT_QUERIES = Counter('chebi2gene_endpoint_queries_total',
+    'Queries sent to each replica of the sparql endpoint.', 'endpoint')
+ENDPOINT_FAILURES = Counter('chebi2gene_endpoint_failures_total',
+    'Queries failing with an error or a timeout per replica.', 'endpoint')
+QUERY_HEDGED = Counter('chebi2gene_query_hedged_total',
+    'Queries sent to a second replica for being slow.', 'server')
+RENDER_SECONDS = Histogram('chebi2gene_render_seconds',
+    'Time spent rendering the templates.', 'template')
+REQUEST_SECONDS = Histogram('chebi2gene_request_seconds',
+    'Time spent answering the requests.', 'endpoint')
+METRICS = [QUERY_SECONDS, QUERY_PARSE_SECONDS, QUERY_BYTES,
+    QUERY_CACHE_HITS, QUERY_FAILURES, QUERY_COALESCED, ENDPOINT_QUERIES,
+    ENDPOINT_FAILURES, QUERY_HEDGED, RENDER_SECONDS, REQUEST_SECONDS]
+
+
+class RequestStats(object):
+    """ Statistics of the queries sent and the templates rendered while
+    answering one request.
+    """
+
+    def __init__(self):
+        """ Constructor. """
+        self.start = time.time()
+        self.queries = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.bytes = 0
+        self.endpoint_time = 0.0
+        self.parse_time = 0.0
+        self.render_time = 0.0
+        # family: [number of queries, endpoint time]
+        self.families = collections.OrderedDict()
+        self.slowest = None
+        self._lock = threading.Lock()
+
+    def add_query(self, family, nbytes, endpoint_time, parse_time):
+        """ Records a query sent to the sparql endpoint. """
+        with self._lock:
+            self.queries += 1
+            self.bytes += nbytes
+            self.endpoint_time += endpoint_time
+            self.parse_time += parse_time
+            stats = self.families.setdefault(family, [0, 0.0])
+            stats[0] += 1
+            stats[1] += endpoint_time
+            if self.slowest is None or endpoint_time > self.slowest[1]:
+                self.slowest = (family, endpoint_time)
+
+    def add_cache_hit(self, family):
+        """ Records a query answered from the cache. """
+        with self._lock:
+            self.cache_hits += 1
+
+    def add_coalesced(self, family):
+        """ Records a query answered by the same query sent for another
+        request.
+        """
+        with self._lock:
+            self.coalesced += 1
+
+    def add_failure(self, family):
+        """ Records a query which failed, the answer to the request is
+        then incomplete.
+        """
+        with self._lock:
+            self.failures += 1
+
+    def add_render(self, render_time):
+        """ Records the rendering of a template. """
+        with self._lock:
+            self.render_time += render_time
+
+    def server_timing(self):
+        """ Returns the value of the Server-Timing header of the response.
+        The endpoint times of the queries sent concurrently are added up.
+        """
+        timings = ['sparql;dur=%.1f;desc="%d queries, %d bytes"' % (
+                self.endpoint_time * 1000, self.queries, self.bytes),
+            'parse;dur=%.1f' % (self.parse_time * 1000),
+            'render;dur=%.1f' % (self.render_time * 1000)]
+        for family, (count, endpoint_time) in self.families.items():
+            timings.append('sparql-%s;dur=%.1f;desc="%d queries"' % (
+                family, endpoint_time * 1000, count))
+        return ', '.join(timings)
+
+    def as_dict(self):
+        """ Returns the statistics as a dictionary. """
+        return {
+            'duration': round(time.time() - self.start, 6),
+            'queries': self.queries,
+            'cache_hits': self.cache_hits,
+            'coalesced': self.coalesced,
+            'failures': self.failures,
+            'bytes': self.bytes,
+            'endpoint_time': round(self.endpoint_time, 6),
+            'parse_time': round(self.parse_time, 6),
+            'render_time': round(self.render_time, 6),
+            'families': dict((family, {'queries': count,
+                    'endpoint_time': round(endpoint_time, 6)})
+                for family, (count, endpoint_time) in self.families.items()),
+            'slowest': {'family': self.slowest[0],
+                    'endpoint_time': round(self.slowest[1], 6)}
+                if self.slowest else None,
+        }
+
+
+# Statistics of the request being answered by the current thread
+_REQUEST_STATS = threading.local()
+
+
+def current_stats():
+    """ Returns the RequestStats of the request being answered by the
+    current thread, or None.
+    """
+    return getattr(_REQUEST_STATS, 'stats', None)
+
+
+def set_current_stats(stats):
+    """ Sets the RequestStats of the request being answered by the
+    current thread, None once it is answered.
+    """
+    _REQUEST_STATS.stats = stats
+
+
+def _with_stats(function):
+    """ Returns the given function wrapped so that the queries it sends,
+    when ran by the threads of a pool, are recorded in the statistics of
+    the request being answered by the current thread.
+    """
+    stats = current_stats()
+    if stats is None:
+        return function
+
+    def _wrapped(*args, **kwargs):
+        """ Runs the function with the statistics of the request. """
+        previous = current_stats()
+        _REQUEST_STATS.stats = stats
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _REQUEST_STATS.stats = previous
+    return _wrapped
+
+
+_SEMAPHORES = {}
+_SEMAPHORES_LOCK = threading.Lock()
+
+
+def _endpoint_semaphore(server):
+    """ Returns the semaphore limiting the number of queries sent at the
+    same time to the given sparql endpoint.
+    """
+    with _SEMAPHORES_LOCK:
+        if server not in _SEMAPHORES:
+            _SEMAPHORES[server] = threading.BoundedSemaphore(
+                max(1, MAX_REQUESTS))
+        return _SEMAPHORES[server]
+
+
+class EndpointBalancer(object):
+    """ Chooses the replica of a sparql endpoint each query is sent to.
+
+    The replica chosen is the healthy one with the lowest expected wait:
+    its average time to answer times the number of queries it is already
+    running plus one, so that both slow and busy replicas get less
+    queries. A replica failing several times in a row is left aside for
+    a while, then tried again.
+    """
+
+    def __init__(self, failures=3, cooldown=30.0, decay=0.2):
+        """ Constructor.
+
+        @param failures, an integer, the number of consecutive errors or
+        timeouts after which a replica is marked unhealthy.
+        @param cooldown, a float, the number of seconds an unhealthy
+        replica is left aside.
+        @param decay, a float, the weight of the last answer time in the
+        moving average of the answer times.
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        self.decay = decay
+        # url: [outstanding queries, average seconds, consecutive
+        # failures, time until which it is left aside]
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, url):
+        """ Returns the state of the given replica, the lock held. """
+        if url not in self._states:
+            self._states[url] = [0, None, 0, 0.0]
+        return self._states[url]
+
+    def healthy(self, url):
+        """ Returns whether the given replica may be sent queries. """
+        with self._lock:
+            return self._state(url)[3] <= time.time()
+
+    def choose(self, urls, exclude=()):
+        """ Returns the replica to send a query to, or None if all the
+        given replicas are excluded.
+
+        @param urls, a list of strings, the urls of the replicas.
+        @param exclude, the urls of the replicas not to choose.
+        """
+        now = time.time()
+        candidates = []
+        with self._lock:
+            for url in urls:
+                if url in exclude:
+                    continue
+                outstanding, seconds, _, down_until = self._state(url)
+                # Replicas never measured are tried first
+                candidates.append((down_until > now, down_until,
+                    (outstanding + 1) * (seconds or 0), outstanding,
+                    random.random(), url))
+        if not candidates:
+            return None
+        # Unhealthy replicas only when there is nothing else, the one
+        # coming back first
+        return min(candidates)[-1]
+
+    def started(self, url):
+        """ Records that a query is sent to the given replica. """
+        with self._lock:
+            self._state(url)[0] += 1
+        ENDPOINT_QUERIES.inc(url)
+
+    def answered(self, url, seconds):
+        """ Records that the given replica started to answer a query
+        after the given number of seconds.
+        """
+        with self._lock:
+            state = self._state(url)
+            if state[1] is None:
+                state[1] = seconds
+            else:
+                state[1] += self.decay * (seconds - state[1])
+            state[2] = 0
+            state[3] = 0.0
+
+    def failed(self, url):
+        """ Records that a query sent to the given replica failed. """
+        with self._lock:
+            state = self._state(url)
+            state[2] += 1
+            if state[2] >= self.failures:
+                state[3] = time.time() + self.cooldown
+        ENDPOINT_FAILURES.inc(url)
+
+    def finished(self, url):
+        """ Records that a query sent to the given replica is over. """
+        with self._lock:
+            self._state(url)[0] -= 1
+
+    def stats(self):
+        """ Returns the state of the replicas as a dictionary. """
+        now = time.time()
+        with self._lock:
+            return dict([(url, {'outstanding': state[0],
+                'seconds': state[1], 'healthy': state[3] <= now})
+                for url, state in self._states.items()])
+
+
+# Replicas serving the graphs of the `endpoints` section, the queries
+# only reading graphs served by the same replicas are sent to them.
+GRAPH_ENDPOINTS = {}
+if CONFIG.has_section('endpoints'):
+    GRAPH_ENDPOINTS = dict([(GRAPHS[option], tuple(
+        CONFIG.get('endpoints', option).replace(',', ' ').split()))
+        for option in CONFIG.options('endpoints') if option in GRAPHS])
+# Number of seconds after which a query still waiting for its replica is
+# sent to a second one as well, the first answer being used (0 disables
+# it).
+HEDGE_AFTER = float(_config('hedge_after', 0))
+# Chooses the replicas of the sparql endpoint.
+BALANCER = EndpointBalancer(
+    failures=int(_config('endpoint_failures', 3)),
+    cooldown=float(_config('endpoint_cooldown', 30)))
+
+
+def _replicas(server, query):
+    """ Returns the urls of the replicas the given query for the given
+    sparql endpoint may be sent to.
+    """
+    if server not in SERVERS:
+        return (server,)
+    graphs = set(re.findall(r'FROM\s+<([^>]+)>', query, re.IGNORECASE))
+    pools = set([GRAPH_ENDPOINTS.get(graph) for graph in graphs])
+    if len(pools) == 1 and None not in pools:
+        return pools.pop()
+    return SERVERS or (server,)
+
+
+# Errors of a replica after which the query is sent to another one.
+_ENDPOINT_ERRORS = (IOError, httplib.HTTPException)
+
+
+def _attempt(url, body, stream, results):
+    """ Sends a query to the given replica and puts in the given queue a
+    tuple (url, first piece of its output, iterator over the other
+    pieces, exc_info of the error or None). Only the errors of
+    _ENDPOINT_ERRORS count against the replica.
+
+    The semaphore of the replica is held and the query counted as
+    outstanding until the output is closed by _close_output.
+    """
+    semaphore = _endpoint_semaphore(url)
+    semaphore.acquire()
+    BALANCER.started(url)
+    start = time.time()
+    try:
+        if stream and hasattr(TRANSPORT, 'stream'):
+            chunks = TRANSPORT.stream(url, body)
+        else:
+            chunks = iter([TRANSPORT.post(url, body)])
+        first = next(chunks, '')
+    except Exception:
+        error = sys.exc_info()
+        if isinstance(error[1], _ENDPOINT_ERRORS):
+            BALANCER.failed(url)
+        BALANCER.finished(url)
+        semaphore.release()
+        results.put((url, None, None, error))
+        return
+    BALANCER.answered(url, time.time() - start)
+    results.put((url, first, chunks, None))
+
+
+def _close_output(url, chunks):
+    """ Closes the output of a query sent by _attempt and releases its
+    replica.
+    """
+    try:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    finally:
+        BALANCER.finished(url)
+        _endpoint_semaphore(url).release()
+
+
+def _discard_outputs_later(results, count):
+    """ Waits, in a thread, for the given number of attempts which lost a
+    race and closes their output.
+    """
+    def _discard():
+        """ Closes the outputs as they come. """
+        for _ in xrange(count):
+            url, _, chunks, error = results.get()
+            if error is None:
+                _close_output(url, chunks)
+
+    thread = threading.Thread(target=_discard)
+    thread.daemon = True
+    thread.start()
+
+
+@contextlib.contextmanager
+def _replica_output(server, query, body, stream=False):
+    """ Sends a query to a replica of the given sparql endpoint and gives
+    the pieces of its output.
+
+    A query failing on a replica is sent to the next one, and a query
+    not answered within `hedge_after` seconds is sent to a second
+    replica as well, the first to answer being used.
+
+    @param server, a string, the url of the sparql endpoint.
+    @param query, a string, the sparql query, used to find the replicas
+    serving its graphs.
+    @param body, a string, the url-encoded parameters of the query.
+    @param stream, a boolean, whether the output is read as it is
+    received, when the transport supports it.
+    @return, a context manager giving an iterator over the pieces of
+    the output.
+    """
+    urls = _replicas(server, query)
+    results = Queue.Queue()
+    tried = set()
+    pending = 0
+    error = None
+    while True:
+        url = BALANCER.choose(urls, exclude=tried)
+        if error is not None and (not pending and url is None
+                or not isinstance(error[1], _ENDPOINT_ERRORS)):
+            if pending:
+                _discard_outputs_later(results, pending)
+            raise error[0], error[1], error[2]
+        if url is not None:
+            tried.add(url)
+            pending += 1
+            if HEDGE_AFTER <= 0 or len(urls) < 2:
+                _attempt(url, body, stream, results)
+            else:
+                thread = threading.Thread(target=_attempt,
+                    args=(url, body, stream, results))
+                thread.daemon = True
+                thread.start()
+        timeout = None
+        if url is not None and len(tried) == 1 < len(urls) and \
+                HEDGE_AFTER > 0:
+            timeout = HEDGE_AFTER
+        try:
+            url, first, chunks, failure = results.get(True, timeout)
+        except Queue.Empty:
+            if url is not None:
+                QUERY_HEDGED.inc(server)
+            continue
+        pending -= 1
+        if failure is None:
+            break
+        error = failure
+    if pending:
+        _discard_outputs_later(results, pending)
+    try:
+        yield itertools.chain([first], chunks)
+    except _ENDPOINT_ERRORS:
+        BALANCER.failed(url)
+        raise
+    finally:
+        _close_output(url, chunks)
+
+
+def _query_params(query, output_format):
+    """ Returns the parameters of the request running the given query. """
+    return {
+        'default-graph': '',
+        'should-sponge': 'soft',
+        'query': query,
+        'debug': 'off',
+        'timeout': '',
+        'format': output_format,
+        'save': 'display',
+        'fname': ''
+    }
+
+
+def _record_failure(family):
+    """ Records a failed query in the metrics and in the statistics of the
+    current request.
+    """
+    QUERY_FAILURES.inc(family)
+    stats = current_stats()
+    if stats is not None:
+        stats.add_failure(family)
+
+
+def _coalesced_or_failed(key, use_cache, fetch, family):
+    """ Returns the output of _coalesced, recording the failure of the
+    query if it raises.
+    """
+    try:
+        return _coalesced(key, use_cache, fetch, family)
+    except Exception:
+        _record_failure(family)
+        raise
+
+
+def sparql_query(query, server, output_format='application/json',
+        use_cache=True, family='other'):
     """ Runs the given SPARQL query against the desired sparql endpoint
     and return the output in the format asked (default being rdf/xml).
+    The outputs are kept in `CACHE`, so running the same query again
+    does not reach the sparql endpoint.
+
+    @param query, the string of the sparql query that should be ran.
+    @param server, a string, the url of the sparql endpoint that we want
+    to run query against.
+    @param format, specifies in which format we want to have the output.
+    Defaults to `application/json` but can also be `application/rdf+xml`.
+    @param use_cache, a boolean, whether the output may be read from and
+    stored in the cache.
+    @param family, a string, the kind of information retrieved by the
+    query, used to label its statistics.
+    @return, a JSON object, representing the output of the provided
+    sparql query.
+    """
+    stats = current_stats()
+    key = _cache_key(query, server, output_format)
+    if use_cache:
+        output = CACHE.get(key)
+        if output is not None:
+            QUERY_CACHE_HITS.inc(family)
+            if stats is not None:
+                stats.add_cache_hit(family)
+            return output
+    querypart = urllib.urlencode(_query_params(query, output_format))
+
+    def _fetch():
+        """ Sends the query to the sparql endpoint. """
+        start = time.time()
+        with _replica_output(server, query, querypart) as chunks:
+            response = ''.join(chunks)
+        endpoint_time = time.time() - start
+        start = time.time()
+        try:
+            output = json.loads(response)
+        except ValueError:
+            output = {}
+        parse_time = time.time() - start
+        QUERY_SECONDS.observe(family, endpoint_time)
+        QUERY_PARSE_SECONDS.observe(family, parse_time)
+        QUERY_BYTES.inc(family, len(response))
+        if stats is not None:
+            stats.add_query(family, len(response), endpoint_time,
+                parse_time)
+        if output and use_cache:
+            CACHE.set(key, output)
+        return output
+
+    output = _coalesced_or_failed(key, use_cache, _fetch, family)
+    if not output:
+        _record_failure(family)
+    return output
+
+
+def sparql_query_all(queries, server, family='other'):
+    """ Runs all the given SPARQL queries against the desired sparql
+    endpoint, concurrently, and returns their outputs.
+
+    At most `max_requests` queries are sent at the same time to the
+    sparql endpoint, including those sent by other threads.
+
+    @param queries, a list of strings, the sparql queries to run.
+    @param server, a string, the url of the sparql endpoint that we want
+    to run query against.
+    @param family, a string, the kind of information retrieved by the
+    queries, or a list with the family of each query.
+    @return, a list of JSON objects, the outputs of the queries in the
+    same order as the queries.
+    """
+    if isinstance(family, basestring):
+        families = [family] * len(queries)
+    else:
+        families = family
+    if len(queries) < 2 or MAX_REQUESTS < 2:
+        return [sparql_query(query, server, family=family)
+            for query, family in zip(queries, families)]
+    pool = ThreadPool(min(len(queries), MAX_REQUESTS))
+    try:
+        return pool.map(_with_stats(lambda args: sparql_query(
+            args[0], server, family=args[1])), zip(queries, families))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _iter_lines(chunks):
+    """ Returns the lines, with their line endings, of the text made of
+    the given pieces.
+    """
+    pending = ''
+    for data in chunks:
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def _rows_from_output(chunks, variables):
+    """ Returns the values of the given variables in the results of a
+    query, read from the pieces of its output.
+
+    The output is read line by line as SPARQL CSV results, or as a whole
+    as SPARQL JSON results for the endpoints ignoring the format asked.
+
+    @return, a list of tuples of unicode strings, None for the unbound
+    variables, or None if the output is not a valid results document.
+    """
+    chunks = iter(chunks)
+    for first in chunks:
+        if first.strip():
+            break
+    else:
+        return None
+    if first.lstrip().startswith('{'):
+        try:
+            bindings = json.loads(first + ''.join(chunks))['results'][
+                'bindings']
+        except (ValueError, KeyError, TypeError):
+            return None
+        return [tuple([entry[var]['value'] if var in entry else None
+            for var in variables]) for entry in bindings]
+    reader = csv.reader(_iter_lines(itertools.chain([first], chunks)))
+    header = next(reader, [])
+    if any(var not in header for var in variables):
+        return None
+    columns = [header.index(var) for var in variables]
+    rows = []
+    for row in reader:
+        if row:
+            rows.append(tuple([row[idx].decode('utf-8') or None
+                for idx in columns]))
+    return rows
+
+
+class QueryError(Exception):
+    """ Raised when a query whose results are needed fails. """
+
+
+def _checked_rows(rows):
+    """ Returns the given rows of sparql_select, raising a QueryError if
+    the query failed, so that a failure is not taken for an empty result.
+    """
+    if rows is None:
+        raise QueryError('The sparql endpoint did not return valid results')
+    return rows
+
+
+def sparql_select(query, server, variables, family='other',
+        use_cache=True):
+    """ Runs the given SELECT query against the desired sparql endpoint and
+    returns the values of the given variables only.
+
+    The results are asked as CSV and parsed while they are received, so
+    that neither the whole output nor the bindings of all the variables
+    are ever held in memory. The rows are kept in `CACHE`.
 
     @param query, the string of the sparql query that should be ran.
     @param server, a string, the url of the sparql endpoint that we want
     to run query against.
-    @param format, specifies in which format we want to have the output.
-    Defaults to `application/json` but can also be `application/rdf+xml`.
-    @return, a JSON object, representing the output of the provided
-    sparql query.
+    @param variables, a tuple of the names of the variables to return.
+    @param family, a string, the kind of information retrieved by the
+    query, used to label its statistics.
+    @param use_cache, a boolean, whether the rows may be read from and
+    stored in the cache.
+    @return, a list of tuples with the values of the variables in the
+    order given, None for the unbound ones, or None if the query failed.
     """
-    params = {
-        'default-graph': '',
-        'should-sponge': 'soft',
-        'query': query,
-        'debug': 'off',
-        'timeout': '',
-        'format': output_format,
-        'save': 'display',
-        'fname': ''
-    }
-    querypart = urllib.urlencode(params)
-    response = urllib.urlopen(server, querypart).read()
+    stats = current_stats()
+    key = _cache_key(query, server, 'text/csv;%s' % ','.join(variables))
+    if use_cache:
+        rows = CACHE.get(key)
+        if rows is not None:
+            QUERY_CACHE_HITS.inc(family)
+            if stats is not None:
+                stats.add_cache_hit(family)
+            # The disk cache gives back lists
+            return [tuple(row) for row in rows]
+    querypart = urllib.urlencode(_query_params(query, 'text/csv'))
+    # [bytes received, seconds spent waiting for the endpoint]
+    received = [0, 0.0]
+
+    def _timed(chunks):
+        """ Returns the given pieces of the output, recording how long
+        they were waited for.
+        """
+        chunks = iter(chunks)
+        while True:
+            start = time.time()
+            try:
+                data = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                received[1] += time.time() - start
+            received[0] += len(data)
+            yield data
+
+    def _fetch():
+        """ Sends the query to the sparql endpoint. """
+        start = time.time()
+        with _replica_output(server, query, querypart,
+                stream=True) as chunks:
+            # Time until the endpoint starts to answer
+            received[1] += time.time() - start
+            rows = _rows_from_output(_timed(chunks), variables)
+        parse_time = time.time() - start - received[1]
+        QUERY_SECONDS.observe(family, received[1])
+        QUERY_PARSE_SECONDS.observe(family, parse_time)
+        QUERY_BYTES.inc(family, received[0])
+        if stats is not None:
+            stats.add_query(family, received[0], received[1], parse_time)
+        if rows is not None and use_cache:
+            CACHE.set(key, rows)
+        return rows
+
+    rows = _coalesced_or_failed(key, use_cache, _fetch, family)
+    if rows is None:
+        _record_failure(family)
+    elif rows and not isinstance(rows[0], tuple):
+        # Rows read back from the disk cache by another process
+        rows = [tuple(row) for row in rows]
+    return rows
+
+
+def sparql_select_all(queries, server, variables, family='other',
+        use_cache=True):
+    """ Runs all the given SELECT queries against the desired sparql
+    endpoint, concurrently as sparql_query_all, and returns their rows.
+
+    @param queries, a list of strings, the sparql queries to run.
+    @param server, a string, the url of the sparql endpoint that we want
+    to run query against.
+    @param variables, a tuple of the names of the variables to return,
+    or a list with the variables of each query.
+    @param family, a string, the kind of information retrieved by the
+    queries, or a list with the family of each query.
+    @param use_cache, a boolean, whether the rows may be read from and
+    stored in the cache.
+    @return, a list of the rows of each query as returned by
+    sparql_select, in the same order as the queries.
+    """
+    if variables and isinstance(variables[0], basestring):
+        variables = [variables] * len(queries)
+    if isinstance(family, basestring):
+        family = [family] * len(queries)
+    calls = zip(queries, variables, family)
+    if len(queries) < 2 or MAX_REQUESTS < 2:
+        return [sparql_select(query, server, query_variables,
+            family=query_family, use_cache=use_cache)
+            for query, query_variables, query_family in calls]
+    pool = ThreadPool(min(len(queries), MAX_REQUESTS))
     try:
-        output = json.loads(response)
-    except ValueError:
-        output = {}
-    return output
+        return pool.map(_with_stats(lambda args: sparql_select(
+            args[0], server, args[1], family=args[2],
+            use_cache=use_cache)), calls)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def run_query_via_rdflib(query, server):
@@ -374,123 +2676,1162 @@ def run_query_via_rdflib(query, server):
     to run query against.
     @return, a string, representing the rdf output of the provided query.
     """
+    import rdflib
     graph = rdflib.Graph()
     graph.parse(data=sparql_query(query, server),
         output_format="application/rdf+xml")
     return graph.serialize(format='xml')
 
 
-##  Web-app
+class RdflibTransport(object):
+    """ Answers the queries from a rdflib graph instead of a sparql
+    endpoint, for example a graph loaded from RDF dumps.
+
+    The FROM clauses of the queries are ignored, the graph is expected
+    to contain the data of all the graphs used.
+    """
+
+    def __init__(self, graph):
+        """ Constructor.
+
+        @param graph, a rdflib.Graph containing the data to query.
+        """
+        self.graph = graph
+        # rdflib is not thread-safe, the queries are run one at a time
+        self._lock = threading.Lock()
 
+    def post(self, url, body):
+        """ Runs the query contained in the given body against the graph
+        and returns its output.
 
-@APP.route('/', methods=['GET', 'POST'])
-def index():
-    """ Shows the front page.
-    All the content of this page is in the index.html file under the
-    templates directory. The file is full html and has no templating
-    logic within.
+        @param url, a string, ignored.
+        @param body, a string, the url-encoded parameters of the query.
+        @return, a string, the output of the query as JSON or, if the
+        format asked is `text/csv`, as csv.
+        """
+        params = urlparse.parse_qs(body)
+        query = re.sub(r'(?i)\bFROM\s+<[^>]*>', '', params['query'][0])
+        output_format = params.get('format', ['application/json'])[0]
+        with self._lock:
+            result = self.graph.query(query)
+            if output_format == 'text/csv':
+                return result.serialize(format='csv')
+            return result.serialize(format='json')
+
+
+def _iter_all_rows(query, variables, page_size=None):
+    """ Runs the given query page by page and returns all its rows.
+    The query should end with an ORDER BY clause so that the pages are
+    stable. The pages are not kept in the cache.
+
+    @param query, the string of the sparql query that should be ran.
+    @param variables, a tuple of the names of the variables returned.
+    @param page_size, an integer, the number of results asked at once.
+    Defaults to the `index_page_size` set in the configuration.
+    @return, a generator of the rows of the query, as sparql_select.
+    @raise QueryError, if a page fails, rather than ending early.
     """
-    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
-        request.remote_addr, request.url)
-    form = ChebiIDForm(csrf_enabled=False)
-    if form.validate_on_submit():
-        try:
-            int(form.chebi_id.data)
-            return redirect(url_for('show_chebi',
-                chebi_id=form.chebi_id.data))
-        except ValueError:
-            return redirect(url_for('search_chebi',
-                name=form.chebi_id.data))
-    return render_template('index.html', form=form)
-
-
-@APP.route('/search/<name>')
-def search_chebi(name):
-    """ Search the CHEBI database for the name given.
-    """
-    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
-        request.remote_addr, request.url)
-    molecules = get_exact_chebi_from_search(name)
-    if molecules and len(molecules) == 1:
-        return redirect(url_for('show_chebi',
-                chebi_id=molecules.keys()[0]))
-    return render_template('search.html', data=molecules, search=name,
-        extended=False)
-
-
-@APP.route('/fullsearch/<name>')
-def search_chebi_extended(name):
-    """ Search the CHEBI database for the name given including the
-    synonyms.
-    """
-    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
-        request.remote_addr, request.url)
-    molecules = get_extended_chebi_from_search(name)
-    return render_template('search.html', data=molecules, search=name,
-        extended=True)
-
-
-@APP.route('/chebi/<chebi_id>')
-def show_chebi(chebi_id):
-    """ Shows the front page.
-    All the content of this page is in the index.html file under the
-    templates directory. The file is full html and has no templating
-    logic within.
-    """
-    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
-        request.remote_addr, request.url)
-    proteins = get_protein_of_chebi(chebi_id)
-    if not proteins:
-        return render_template('output.html', proteins=[],
-        pathways=None, genes=None, organisms=None, chebi=chebi_id)
-    proteins = convert_to_uniprot_id(proteins)
-    pathways = get_pathways_of_proteins(proteins)
-    genes = get_genes_of_proteins(proteins)
-    organisms = get_organism_of_proteins(proteins)
-    return render_template('output.html', proteins=proteins,
-        pathways=pathways, genes=genes, organisms=organisms,
-        chebi=chebi_id)
-
-
-@APP.route('/csv/<chebi_id>')
-def generate_csv(chebi_id):
-    """ Generate a comma separated value file containing all the
-    information.
-    """
-    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
-        request.remote_addr, request.url)
-    # Regenerate the informations
-    proteins = get_protein_of_chebi(chebi_id)
-    proteins = convert_to_uniprot_id(proteins)
-    pathways = get_pathways_of_proteins(proteins)
-    genes = get_genes_of_proteins(proteins)
-    organisms = get_organism_of_proteins(proteins)
+    page_size = page_size or int(_config('index_page_size', 10000))
+    offset = 0
+    while True:
+        rows = sparql_select('%s LIMIT %s OFFSET %s' % (
+            query, page_size, offset), SERVER, variables, use_cache=False,
+            family='index')
+        _checked_rows(rows)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            break
+        offset += page_size
+
+
+class LocalIndex(object):
+    """ Precomputed copy of the information of all the compounds, used to
+    answer the requests without querying the sparql endpoint.
+
+    It contains the reactions of each compound, the pathways, genes and
+    organisms of each protein and the names and synonyms of the
+    compounds, in the structures returned by the corresponding get_*
+    functions with tuples in place of the lists.
+    """
+
+    def __init__(self, data):
+        """ Constructor.
+
+        @param data, a dictionary as built by build_index.
+        """
+        self.version = data['version']
+        self.built = data['built']
+        self.reactions = data['reactions']
+        self.proteins = {
+            'pathways': data['pathways'],
+            'genes': data['genes'],
+            'organisms': data['organisms'],
+        }
+        self.names = data['names']
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the LocalIndex stored in the given file. """
+        with open(path, 'rb') as stream, _interning():
+            return cls(cPickle.load(stream))
+
+    def protein_of_chebi(self, chebi_id):
+        """ Returns the reactions of a compound as get_protein_of_chebi.
+        """
+        reactions = self.reactions.get(chebi_id)
+        if not reactions:
+            return
+        return dict([(key, list(value)) for key, value in reactions.items()])
+
+    def of_proteins(self, kind, data):
+        """ Returns the `pathways`, `genes` or `organisms` of the proteins
+        of the given reactions, as get_*_of_proteins.
+        """
+        values = self.proteins[kind]
+        output = {}
+        for protein in unique_proteins(data):
+            if protein in values:
+                output[protein] = list(values[protein])
+        return output
+
+    def information(self, data):
+        """ Returns the pathways, genes and organisms of the proteins of
+        the given reactions, as get_information_of_proteins.
+        """
+        return (self.of_proteins('pathways', data),
+            self.of_proteins('genes', data),
+            self.of_proteins('organisms', data))
+
+
+def get_all_reactions():
+    """ Returns the reactions with a protein of all the compounds.
+
+    @return, a dictionary as returned by get_protein_of_chebis for all
+    the compounds having such reactions.
+    """
+    index = get_index()
+    if index is not None:
+        return dict([(chebi_id, index.protein_of_chebi(chebi_id))
+            for chebi_id in index.reactions])
+    return _query_all_reactions()
+
+
+def _query_all_reactions():
+    """ Returns the reactions with a protein of all the compounds, as
+    get_all_reactions, walking the rhea graph even if a local index is
+    loaded.
+    """
+    reactions = {}
+    query = '''
+    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
+    SELECT DISTINCT ?chebi ?react ?xref
+    FROM <%(rhea)s>
+    WHERE {
+      ?cmp bp:XREF ?chebi .
+      FILTER (
+        regex(str(?chebi), '#CHEBI:')
+      )
+      ?dir ?p ?cmp .
+      ?react ?p2 ?dir .
+      ?react bp:XREF ?xref .
+      FILTER (
+        regex(str(?xref), 'UNIPROT')
+      )
+    } ORDER BY ?chebi ?react ?xref
+    ''' % {'rhea': GRAPHS['rhea']}
+    for chebi, react, xref in _iter_all_rows(query,
+            ('chebi', 'react', 'xref')):
+        chebi_id = chebi.rsplit(':', 1)[1]
+        key = react.split('#')[1]
+        reactions.setdefault(chebi_id, {}).setdefault(key, []).append(xref)
+    return reactions
+
+
+def _compounds_of_proteins(reactions):
+    """ Returns the compounds of each protein of the given reactions.
+
+    @param reactions, a dictionary as returned by get_all_reactions.
+    @return, a dictionary where the keys are the uniprot identifiers and
+    the values sorted lists of chebi identifiers.
+    """
+    compounds = {}
+    for chebi_id, compound in reactions.items():
+        for xrefs in compound.values():
+            for xref in xrefs:
+                compounds.setdefault(xref.rsplit(':', 1)[1].strip(),
+                    set()).add(chebi_id)
+    return dict([(protein, sorted(chebi_ids, key=int))
+        for protein, chebi_ids in compounds.items()])
+
+
+def _frozen(values):
+    """ Returns a copy of the given dictionary of lists with tuples in
+    place of the lists, which take less memory.
+    """
+    return dict([(key, tuple(value)) for key, value in values.items()])
+
+
+def build_index(path, dumps=None):
+    """ Walks the configured graphs and stores the information of all the
+    compounds in a file that can be loaded as a LocalIndex.
+
+    @param path, a string, the path of the file to write.
+    @param dumps, a list of paths to RDF files, if given they are loaded
+    in memory with rdflib and queried instead of the sparql endpoint.
+    @return, the LocalIndex built.
+    """
+    global TRANSPORT
+    original = TRANSPORT
+    if dumps:
+        import rdflib
+        import rdflib.util
+        graph = rdflib.Graph()
+        for dump in dumps:
+            print >> sys.stderr, 'Loading %s' % dump
+            graph.parse(dump, format=rdflib.util.guess_format(dump))
+        TRANSPORT = RdflibTransport(graph)
+    try:
+        with _interning():
+            # The graphs are walked even when a previous index is loaded
+            reactions = _query_all_reactions()
+            print >> sys.stderr, '%s compounds with reactions' % len(
+                reactions)
+
+            proteins = _compounds_of_proteins(reactions)
+            # The cache is keyed on the endpoint and must not keep the rows
+            # of the dumps
+            pathways, genes, organisms = _query_information_of_proteins(
+                _chunks(sorted(proteins), CHUNK_SIZE), use_cache=False)
+            print >> sys.stderr, '%s proteins' % len(proteins)
+
+            names = get_chebi_names()
+            print >> sys.stderr, '%s compound names' % len(names)
+    finally:
+        TRANSPORT = original
+
+    data = {
+        'version': GRAPHS_VERSION,
+        'built': time.time(),
+        'reactions': dict([(chebi_id, _frozen(value))
+            for chebi_id, value in reactions.items()]),
+        'pathways': _frozen(pathways),
+        'genes': _frozen(genes),
+        'organisms': _frozen(organisms),
+        'names': names,
+    }
+    # Write to a temporary file first so that the running applications
+    # never load a partially written index
+    with open(path + '.tmp', 'wb') as stream:
+        cPickle.dump(data, stream, cPickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+    return LocalIndex(data)
+
+
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index():
+    """ Returns the LocalIndex set in the configuration, loading it on
+    first use.
+
+    @return, a LocalIndex or None if there is no index to load.
+    """
+    if INDEX is _INDEX_NOT_LOADED:
+        with _INDEX_LOCK:
+            if INDEX is _INDEX_NOT_LOADED:
+                load_index()
+    return INDEX
+
 
-    string = 'Chebi ID, Chebi URL, Rhea ID, Rhea URL, UniProt, \
-Organism, Type, Name, Scaffold, Start, Stop, Description\n'
+def load_index():
+    """ Loads, or reloads, the LocalIndex set in the configuration as
+    `INDEX`. `INDEX` is None if there is no index to load.
+    """
+    global INDEX, SEARCH_INDEX, GENE_INDEX, REVERSE_INDEX
+    SEARCH_INDEX = None
+    GENE_INDEX = None
+    REVERSE_INDEX = None
+    AUTOCOMPLETE_CACHE.clear()
+    PAGE_CACHE.clear()
+    path = _config('index_path')
+    if not path or not os.path.exists(path):
+        INDEX = None
+        return
+    INDEX = LocalIndex.load(path)
+    if INDEX.version != GRAPHS_VERSION:
+        print >> sys.stderr, 'The index %s was built for other graphs ' \
+            'than the ones configured' % path
+
+
+# Value of INDEX until the configured index is loaded by get_index.
+_INDEX_NOT_LOADED = object()
+# Precomputed information of all the compounds, used instead of the
+# sparql endpoint when it is set.
+INDEX = _INDEX_NOT_LOADED
+# Index of the names and synonyms of the compounds, see get_search_index.
+SEARCH_INDEX = None
+# Index of the positions of the genes, see get_gene_index.
+GENE_INDEX = None
+# Index of the compounds of the genes, see get_reverse_index.
+REVERSE_INDEX = None
+# Answers of the autocompletion for the most frequent prefixes.
+AUTOCOMPLETE_CACHE = LRUCache(size=int(_config('autocomplete_cache_size',
+    10000)), ttl=float(_config('cache_ttl', 3600)))
+# Rendered pages and csv exports of the most requested compounds.
+PAGE_CACHE = LRUCache(size=int(_config('page_cache_size', 200)),
+    ttl=float(_config('cache_ttl', 3600)))
+# Largest page, in bytes, kept in PAGE_CACHE.
+PAGE_CACHE_MAX_BODY = int(_config('page_cache_max_body', 1024 * 1024))
+
+
+def data_version():
+    """ Returns the version of the data the pages are built from, which
+    changes with the configured graphs and the local index.
+    """
+    index = get_index()
+    if index is not None:
+        return '%s-%s' % (GRAPHS_VERSION, index.built)
+    return GRAPHS_VERSION
+
+
+# Columns of the csv export.
+CSV_HEADER = ['Chebi ID', 'Chebi URL', 'Rhea ID', 'Rhea URL', 'UniProt',
+    'Organism', 'Type', 'Name', 'Scaffold', 'Start', 'Stop', 'Description']
+
+
+class _CsvLine(object):
+    """ File-like object returning what is written to it, so that a
+    csv.writer returns the formatted lines instead of storing them.
+    """
+
+    def write(self, value):
+        """ Returns the given value. """
+        return value
+
+
+def csv_line(row):
+    """ Returns the given row formatted as a line of csv. """
+    return csv.writer(_CsvLine()).writerow([
+        value.encode('utf-8') if isinstance(value, unicode) else value
+        for value in row])
+
+
+def iter_csv_rows(chebi_id, proteins, information, regions=None):
+    """ Returns the rows of the csv export of a compound.
+
+    @param chebi_id, a string, identifier of a compound on chebi.
+    @param proteins, a dictionary where the keys are reactions identifier
+    and the values lists of proteins identifier of the compound.
+    @param information, a ProteinInformation giving access to the
+    information of the proteins of the compound.
+    @param regions, an IntervalIndex of named regions, as returned by
+    parse_bed, the rows of the genes then end with the names of the
+    regions they overlap.
+    @return, a generator of lists, the rows of the export.
+    """
     chebi_url = 'http://www.ebi.ac.uk/chebi/searchId.do?chebiId=%s' % \
         chebi_id
     for reaction in proteins:
         react_url = 'http://www.ebi.ac.uk/rhea/reaction.xhtml?id=RHEA:%s' % \
             reaction
         for protein in proteins[reaction]:
-            if protein in pathways:
-                for pathway in pathways[protein]:
-                    string = string + '%s,%s,%s,%s,%s,%s,Pathway,%s\n' % (
-                        chebi_id, chebi_url, reaction, react_url, protein,
-                        " - ".join(organisms[protein]),
-                        pathway)
-            if protein in genes:
-                for gene in genes[protein]:
-                    string = string + \
-                    '%s,%s,%s,%s,%s,%s,Gene,%s,%s,%s,%s,%s\n' % (
-                        chebi_id, chebi_url, reaction, react_url, protein,
-                        " - ".join(organisms[protein]),
-                        gene['name'], gene['sca'],
-                        gene['start'], gene['stop'], gene['desc'])
-    return Response(string, mimetype='application/excel')
+            information.fetch(protein)
+            organism = ' - '.join(information.organisms.get(protein, []))
+            for pathway in information.pathways.get(protein, []):
+                yield [chebi_id, chebi_url, reaction, react_url, protein,
+                    organism, 'Pathway', pathway]
+            for gene in information.genes.get(protein, []):
+                row = [chebi_id, chebi_url, reaction, react_url, protein,
+                    organism, 'Gene', gene['name'], gene['sca'],
+                    gene['start'], gene['stop'], gene['desc']]
+                if regions is not None:
+                    row.append(' '.join(gene_regions(regions, gene)))
+                yield row
+
+
+def _json_line(chebi_id, proteins, information, regions=None):
+    """ Returns the information of a compound as a line of JSON.
+
+    @param chebi_id, a string, identifier of a compound on chebi.
+    @param proteins, a dictionary where the keys are reactions identifier
+    and the values lists of proteins identifier of the compound.
+    @param information, a ProteinInformation giving access to the
+    information of the proteins of the compound.
+    @param regions, an IntervalIndex of named regions, as returned by
+    parse_bed, each gene then has the `regions` it overlaps.
+    @return, a string, a JSON object followed by a new line.
+    """
+    output = {'chebi': chebi_id, 'reactions': proteins, 'pathways': {},
+        'genes': {}, 'organisms': {}}
+    for protein in unique_proteins(proteins):
+        information.fetch(protein)
+        for key in ['pathways', 'genes', 'organisms']:
+            values = getattr(information, key).get(protein)
+            if values:
+                output[key][protein] = values
+    if regions is not None:
+        for protein, genes in output['genes'].items():
+            output['genes'][protein] = [dict(gene.as_dict()
+                if isinstance(gene, Gene) else gene,
+                regions=gene_regions(regions, gene)) for gene in genes]
+    return json.dumps(output, default=Gene.as_dict) + '\n'
+
+
+def parse_chebi_ids(text):
+    """ Returns the chebi identifiers contained in the given text.
+
+    @param text, a string containing chebi identifiers, with or without
+    their `CHEBI:` prefix, separated by spaces, commas or new lines.
+    @return, a list of the unique identifiers found, in the order in
+    which they appear. Anything else than an identifier is ignored.
+    """
+    chebi_ids = []
+    seen = set()
+    for chebi_id in re.split(r'[\s,;]+', text):
+        if chebi_id.upper().startswith('CHEBI:'):
+            chebi_id = chebi_id[6:]
+        if chebi_id.isdigit() and chebi_id not in seen:
+            seen.add(chebi_id)
+            chebi_ids.append(chebi_id)
+    return chebi_ids
+
+
+def iter_bulk_output(chebi_ids, output_format='csv', regions=None):
+    """ Returns the information of several compounds as a single csv file
+    or JSON lines document.
+
+    The reactions of all the compounds are retrieved with batched queries
+    and the proteins shared by several compounds are only retrieved once.
+
+    @param chebi_ids, a list of strings, identifiers of compounds on
+    chebi.
+    @param output_format, a string, either `csv` or `jsonl`.
+    @param regions, an IntervalIndex of named regions, as returned by
+    parse_bed, with which the genes are annotated.
+    @return, a generator of strings, the lines of the output.
+    """
+    if output_format == 'csv':
+        if regions is not None:
+            yield csv_line(CSV_HEADER + ['Regions'])
+        else:
+            yield csv_line(CSV_HEADER)
+    reactions = get_protein_of_chebis(chebi_ids)
+    compounds = collections.OrderedDict()
+    for chebi_id in chebi_ids:
+        if chebi_id in reactions:
+            compounds[chebi_id] = convert_to_uniprot_id(reactions[chebi_id])
+    # Proteins are retrieved in the order in which the compounds need them
+    merged = collections.OrderedDict()
+    for chebi_id, proteins in compounds.items():
+        for reaction in proteins:
+            merged[(chebi_id, reaction)] = proteins[reaction]
+    information = ProteinInformation(merged)
+    try:
+        for chebi_id, proteins in compounds.items():
+            if output_format == 'csv':
+                for row in iter_csv_rows(chebi_id, proteins, information,
+                        regions):
+                    yield csv_line(row)
+            else:
+                yield _json_line(chebi_id, proteins, information, regions)
+    finally:
+        information.close()
+
+
+def get_chebis_with_reactions():
+    """ Returns the identifiers of all the compounds having a reaction
+    with a protein in Rhea.
+
+    @return, a list of strings, the chebi identifiers sorted numerically.
+    """
+    index = get_index()
+    if index is not None:
+        return sorted(index.reactions, key=int)
+    query = '''
+    prefix bp: <http://www.biopax.org/release/biopax-level2.owl#>
+    SELECT DISTINCT ?chebi
+    FROM <%(rhea)s>
+    WHERE {
+      ?cmp bp:XREF ?chebi .
+      FILTER (
+        regex(str(?chebi), '#CHEBI:')
+      )
+      ?dir ?p ?cmp .
+      ?react ?p2 ?dir .
+      ?react bp:XREF ?xref .
+      FILTER (
+        regex(str(?xref), 'UNIPROT')
+      )
+    } ORDER BY ?chebi
+    ''' % {'rhea': GRAPHS['rhea']}
+    return sorted(set([chebi.rsplit(':', 1)[1]
+        for (chebi,) in _iter_all_rows(query, ('chebi',))]), key=int)
+
+
+# Line of the access log for a page or a csv export of a compound
+_ACCESS_LINE = re.compile(
+    r'^Chebi2gene .* -- .* -- [^ ]*/(?:chebi|csv)/(\d+)(?:[?#].*)?$')
+
+
+def top_chebi_ids_from_logs(paths, limit=1000):
+    """ Returns the compounds the most requested in the given access
+    logs, counting the requests of their page and of their csv export.
+
+    Only the `Chebi2gene <date> -- <address> -- <url>` lines written by
+    the web application for each request are read, the other lines,
+    such as the statistics of the requests, are ignored.
+
+    @param paths, a list of paths to the log files.
+    @param limit, an integer, the maximum number of compounds returned.
+    @return, a list of strings, the chebi identifiers from the most to
+    the least requested.
+    """
+    counts = collections.Counter()
+    for path in paths:
+        with open(path) as stream:
+            for line in stream:
+                match = _ACCESS_LINE.match(line)
+                if match:
+                    counts[match.group(1)] += 1
+    return [chebi_id for chebi_id, _ in counts.most_common(limit)]
+
+
+class _RateLimiter(object):
+    """ Spaces out the calls made by several threads so that at most
+    `rate` of them are made per second.
+    """
+
+    def __init__(self, rate):
+        """ Constructor.
+
+        @param rate, a float, the number of calls per second, no limit
+        if it is not set.
+        """
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Waits until the next call can be made. """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def warm_cache(chebi_ids, concurrency=None, rate=None, state_path=None,
+        progress=None):
+    """ Retrieves the information of the given compounds so that their
+    queries are answered from `CACHE` afterwards, which is only useful
+    to the web application with a `cache_path` shared between them.
+
+    @param chebi_ids, a list of strings, identifiers of compounds on
+    chebi.
+    @param concurrency, an integer, the number of compounds retrieved at
+    the same time. Defaults to the `max_requests` of the configuration.
+    @param rate, a float, the maximum number of compounds started per
+    second, no limit if it is not set.
+    @param state_path, a string, the path of a file listing the compounds
+    already retrieved, which are skipped, and to which the compounds
+    retrieved are added, so that an interrupted run can be resumed. The
+    file is started again when the data changed.
+    @param progress, a file to which the progress is written.
+    @return, a tuple (number of compounds retrieved, list of the
+    compounds which failed).
+    """
+    version = '# %s\n' % data_version()
+    done = set()
+    if state_path and os.path.exists(state_path):
+        with open(state_path) as stream:
+            if stream.readline() == version:
+                done.update([line.strip() for line in stream])
+    todo = [chebi_id for chebi_id in chebi_ids if chebi_id not in done]
+    state = None
+    if state_path:
+        state = open(state_path, 'a' if done else 'w')
+        if not done:
+            state.write(version)
+            state.flush()
+    limiter = _RateLimiter(rate)
+    failed = []
+
+    def _warm(chebi_id):
+        """ Retrieves the information of one compound. """
+        limiter.wait()
+        try:
+            get_information_of_chebi(chebi_id)
+        except Exception, err:
+            return chebi_id, err
+        return chebi_id, None
+
+    start = time.time()
+    count = 0
+    pool = ThreadPool(max(1, concurrency or MAX_REQUESTS))
+    try:
+        for chebi_id, err in pool.imap_unordered(_warm, todo):
+            count += 1
+            if err is not None:
+                failed.append(chebi_id)
+            elif state is not None:
+                state.write('%s\n' % chebi_id)
+                state.flush()
+            if progress is not None and (count % 10 == 0
+                    or count == len(todo)):
+                elapsed = time.time() - start
+                speed = count / elapsed if elapsed else 0
+                print >> progress, '%s/%s compounds (%s already done, %s ' \
+                    'failed), %.1f/s, %ds left' % (count, len(todo),
+                    len(done), len(failed), speed,
+                    (len(todo) - count) / speed if speed else 0)
+    finally:
+        pool.terminate()
+        pool.join()
+        if state is not None:
+            state.close()
+    return count - len(failed), failed
+
+
+class IntervalIndex(object):
+    """ Index of intervals on scaffolds, finding the ones overlapping a
+    region in logarithmic time.
+
+    The intervals of each scaffold are kept sorted by start in arrays,
+    along with the furthest stop reached by the intervals up to each of
+    them, so that both ends of the overlapping intervals are found by
+    bisection. Coordinates are integers, both ends included.
+    """
+
+    def __init__(self, intervals):
+        """ Constructor.
+
+        @param intervals, an iterable of tuples (scaffold, start, stop,
+        value) where value is returned with the interval.
+        """
+        by_scaffold = {}
+        for scaffold, start, stop, value in intervals:
+            by_scaffold.setdefault(scaffold, []).append((start, stop, value))
+        self._scaffolds = {}
+        for scaffold, items in by_scaffold.items():
+            items.sort(key=lambda item: item[:2])
+            reach = array.array('l')
+            furthest = None
+            for _, stop, _ in items:
+                furthest = stop if furthest is None else max(furthest, stop)
+                reach.append(furthest)
+            self._scaffolds[scaffold] = (
+                array.array('l', [item[0] for item in items]),
+                array.array('l', [item[1] for item in items]),
+                reach,
+                [item[2] for item in items])
+
+    def __len__(self):
+        return sum([len(entry[0]) for entry in self._scaffolds.values()])
+
+    def scaffolds(self):
+        """ Returns the sorted list of the scaffolds having intervals. """
+        return sorted(self._scaffolds)
+
+    def overlapping(self, scaffold, start, stop):
+        """ Returns the intervals overlapping the given region.
+
+        @param scaffold, a string, the scaffold of the region.
+        @param start, an integer, the first position of the region.
+        @param stop, an integer, the last position of the region.
+        @return, a list of tuples (start, stop, value) sorted by start.
+        """
+        if scaffold not in self._scaffolds:
+            return []
+        starts, stops, reach, values = self._scaffolds[scaffold]
+        # Intervals starting after the region and intervals ending, as
+        # all the ones before them, before the region are left out
+        first = bisect.bisect_left(reach, start)
+        last = bisect.bisect_right(starts, stop)
+        return [(starts[idx], stops[idx], values[idx])
+            for idx in xrange(first, last) if stops[idx] >= start]
+
+
+def parse_region(text):
+    """ Returns the region described as `scaffold:start-stop` in the
+    given text, the positions may contain commas.
+
+    @return, a tuple (scaffold, start, stop).
+    @raise ValueError, if the text is not a valid region.
+    """
+    match = re.match(r'^\s*([^:\s]+):([\d,]+)-([\d,]+)\s*$', text)
+    if not match:
+        raise ValueError('Invalid region %r, expected scaffold:start-stop'
+            % text)
+    start = int(match.group(2).replace(',', ''))
+    stop = int(match.group(3).replace(',', ''))
+    if stop < start:
+        raise ValueError('Invalid region %r, it stops before it starts'
+            % text)
+    return match.group(1), start, stop
+
+
+def parse_bed(text):
+    """ Returns the regions of the given BED file in an IntervalIndex.
+
+    The regions are converted from the zero-based, end excluded,
+    coordinates of BED to the positions of the genes. Each region comes
+    with its name, or `scaffold:start-stop` if it has none.
+
+    @param text, a string, the content of the BED file.
+    @return, an IntervalIndex of the names of the regions.
+    @raise ValueError, if a line is not a valid BED line.
+    """
+    regions = []
+    for cnt, line in enumerate(text.splitlines()):
+        fields = line.split('\t') if '\t' in line else line.split()
+        if not line.strip() or fields[0] in ('browser', 'track') \
+                or line.startswith('#'):
+            continue
+        try:
+            scaffold, start, stop = fields[0], int(fields[1]) + 1, \
+                int(fields[2])
+        except (IndexError, ValueError):
+            raise ValueError('Invalid BED line %s: %r' % (cnt + 1, line))
+        if len(fields) > 3 and fields[3].strip():
+            name = fields[3].strip()
+        else:
+            name = '%s:%s-%s' % (scaffold, start, stop)
+        regions.append((scaffold, start, stop, name))
+    return IntervalIndex(regions)
+
+
+def gene_regions(regions, gene):
+    """ Returns the names of the regions of the given IntervalIndex which
+    the given gene overlaps.
+    """
+    start, stop = _coordinate(gene['start']), _coordinate(gene['stop'])
+    if not isinstance(start, int) or not isinstance(stop, int):
+        return []
+    return [name for _, _, name in regions.overlapping(gene['sca'], start,
+        stop)]
+
+
+def _build_gene_index(reactions, genes):
+    """ Returns the IntervalIndex of the genes of all the proteins having
+    a reaction, from the reactions of get_all_reactions and their genes.
+    """
+    compounds = _compounds_of_proteins(reactions)
+    intervals = []
+    for protein, protein_genes in genes.items():
+        for gene in protein_genes:
+            start = _coordinate(gene['start'])
+            stop = _coordinate(gene['stop'])
+            if isinstance(start, int) and isinstance(stop, int):
+                intervals.append((gene['sca'], start, stop,
+                    (protein, gene, compounds.get(protein, []))))
+    return IntervalIndex(intervals)
+
+
+class IndexNotReady(Exception):
+    """ Raised when an index built in the background is needed before it
+    is ready.
+    """
+
+
+def build_gene_indexes():
+    """ Builds the indexes of the genes, GENE_INDEX and REVERSE_INDEX,
+    walking the graphs if there is no local index.
+
+    The genes of all the proteins are retrieved, which takes a while:
+    the web application builds them in the background at startup, see
+    start_gene_indexes, and the results are kept out of the cache.
+    """
+    global GENE_INDEX, REVERSE_INDEX
+    reactions = get_all_reactions()
+    genes = get_genes_of_proteins(
+        {None: sorted(_compounds_of_proteins(reactions))}, use_cache=False)
+    gene_index = _build_gene_index(reactions, genes)
+    reverse_index = ReverseIndex(reactions, genes)
+    with _GENE_INDEX_LOCK:
+        GENE_INDEX = gene_index
+    with _REVERSE_INDEX_LOCK:
+        REVERSE_INDEX = reverse_index
+
+
+def _build_gene_indexes_in_background():
+    """ Runs build_gene_indexes, reporting its failure. """
+    try:
+        build_gene_indexes()
+    except Exception, err:
+        print >> sys.stderr, 'The indexes of the genes could not be ' \
+            'built: %s' % err
+
+
+_GENE_INDEX_LOCK = threading.Lock()
+# Thread building the indexes of the genes, see start_gene_indexes.
+_GENE_INDEXES_THREAD = None
+
+
+def start_gene_indexes():
+    """ Starts building the indexes of the genes in a background thread,
+    unless they are built or being built. A failed build is started
+    again at the next call.
+
+    @return, the thread building the indexes.
+    """
+    global _GENE_INDEXES_THREAD
+    with _GENE_INDEX_LOCK:
+        thread = _GENE_INDEXES_THREAD
+        if thread is None or (not thread.is_alive() and (
+                GENE_INDEX is None or REVERSE_INDEX is None)):
+            thread = threading.Thread(
+                target=_build_gene_indexes_in_background)
+            thread.daemon = True
+            thread.start()
+            _GENE_INDEXES_THREAD = thread
+        return thread
+
+
+def get_gene_index():
+    """ Returns the IntervalIndex of the genes linked to a compound. The
+    value of each gene is a tuple (protein, gene, list of chebi
+    identifiers).
+
+    It is built on first use from the local index if there is one,
+    otherwise in the background by start_gene_indexes.
+
+    @raise IndexNotReady, if the index is still being built.
+    """
+    global GENE_INDEX
+    if GENE_INDEX is None:
+        if get_index() is None:
+            start_gene_indexes()
+            raise IndexNotReady('The index of the genes is being built')
+        with _GENE_INDEX_LOCK:
+            if GENE_INDEX is None:
+                reactions = get_all_reactions()
+                GENE_INDEX = _build_gene_index(reactions,
+                    get_genes_of_proteins(
+                        {None: sorted(_compounds_of_proteins(reactions))}))
+    return GENE_INDEX
+
+
+def get_genes_in_region(scaffold, start, stop):
+    """ Returns the genes linked to a compound overlapping a region.
+
+    @param scaffold, a string, the scaffold of the region.
+    @param start, an integer, the first position of the region.
+    @param stop, an integer, the last position of the region.
+    @return, a list of dictionaries with the `protein`, the fields of
+    the gene and the `compounds` of the protein, sorted by start.
+    @raise IndexNotReady, if the index of the genes is being built.
+    """
+    output = []
+    for _, _, (protein, gene, compounds) in get_gene_index().overlapping(
+            scaffold, start, stop):
+        entry = dict(gene.as_dict() if isinstance(gene, Gene) else gene)
+        entry.update({'protein': protein, 'compounds': compounds})
+        output.append(entry)
+    return output
+
+
+class ReverseIndex(object):
+    """ Inverted index from the genes and the proteins to the reactions
+    and the compounds they take part in, so that each lookup is a single
+    probe of a dictionary.
+
+    Genes are found by their name, with or without its version, and
+    proteins by their uniprot identifier, ignoring the case.
+    """
+
+    def __init__(self, reactions, genes):
+        """ Constructor.
+
+        @param reactions, a dictionary as returned by get_all_reactions.
+        @param genes, a dictionary as returned by get_genes_of_proteins.
+        """
+        compounds = {}
+        for chebi_id, compound in reactions.items():
+            for reaction, xrefs in compound.items():
+                for xref in xrefs:
+                    protein = xref.rsplit(':', 1)[1].strip()
+                    compounds.setdefault(protein, set()).add(
+                        (chebi_id, reaction))
+        # protein: ((chebi, reaction), ...)
+        self.proteins = dict([(protein, tuple(sorted(pairs,
+            key=lambda pair: (int(pair[0]), pair[1]))))
+            for protein, pairs in compounds.items()])
+        # protein: (gene name, ...)
+        self.protein_genes = {}
+        # name of gene: ((gene name, protein), ...)
+        self.genes = {}
+        for protein, protein_genes in genes.items():
+            if protein not in self.proteins:
+                continue
+            names = tuple(sorted(set([gene['name']
+                for gene in protein_genes])))
+            self.protein_genes[protein] = names
+            for name in names:
+                keys = set([name.upper(), name.split('.', 1)[0].upper()])
+                for key in keys:
+                    self.genes[key] = self.genes.get(key, ()) + (
+                        (name, protein),)
+
+    def __len__(self):
+        return len(self.proteins)
+
+    def lookup(self, identifier):
+        """ Returns the compounds and reactions of a gene or a protein.
+
+        @param identifier, a string, the name of a gene or the uniprot
+        identifier of a protein.
+        @return, a dictionary with the `genes` names matched and, for
+        each of their `proteins`, a dictionary where the keys are chebi
+        identifiers and the values lists of reactions identifier. None
+        if the identifier is not known.
+        """
+        key = identifier.strip().upper()
+        if key.startswith('UNIPROT:'):
+            key = key[8:]
+        if key in self.proteins:
+            matches = [(name, key) for name in self.protein_genes.get(key,
+                [])] or [(None, key)]
+        elif key in self.genes:
+            matches = self.genes[key]
+        else:
+            return None
+        genes = []
+        proteins = {}
+        for name, protein in matches:
+            if name is not None and name not in genes:
+                genes.append(name)
+            if protein not in proteins:
+                compounds = proteins[protein] = {}
+                for chebi_id, reaction in self.proteins[protein]:
+                    compounds.setdefault(chebi_id, []).append(reaction)
+        return {'genes': genes, 'proteins': proteins}
+
+
+_REVERSE_INDEX_LOCK = threading.Lock()
+
+
+def get_reverse_index():
+    """ Returns the ReverseIndex of all the genes and proteins having a
+    reaction, built as get_gene_index.
+
+    @raise IndexNotReady, if the index is still being built.
+    """
+    global REVERSE_INDEX
+    if REVERSE_INDEX is None:
+        if get_index() is None:
+            start_gene_indexes()
+            raise IndexNotReady('The index of the genes is being built')
+        with _REVERSE_INDEX_LOCK:
+            if REVERSE_INDEX is None:
+                reactions = get_all_reactions()
+                genes = get_genes_of_proteins(
+                    {None: sorted(_compounds_of_proteins(reactions))})
+                REVERSE_INDEX = ReverseIndex(reactions, genes)
+    return REVERSE_INDEX
+
+
+def parse_gene_ids(text):
+    """ Returns the names of genes or uniprot identifiers contained in the
+    given text, separated by spaces, commas or new lines.
+
+    @return, a list of the unique identifiers found, in the order in
+    which they appear.
+    """
+    identifiers = []
+    seen = set()
+    for identifier in re.split(r'[\s,;]+', text):
+        if identifier and identifier.upper() not in seen:
+            seen.add(identifier.upper())
+            identifiers.append(identifier)
+    return identifiers
+
+
+# Columns of the csv export of the reverse lookups.
+REVERSE_CSV_HEADER = ['Query', 'Gene', 'UniProt', 'Chebi ID', 'Chebi URL',
+    'Rhea ID', 'Rhea URL']
+
+
+def iter_reverse_output(identifiers, output_format='csv'):
+    """ Returns the compounds of several genes or proteins as a single csv
+    file or JSON lines document.
+
+    @param identifiers, a list of strings, names of genes or uniprot
+    identifiers.
+    @param output_format, a string, either `csv` or `jsonl`.
+    @return, a generator of strings, the lines of the output.
+    @raise IndexNotReady, if the index of the genes is being built.
+    """
+    index = get_reverse_index()
+    if output_format == 'csv':
+        yield csv_line(REVERSE_CSV_HEADER)
+    for identifier in identifiers:
+        found = index.lookup(identifier) or {'genes': [], 'proteins': {}}
+        if output_format != 'csv':
+            found['query'] = identifier
+            yield json.dumps(found) + '\n'
+            continue
+        genes = found['genes']
+        for protein in sorted(found['proteins']):
+            compounds = found['proteins'][protein]
+            protein_genes = [name for name in
+                index.protein_genes.get(protein, []) if name in genes]
+            for chebi_id in sorted(compounds, key=int):
+                chebi_url = 'http://www.ebi.ac.uk/chebi/searchId.do?' \
+                    'chebiId=%s' % chebi_id
+                for reaction in compounds[chebi_id]:
+                    react_url = 'http://www.ebi.ac.uk/rhea/reaction.xhtml?' \
+                        'id=RHEA:%s' % reaction
+                    for gene in protein_genes or ['']:
+                        yield csv_line([identifier, gene, protein, chebi_id,
+                            chebi_url, reaction, react_url])
+
+
+def main(argv):
+    """ Command line entry point, runs the web application or the
+    other commands of chebi2gene.
+
+    @param argv, a list of strings, the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Link chebi compounds '
+        'to pathways and tomato genes.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve',
+        help='Run the development server (default command)')
+    subparser = subparsers.add_parser('batch',
+        help='Export the information of several compounds')
+    subparser.add_argument('inputs', nargs='*', metavar='FILE',
+        help='Files containing chebi identifiers, the standard input is '
+        'read if none is given')
+    subparser.add_argument('--format', choices=['csv', 'jsonl'],
+        default='csv', help='Output format (default: csv)')
+    subparser.add_argument('--output', metavar='FILE',
+        help='File to write the output to (default: standard output)')
+    subparser.add_argument('--regions', metavar='FILE',
+        help='BED file of regions with which the genes are annotated')
+    subparser = subparsers.add_parser('reverse',
+        help='Export the compounds of several genes or proteins')
+    subparser.add_argument('inputs', nargs='*', metavar='FILE',
+        help='Files containing names of genes or uniprot identifiers, the '
+        'standard input is read if none is given')
+    subparser.add_argument('--format', choices=['csv', 'jsonl'],
+        default='csv', help='Output format (default: csv)')
+    subparser.add_argument('--output', metavar='FILE',
+        help='File to write the output to (default: standard output)')
+    subparser = subparsers.add_parser('build-search-index',
+        help='Build the index of the names of the compounds')
+    subparser.add_argument('output', metavar='FILE',
+        help='File to write the index to, the `search_index_path` of the '
+        'configuration is used by the web application')
+    subparser = subparsers.add_parser('build-index',
+        help='Build the local index of all the compounds')
+    subparser.add_argument('output', metavar='FILE',
+        help='File to write the index to, the `index_path` of the '
+        'configuration is used by the web application')
+    subparser.add_argument('--dump', action='append', metavar='FILE',
+        help='RDF file to load instead of querying the sparql endpoint, '
+        'can be repeated')
+    subparser = subparsers.add_parser('warm',
+        help='Fill the cache of the queries shared with the web application')
+    subparser.add_argument('inputs', nargs='*', metavar='FILE',
+        help='Files containing the chebi identifiers of the compounds')
+    subparser.add_argument('--access-log', action='append', metavar='FILE',
+        help='Access log of the web application from which the most '
+        'requested compounds are taken, can be repeated')
+    subparser.add_argument('--top', type=int, default=1000,
+        help='Number of compounds taken from the access logs '
+        '(default: 1000)')
+    subparser.add_argument('--all', action='store_true',
+        help='Take all the compounds having a reaction')
+    subparser.add_argument('--concurrency', type=int,
+        help='Number of compounds retrieved at the same time (default: '
+        'max_requests)')
+    subparser.add_argument('--rate', type=float,
+        help='Maximum number of compounds started per second')
+    subparser.add_argument('--state', metavar='FILE',
+        help='File recording the compounds done, to resume an '
+        'interrupted run')
+    args = parser.parse_args(argv or ['serve'])
+
+    if args.command == 'batch':
+        if args.inputs:
+            text = '\n'.join([open(path).read() for path in args.inputs])
+        else:
+            text = sys.stdin.read()
+        regions = None
+        if args.regions:
+            try:
+                regions = parse_bed(open(args.regions).read())
+            except ValueError, err:
+                parser.error(str(err))
+        stream = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            for line in iter_bulk_output(parse_chebi_ids(text),
+                    args.format, regions):
+                stream.write(line)
+        finally:
+            if args.output:
+                stream.close()
+    elif args.command == 'reverse':
+        if args.inputs:
+            text = '\n'.join([open(path).read() for path in args.inputs])
+        else:
+            text = sys.stdin.read()
+        if get_index() is None:
+            build_gene_indexes()
+        stream = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            for line in iter_reverse_output(parse_gene_ids(text),
+                    args.format):
+                stream.write(line)
+        finally:
+            if args.output:
+                stream.close()
+    elif args.command == 'build-index':
+        build_index(args.output, dumps=args.dump)
+    elif args.command == 'warm':
+        if CACHE.disk is None:
+            parser.error('the cache_path of the configuration must be set '
+                'for the web application to use the warmed cache')
+        chebi_ids = parse_chebi_ids('\n'.join(
+            [open(path).read() for path in args.inputs]))
+        if args.access_log:
+            chebi_ids.extend(top_chebi_ids_from_logs(args.access_log,
+                args.top))
+        if args.all:
+            chebi_ids.extend(get_chebis_with_reactions())
+        chebi_ids = parse_chebi_ids(' '.join(chebi_ids))
+        if not chebi_ids:
+            parser.error('no compound to warm, give files of identifiers, '
+                '--access-log or --all')
+        count, failed = warm_cache(chebi_ids, concurrency=args.concurrency,
+            rate=args.rate, state_path=args.state, progress=sys.stderr)
+        print >> sys.stderr, '%s compounds retrieved, %s failed' % (count,
+            len(failed))
+        if failed:
+            sys.exit(1)
+    elif args.command == 'build-search-index':
+        if get_index() is not None:
+            SearchIndex(get_index().names).save(args.output)
+        else:
+            SearchIndex(get_chebi_names()).save(args.output)
+    else:
+        # The web application imports this module, it must not import it
+        # a second time when it is run as a script
+        sys.modules.setdefault('chebi2gene', sys.modules[__name__])
+        import webapp
+        print >> sys.stderr, GRAPHS
+        # Load the indexes before the first request
+        if get_index() is None:
+            start_gene_indexes()
+        get_search_index()
+        app = webapp.create_app()
+        app.debug = True
+        app.run()
 
 
 if __name__ == '__main__':
-    APP.debug = True
-    APP.run()
+    main(sys.argv[1:])
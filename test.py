@@ -4,12 +4,269 @@
 Unit-tests for chebi2gene
 """
 
+import BaseHTTPServer
+import cPickle
+import csv
+import gzip
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urlparse
 import json
 
+import rdflib
+
+import chebi2gene
+import webapp
+import wsgi
 from chebi2gene import *
 
 
+# Web application the pages are requested from.
+APP = webapp.create_app()
+# Maximum number of seconds importing chebi2gene may take, it takes about
+# 0.05 seconds without Flask and rdflib.
+STARTUP_BUDGET = 0.2
+
+
+# Small RDF dataset following the structure of the Rhea, UniProt, iTAG
+# and ChEBI graphs.
+TURTLE = '''
+@prefix bp: <http://www.biopax.org/release/biopax-level2.owl#> .
+@prefix rhea: <http://www.ebi.ac.uk/rhea#> .
+@prefix uniprot: <http://purl.uniprot.org/core/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix obo: <http://purl.obolibrary.org/obo#> .
+@prefix gene: <http://pbr.wur.nl/GENE#> .
+@prefix pos: <http://pbr.wur.nl/POSITION#> .
+
+rhea:cmp1 bp:XREF <http://www.ebi.ac.uk/rhea#CHEBI:17578> .
+rhea:left1 bp:PARTICIPANTS rhea:cmp1 .
+rhea:16740 bp:LEFT rhea:left1 ;
+    bp:XREF <http://www.ebi.ac.uk/rhea#rel/controller/UNIPROT:P1> .
+
+<http://purl.uniprot.org/uniprot/P1> uniprot:annotation _:annot ;
+    uniprot:organism <http://purl.uniprot.org/taxonomy/3702> .
+_:annot rdfs:seeAlso <http://pathway/1> ;
+    rdfs:comment "Carotenoid biosynthesis." .
+<http://purl.uniprot.org/taxonomy/3702> uniprot:scientificName
+    "Arabidopsis thaliana" .
+
+<http://pbr.wur.nl/GENE#Solyc01g000010> gene:Protein
+        <http://purl.uniprot.org/uniprot/P1> ;
+    gene:Position <http://pbr.wur.nl/POSITION#1> ;
+    gene:Description "Lycopene cyclase" ;
+    gene:FeatureName "Solyc01g000010.1.1" .
+<http://pbr.wur.nl/POSITION#1> pos:Scaffold
+        <http://pbr.wur.nl/SCAFFOLD#SL2.31ch01> ;
+    pos:Start "10" ;
+    pos:Stop "20" .
+
+<http://purl.obolibrary.org/obo/CHEBI_17578> rdfs:label "beta-carotene" ;
+    obo:Synonym "all-trans-beta-carotene" .
+'''
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP handler failing every other request and answering the
+    others with a gzip compressed body.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    body = '{"results": {"bindings": []}}'
+
+    def do_POST(self):
+        """ Answers a POST request. """
+        self.rfile.read(int(self.headers['content-length']))
+        FlakyHandler.requests.append(self.client_address)
+        if len(FlakyHandler.requests) % 2:
+            body = 'overloaded'
+            self.send_response(503)
+        else:
+            stream = StringIO.StringIO()
+            gzfile = gzip.GzipFile(fileobj=stream, mode='w')
+            gzfile.write(FlakyHandler.body)
+            gzfile.close()
+            body = stream.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """ Keeps the test output quiet. """
+        pass
+
+
+class IdleTimeoutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP handler closing the kept-alive connection after each request
+    without telling the client, as a server whose idle timeout expired.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_POST(self):
+        """ Answers a POST request. """
+        self.rfile.read(int(self.headers['content-length']))
+        IdleTimeoutHandler.requests.append(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        """ Keeps the test output quiet. """
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """ HTTP server answering each request in its own thread. """
+    daemon_threads = True
+
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP handler answering the requests after the delays given in
+    `delays`, one per request.
+    """
+    protocol_version = 'HTTP/1.1'
+    delays = []
+    requests = []
+
+    def do_POST(self):
+        """ Answers a POST request. """
+        self.rfile.read(int(self.headers['content-length']))
+        SlowHandler.requests.append(self.client_address)
+        time.sleep(SlowHandler.delays[len(SlowHandler.requests) - 1])
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        """ Keeps the test output quiet. """
+        pass
+
+
+class UnavailableHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP handler answering every request as an overloaded server. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        """ Answers a POST request. """
+        self.rfile.read(int(self.headers['content-length']))
+        self.send_response(503)
+        self.send_header('Content-Length', '10')
+        self.end_headers()
+        self.wfile.write('overloaded')
+
+    def log_message(self, *args):
+        """ Keeps the output of the tests clean. """
+
+
+class FakeTransport(object):
+    """ Transport answering the queries of chebi2gene from a small
+    dataset, without any sparql endpoint.
+    """
+
+    reactions = {
+        '17578': {'16740': ['P1', 'P2'], '16741': ['P2', 'P3']},
+        '17579': {'16742': ['P3']},
+    }
+    genes = {
+        'P1': [('Solyc01g000010.1.1', 'SL2.31ch01', '10', '20',
+            'Lycopene cyclase, beta and epsilon')],
+        'P3': [('Solyc03g000030.1.1', 'SL2.31ch03', '30', '40', 'Unknown')],
+    }
+    pathways = {'P1': ['Carotenoid biosynthesis.'], 'P2': ['Other.']}
+    organisms = {'P1': ['Arabidopsis thaliana'], 'P2': ['Zea mays'],
+        'P3': ['Solanum lycopersicum']}
+
+    def __init__(self):
+        self.queries = []
+
+    @staticmethod
+    def _uri(value):
+        """ Returns a binding of the given uri. """
+        return {'type': 'uri', 'value': value}
+
+    @staticmethod
+    def _literal(value):
+        """ Returns a binding of the given literal. """
+        return {'type': 'literal', 'value': value}
+
+    def _bindings(self, query):
+        """ Returns the bindings answering the given query. """
+        proteins = re.findall('purl.uniprot.org/uniprot/(\\w+)>', query)
+        bindings = []
+        for chebi_id in re.findall('rhea#CHEBI:(\\w+)>', query):
+            reactions = self.reactions.get(chebi_id, {})
+            for react in sorted(reactions):
+                for prot in reactions[react]:
+                    bindings.append({
+                        'chebi': self._uri(
+                            'http://www.ebi.ac.uk/rhea#CHEBI:%s' % chebi_id),
+                        'react': self._uri(
+                            'http://www.ebi.ac.uk/rhea#%s' % react),
+                        'xref': self._uri('http://www.ebi.ac.uk/rhea#rel/'
+                            'controller/UNIPROT:%s' % prot)})
+        for prot in proteins:
+            prot_uri = self._uri('http://purl.uniprot.org/uniprot/%s' % prot)
+            if 'gene:Protein' in query:
+                for name, sca, start, stop, desc in self.genes.get(prot, []):
+                    bindings.append({'prot': prot_uri,
+                        'name': self._literal(name),
+                        'sca': self._uri('http://pbr.wur.nl/SCAFFOLD#' + sca),
+                        'start': self._literal(start),
+                        'stop': self._literal(stop),
+                        'desc': self._literal(desc)})
+            elif 'uniprot:annotation' in query:
+                for desc in self.pathways.get(prot, []):
+                    bindings.append({'prot': prot_uri,
+                        'desc': self._literal(desc)})
+            elif 'uniprot:organism' in query:
+                for name in self.organisms.get(prot, []):
+                    bindings.append({'prot': prot_uri,
+                        'name': self._literal(name)})
+        return bindings
+
+    def post(self, url, body):
+        """ Answers the query contained in the given body. """
+        query = urlparse.parse_qs(body)['query'][0]
+        self.queries.append(query)
+        return json.dumps({'results': {'bindings': self._bindings(query)}})
+
+
+class ReplicaTransport(object):
+    """ Transport answering after the delay set for each replica, or
+    failing for the replicas without delay.
+    """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.urls = []
+
+    def post(self, url, body):
+        """ Answers the query with the url of the replica. """
+        self.urls.append(url)
+        if self.delays[url] is None:
+            raise socket.error('Connection refused')
+        time.sleep(self.delays[url])
+        return json.dumps({'results': {'bindings': [
+            {'url': {'type': 'literal', 'value': url}}]}})
+
+
 class Chebi2GeneTestCase(unittest.TestCase):
     """ Unit-test class for chebi2gene.
 
@@ -18,12 +275,1004 @@ class Chebi2GeneTestCase(unittest.TestCase):
     might results in failed tests.
     """
 
+    def test_startup(self):
+        """ Test that chebi2gene is imported without Flask nor rdflib and
+        within STARTUP_BUDGET ."""
+        script = '\n'.join(['import sys, time',
+            # Importing flask fails
+            'sys.modules["flask"] = None',
+            'start = time.time()',
+            'import chebi2gene',
+            'print time.time() - start, "rdflib" in sys.modules'])
+        durations = []
+        for _ in range(3):
+            output = subprocess.check_output([sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(chebi2gene.__file__)))
+            duration, rdflib_loaded = output.split()
+            durations.append(float(duration))
+        self.assertEqual(rdflib_loaded, 'False')
+        self.assertTrue(min(durations) < STARTUP_BUDGET,
+            'chebi2gene took %.3fs to import' % min(durations))
+
     def test_convert_to_uniprot_id(self):
         """ Test the convert_to_uniprot_id function ."""
         data = {'key': ['http://url/to/test:1234']}
         output = convert_to_uniprot_id(data)
         self.assertEqual(output, {'key': ['1234']})
 
+    def test_unique_proteins(self):
+        """ Test the unique_proteins function ."""
+        data = {'key': ['P1', 'P2', 'P1'], 'key2': ['P2']}
+        output = chebi2gene.unique_proteins(data)
+        self.assertEqual(sorted(output), ['P1', 'P2'])
+
+    def test_chunks(self):
+        """ Test the _chunks function ."""
+        output = chebi2gene._chunks(['P1', 'P2', 'P3', 'P4', 'P5'], 2)
+        self.assertEqual(output, [['P1', 'P2'], ['P3', 'P4'], ['P5']])
+        self.assertEqual(chebi2gene._chunks([], 2), [])
+
+    def test_sparql_query_all(self):
+        """ Test the sparql_query_all function ."""
+        original = chebi2gene.sparql_query
+        chebi2gene.sparql_query = lambda query, server, **kwargs: {
+            'query': query}
+        try:
+            output = sparql_query_all(['q%s' % cnt for cnt in range(10)],
+                'http://server')
+        finally:
+            chebi2gene.sparql_query = original
+        self.assertEqual(output, [{'query': 'q%s' % cnt}
+            for cnt in range(10)])
+
+    def test_http_transport(self):
+        """ Test the HttpTransport class ."""
+        FlakyHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = HttpTransport(retries=1, backoff=0)
+        url = 'http://127.0.0.1:%s/sparql' % server.server_port
+        try:
+            for _ in range(2):
+                output = transport.post(url, 'query=')
+                self.assertEqual(output, '{"results": {"bindings": []}}')
+        finally:
+            transport.close()
+            server.shutdown()
+        # Two attempts per call, all sent over the same connection
+        self.assertEqual(len(FlakyHandler.requests), 4)
+        self.assertEqual(len(set(FlakyHandler.requests)), 1)
+
+    def test_http_transport_idle_timeout(self):
+        """ Test that the HttpTransport class reconnects at once when an
+        idle connection was closed by the endpoint ."""
+        IdleTimeoutHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+            IdleTimeoutHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = HttpTransport(retries=0, backoff=60)
+        url = 'http://127.0.0.1:%s/sparql' % server.server_port
+        start = time.time()
+        try:
+            outputs = [transport.post(url, 'query=') for _ in range(2)]
+            body = ''.join(transport.stream(url, 'query='))
+        finally:
+            transport.close()
+            server.shutdown()
+        self.assertEqual(outputs, ['ok', 'ok'])
+        self.assertEqual(body, 'ok')
+        self.assertEqual(len(IdleTimeoutHandler.requests), 3)
+        self.assertTrue(time.time() - start < 10)
+
+    def test_http_transport_timeout(self):
+        """ Test that the HttpTransport class does not send again a query
+        timing out on a reused connection ."""
+        SlowHandler.requests = []
+        SlowHandler.delays = [0, 1, 1]
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = HttpTransport(retries=0, read_timeout=0.3)
+        url = 'http://127.0.0.1:%s/sparql' % server.server_port
+        try:
+            self.assertEqual(transport.post(url, 'query='), 'ok')
+            self.assertRaises(socket.timeout, transport.post, url, 'query=')
+            # Let a query sent again reach the server
+            time.sleep(0.5)
+        finally:
+            transport.close()
+            server.shutdown()
+        self.assertEqual(len(SlowHandler.requests), 2)
+
+    def test_sparql_select(self):
+        """ Test the sparql_select function ."""
+        FlakyHandler.requests = []
+        FlakyHandler.body = expected = ('prot,desc\r\n'
+            'http://purl.uniprot.org/uniprot/P1,"Carotenoid\r\nbiosynthesis"'
+            '\r\nhttp://purl.uniprot.org/uniprot/P2,\xce\xb2-carotene\r\n'
+            'http://purl.uniprot.org/uniprot/P3,\r\n')
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = HttpTransport(retries=1, backoff=0)
+        url = 'http://127.0.0.1:%s/sparql' % server.server_port
+        try:
+            rows = sparql_select('SELECT', url, ('desc', 'prot'),
+                use_cache=False)
+            body = ''.join(chebi2gene.TRANSPORT.stream(url, 'query='))
+        finally:
+            chebi2gene.TRANSPORT.close()
+            chebi2gene.TRANSPORT = original
+            server.shutdown()
+            FlakyHandler.body = '{"results": {"bindings": []}}'
+        self.assertEqual(rows, [
+            (u'Carotenoid\r\nbiosynthesis',
+                u'http://purl.uniprot.org/uniprot/P1'),
+            (u'\u03b2-carotene', u'http://purl.uniprot.org/uniprot/P2'),
+            (None, u'http://purl.uniprot.org/uniprot/P3')])
+        self.assertEqual(body, expected)
+        # The connection is reused once the streamed body has been read
+        self.assertEqual(len(set(FlakyHandler.requests)), 1)
+        # Endpoints ignoring the format asked answer with JSON
+        self.assertEqual(chebi2gene._rows_from_output(
+            ['{"results": {"bindings": [{"prot": {"value": "P1"}}]}}'],
+            ('prot', 'desc')), [(u'P1', None)])
+        self.assertEqual(chebi2gene._rows_from_output(['Error'],
+            ('prot', 'desc')), None)
+
+    def test_warm_cache(self):
+        """ Test the warm_cache and top_chebi_ids_from_logs functions ."""
+        folder = tempfile.mkdtemp()
+        state = os.path.join(folder, 'state')
+        log = os.path.join(folder, 'access.log')
+        with open(log, 'w') as stream:
+            stream.write(
+                'Chebi2gene 2013-01-01 10:00:00 -- 127.0.0.1 -- '
+                'http://localhost/chebi/17579\n'
+                'Chebi2gene-stats {"path": "/chebi/17579", "status": 200}\n'
+                'Chebi2gene 2013-01-01 10:00:01 -- 127.0.0.1 -- '
+                'http://localhost/csv/17578\n'
+                'Chebi2gene-stats {"path": "/csv/17578", "status": 200}\n'
+                'Chebi2gene-stats {"path": "/csv/17578", "status": 200}\n'
+                'Chebi2gene 2013-01-01 10:00:02 -- 127.0.0.1 -- '
+                'http://localhost/chebi/17579?x=1\n'
+                'Chebi2gene 2013-01-01 10:00:03 -- 127.0.0.1 -- '
+                'http://localhost/search/beta\n')
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = transport = FakeTransport()
+        CACHE.clear()
+        try:
+            top = top_chebi_ids_from_logs([log], limit=5)
+            first = warm_cache(['17578', '17579'], state_path=state)
+            queries = len(transport.queries)
+            CACHE.clear()
+            # The compounds done are skipped when the run is resumed
+            second = warm_cache(['17578', '17579', '1'], state_path=state)
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+            shutil.rmtree(folder)
+        self.assertEqual(top, ['17579', '17578'])
+        self.assertEqual(first, (2, []))
+        self.assertEqual(second, (1, []))
+        self.assertEqual(len(transport.queries), queries + 1)
+
+    def test_single_flight(self):
+        """ Test the SingleFlight class and the coalescing of the
+        concurrent lookups of a compound ."""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def _slow(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value * 2
+
+        outputs = []
+        threads = [threading.Thread(target=lambda: outputs.append(
+            flight.do('key', _slow, 21))) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [21])
+        self.assertEqual(sorted(outputs), [(42, False)] + [(42, True)] * 4)
+        self.assertRaises(ZeroDivisionError, flight.do, 'key',
+            lambda: 1 / 0)
+
+        class SlowTransport(FakeTransport):
+            def post(self, url, body):
+                time.sleep(0.05)
+                return FakeTransport.post(self, url, body)
+
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = transport = SlowTransport()
+        CACHE.clear()
+        try:
+            outputs = []
+            threads = [threading.Thread(target=lambda: outputs.append(
+                get_information_of_chebi('17578'))) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+        self.assertEqual(len(outputs), 8)
+        self.assertEqual(len(set([repr(output) for output in outputs])), 1)
+        # One query for the reactions and one per kind of information
+        self.assertEqual(len(transport.queries), 4)
+
+    def test_coalesced_across_processes(self):
+        """ Test the lock shared with the other processes ."""
+        folder = tempfile.mkdtemp()
+        original = chebi2gene.CACHE, chebi2gene.COALESCE_LOCK_DIR
+        chebi2gene.CACHE = QueryCache(disk=SqliteCache(
+            os.path.join(folder, 'cache')))
+        chebi2gene.COALESCE_LOCK_DIR = folder
+        try:
+            fetched = chebi2gene._coalesced('ab' * 20, True,
+                lambda: [['fetched']], 'other')
+            # The output stored by another process is used once the lock
+            # is held
+            chebi2gene.CACHE.set('cd' * 20, [['cached']])
+            cached = chebi2gene._coalesced('cd' * 20, True,
+                lambda: [['fetched']], 'other')
+        finally:
+            chebi2gene.CACHE, chebi2gene.COALESCE_LOCK_DIR = original
+            shutil.rmtree(folder)
+        self.assertEqual(fetched, [['fetched']])
+        self.assertEqual(cached, [['cached']])
+
+    def test_endpoint_balancer(self):
+        """ Test the EndpointBalancer class ."""
+        balancer = EndpointBalancer(failures=2, cooldown=60)
+        urls = ['http://a', 'http://b']
+        balancer.answered('http://a', 0.1)
+        # Replicas never measured first, then the fastest
+        self.assertEqual(balancer.choose(urls), 'http://b')
+        balancer.answered('http://b', 0.3)
+        self.assertEqual(balancer.choose(urls), 'http://a')
+        self.assertEqual(balancer.choose(urls, exclude=['http://a']),
+            'http://b')
+        self.assertEqual(balancer.choose(urls, exclude=urls), None)
+        # Then the least busy
+        for _ in range(3):
+            balancer.started('http://a')
+        self.assertEqual(balancer.choose(urls), 'http://b')
+        for _ in range(3):
+            balancer.finished('http://a')
+        balancer.failed('http://a')
+        self.assertTrue(balancer.healthy('http://a'))
+        balancer.failed('http://a')
+        self.assertFalse(balancer.healthy('http://a'))
+        self.assertEqual(balancer.choose(urls), 'http://b')
+        balancer.failed('http://b')
+        balancer.failed('http://b')
+        # The replica coming back first when all are unhealthy
+        self.assertEqual(balancer.choose(urls), 'http://a')
+        balancer.answered('http://b', 0.3)
+        self.assertEqual(balancer.stats()['http://b'], {'outstanding': 0,
+            'seconds': 0.3, 'healthy': True})
+
+    def test_replicas(self):
+        """ Test the failover and the hedging of the queries between the
+        replicas of the sparql endpoint ."""
+        original = (chebi2gene.TRANSPORT, chebi2gene.SERVER,
+            chebi2gene.SERVERS, chebi2gene.BALANCER, chebi2gene.HEDGE_AFTER)
+        chebi2gene.SERVER = 'http://a'
+        chebi2gene.SERVERS = ('http://a', 'http://b')
+        chebi2gene.BALANCER = balancer = EndpointBalancer(failures=1)
+        try:
+            # The replica failing is left aside
+            chebi2gene.TRANSPORT = transport = ReplicaTransport(
+                {'http://a': None, 'http://b': 0})
+            balancer.answered('http://a', 0.01)
+            balancer.answered('http://b', 0.02)
+            for _ in range(2):
+                output = sparql_select('SELECT ?url', 'http://a', ('url',),
+                    use_cache=False)
+                self.assertEqual(output, [('http://b',)])
+            self.assertEqual(transport.urls, ['http://a', 'http://b',
+                'http://b'])
+            self.assertFalse(balancer.healthy('http://a'))
+
+            # The slow replica is hedged
+            chebi2gene.TRANSPORT = transport = ReplicaTransport(
+                {'http://a': 0.5, 'http://b': 0})
+            chebi2gene.BALANCER = balancer = EndpointBalancer()
+            chebi2gene.HEDGE_AFTER = 0.05
+            balancer.answered('http://a', 0.01)
+            balancer.answered('http://b', 0.02)
+            start = time.time()
+            output = sparql_query('SELECT ?url', 'http://a', use_cache=False)
+            elapsed = time.time() - start
+            self.assertEqual(output['results']['bindings'][0]['url']['value'],
+                'http://b')
+            self.assertTrue(elapsed < 0.4)
+            self.assertEqual(transport.urls, ['http://a', 'http://b'])
+            self.assertIn('chebi2gene_query_hedged_total{server="http://a"}',
+                '\n'.join(QUERY_HEDGED.render()))
+            # Queries for other endpoints are not balanced
+            chebi2gene.TRANSPORT = transport = ReplicaTransport(
+                {'http://c': 0})
+            sparql_query('SELECT ?url', 'http://c', use_cache=False)
+            self.assertEqual(transport.urls, ['http://c'])
+            # Queries reading graphs with their own replicas go to them
+            chebi2gene.GRAPH_ENDPOINTS = {'http://rhea/': ('http://r',)}
+            self.assertEqual(chebi2gene._replicas('http://a',
+                'SELECT ?x FROM <http://rhea/> WHERE {}'), ('http://r',))
+            self.assertEqual(chebi2gene._replicas('http://a',
+                'SELECT ?x FROM <http://rhea/> FROM <http://itag/> '
+                'WHERE {}'), ('http://a', 'http://b'))
+        finally:
+            (chebi2gene.TRANSPORT, chebi2gene.SERVER, chebi2gene.SERVERS,
+                chebi2gene.BALANCER, chebi2gene.HEDGE_AFTER) = original
+            chebi2gene.GRAPH_ENDPOINTS = {}
+
+    def test_failed_queries(self):
+        """ Test that failed queries are not taken for empty results ."""
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = ReplicaTransport({})
+        chebi2gene.TRANSPORT.post = lambda url, body: 'Internal error'
+        CACHE.clear()
+        try:
+            self.assertRaises(QueryError, get_genes_of_proteins,
+                {'16740': ['P1']})
+            self.assertRaises(QueryError, get_protein_of_chebi, '17578')
+            self.assertRaises(QueryError, list, chebi2gene._iter_all_rows(
+                'SELECT ?chebi', ('chebi',)))
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+
+    def test_replica_server_error(self):
+        """ Test that a replica answering with server errors is left
+        aside for the other one ."""
+        servers = [BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+            for handler in (UnavailableHandler, FlakyHandler)]
+        for server in servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        urls = tuple(['http://127.0.0.1:%s/sparql' % server.server_port
+            for server in servers])
+        original = (chebi2gene.TRANSPORT, chebi2gene.SERVER,
+            chebi2gene.SERVERS, chebi2gene.BALANCER)
+        chebi2gene.TRANSPORT = transport = HttpTransport(retries=0,
+            backoff=0)
+        chebi2gene.SERVER, chebi2gene.SERVERS = urls[0], urls
+        chebi2gene.BALANCER = balancer = EndpointBalancer(failures=1)
+        # The failing replica looks the fastest
+        balancer.answered(urls[0], 0.001)
+        balancer.answered(urls[1], 0.01)
+        FlakyHandler.requests = [None]
+        try:
+            self.assertRaises(ServerError, transport.post, urls[0], 'query=')
+            output = sparql_select('SELECT ?x', urls[0], ('x',),
+                use_cache=False)
+        finally:
+            (chebi2gene.TRANSPORT, chebi2gene.SERVER, chebi2gene.SERVERS,
+                chebi2gene.BALANCER) = original
+            transport.close()
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+        self.assertEqual(output, [])
+        self.assertFalse(balancer.healthy(urls[0]))
+
+    def test_lru_cache(self):
+        """ Test the LRUCache class ."""
+        cache = LRUCache(size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1,
+            'evictions': 1, 'entries': 2})
+        cache.ttl = -1
+        cache.set('d', 4)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_sqlite_cache(self):
+        """ Test the SqliteCache class ."""
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'cache.sqlite')
+        try:
+            cache = SqliteCache(path, version='1')
+            cache.set('key', {'results': {'bindings': []}})
+            self.assertEqual(SqliteCache(path, version='1').get('key'),
+                {'results': {'bindings': []}})
+            self.assertEqual(SqliteCache(path, version='2').get('key'),
+                None)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_generate_csv(self):
+        """ Test the generate_csv function ."""
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = FakeTransport()
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            output = APP.test_client().get('/csv/17578')
+            rows = list(csv.reader(StringIO.StringIO(output.data)))
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+        self.assertEqual(rows[0], CSV_HEADER)
+        self.assertEqual(len(rows), 6)
+        self.assertIn(['17578',
+            'http://www.ebi.ac.uk/chebi/searchId.do?chebiId=17578', '16740',
+            'http://www.ebi.ac.uk/rhea/reaction.xhtml?id=RHEA:16740', 'P1',
+            'Arabidopsis thaliana', 'Pathway', 'Carotenoid biosynthesis.'],
+            rows)
+        genes = [row[6:] for row in rows if row[6] == 'Gene']
+        self.assertIn(['Gene', 'Solyc01g000010.1.1', 'SL2.31ch01', '10',
+            '20', 'Lycopene cyclase, beta and epsilon'], genes)
+
+    def test_request_stats(self):
+        """ Test the statistics of the requests and the metrics ."""
+        original = chebi2gene.TRANSPORT, chebi2gene.MAX_REQUESTS
+        chebi2gene.TRANSPORT = FakeTransport()
+        chebi2gene.MAX_REQUESTS = 4
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = APP.test_client()
+            output = client.get('/chebi/17578')
+            metrics = client.get('/metrics').data
+        finally:
+            chebi2gene.TRANSPORT, chebi2gene.MAX_REQUESTS = original
+            CACHE.clear()
+        timing = output.headers['Server-Timing']
+        # The queries ran by the threads of the pools are counted too
+        self.assertIn('sparql;dur=', timing)
+        self.assertIn('desc="4 queries', timing)
+        self.assertIn('sparql-genes;dur=', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('# TYPE chebi2gene_query_seconds histogram', metrics)
+        self.assertTrue(re.search('chebi2gene_query_seconds_count'
+            '{family="reactions"} [1-9]', metrics))
+        self.assertIn('chebi2gene_query_seconds_bucket{family="genes",'
+            'le="+Inf"}', metrics)
+        self.assertIn('chebi2gene_request_seconds_count{endpoint='
+            '"show_chebi"}', metrics)
+
+    def test_page_cache(self):
+        """ Test the cache of the pages and the conditional requests ."""
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = transport = FakeTransport()
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = APP.test_client()
+            page = client.get('/chebi/17578')
+            queries = len(transport.queries)
+            again = client.get('/chebi/17578')
+            etag = page.headers['ETag']
+            not_modified = client.get('/chebi/17578',
+                headers={'If-None-Match': etag})
+            CACHE.clear()
+            first_csv = client.get('/csv/17578')
+            first_csv.data
+            csv_queries = len(transport.queries)
+            second_csv = client.get('/csv/17578')
+            csv_not_modified = client.get('/csv/17578',
+                headers={'If-None-Match': second_csv.headers['ETag']})
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+            PAGE_CACHE.clear()
+        self.assertEqual(page.status_code, 200)
+        self.assertTrue(page.headers['Last-Modified'])
+        self.assertEqual(again.data, page.data)
+        self.assertEqual(again.headers['ETag'], etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, '')
+        # The csv export is streamed without ETag the first time only
+        self.assertNotIn('ETag', first_csv.headers)
+        self.assertEqual(second_csv.data, first_csv.data)
+        self.assertEqual(csv_not_modified.status_code, 304)
+        # Only the first page and the first export were generated
+        self.assertEqual(len(transport.queries), csv_queries)
+        self.assertTrue(queries < csv_queries)
+
+    def test_progressive_page(self):
+        """ Test the progressive page of a compound and the fragments of
+        its proteins ."""
+        original = chebi2gene.TRANSPORT, chebi2gene.PROGRESSIVE_PAGE
+        chebi2gene.TRANSPORT = transport = FakeTransport()
+        chebi2gene.PROGRESSIVE_PAGE = True
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = APP.test_client()
+            page = client.get('/chebi/17578')
+            page_queries = len(transport.queries)
+            fragments = client.get('/proteins?id=P1&id=P2&id=P1')
+            invalid = client.get('/proteins?id=P1>')
+            newline = client.get('/proteins?id=P1%0A')
+        finally:
+            chebi2gene.TRANSPORT, chebi2gene.PROGRESSIVE_PAGE = original
+            CACHE.clear()
+            PAGE_CACHE.clear()
+        # Only the reactions are retrieved to render the page
+        self.assertEqual(page_queries, 1)
+        self.assertIn('<li>3 proteins involved</li>', page.data)
+        self.assertEqual(page.data.count('data-protein="P2"'), 2)
+        self.assertNotIn('Solyc01g000010.1.1', page.data)
+        # The sections are asked in requests the fragments accept
+        self.assertIn('if (count == %s) {' % webapp.FRAGMENT_PROTEINS,
+            page.data)
+        self.assertEqual(json.loads(fragments.data)['proteins'], {
+            'P1': {'pathways': ['Carotenoid biosynthesis.'],
+                'organisms': ['Arabidopsis thaliana'],
+                'genes': [{'name': 'Solyc01g000010.1.1',
+                    'sca': 'SL2.31ch01', 'start': 10, 'stop': 20,
+                    'desc': 'Lycopene cyclase, beta and epsilon'}]},
+            'P2': {'pathways': ['Other.'], 'organisms': ['Zea mays'],
+                'genes': []}})
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(newline.status_code, 400)
+
+    def test_wsgi(self):
+        """ Test that the WSGI application of wsgi.py serves the pages ."""
+        original = chebi2gene.TRANSPORT, chebi2gene.PROGRESSIVE_PAGE
+        chebi2gene.TRANSPORT = FakeTransport()
+        chebi2gene.PROGRESSIVE_PAGE = False
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = wsgi.application.test_client()
+            index = client.get('/')
+            page = client.get('/chebi/17578')
+        finally:
+            chebi2gene.TRANSPORT, chebi2gene.PROGRESSIVE_PAGE = original
+            CACHE.clear()
+            PAGE_CACHE.clear()
+        self.assertEqual(index.status_code, 200)
+        self.assertIn('<form method="POST"', index.data)
+        self.assertEqual(page.status_code, 200)
+        self.assertIn('<li>2 reactions found</li>', page.data)
+        self.assertIn('Solyc01g000010.1.1', page.data)
+
+    def test_access_log(self):
+        """ Test that the pages answered from the cache are logged ."""
+        original = chebi2gene.TRANSPORT, sys.stdout
+        chebi2gene.TRANSPORT = FakeTransport()
+        sys.stdout = log = StringIO.StringIO()
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = APP.test_client()
+            for _ in range(2):
+                client.get('/chebi/17578')
+        finally:
+            chebi2gene.TRANSPORT, sys.stdout = original
+            CACHE.clear()
+            PAGE_CACHE.clear()
+        self.assertEqual(len([line for line in log.getvalue().splitlines()
+            if chebi2gene._ACCESS_LINE.match(line)]), 2)
+
+    def test_page_cache_failures(self):
+        """ Test that the pages for which a query failed are not cached ."""
+        original = webapp.get_information_of_chebi
+
+        def _information(chebi_id):
+            """ Returns the information with a failed query. """
+            chebi2gene._record_failure('genes')
+            return original(chebi_id)
+
+        chebi2gene.TRANSPORT, transport = FakeTransport(), \
+            chebi2gene.TRANSPORT
+        webapp.get_information_of_chebi = _information
+        CACHE.clear()
+        PAGE_CACHE.clear()
+        try:
+            client = APP.test_client()
+            page = client.get('/chebi/17578')
+            stats = PAGE_CACHE.stats()
+        finally:
+            webapp.get_information_of_chebi = original
+            chebi2gene.TRANSPORT = transport
+            CACHE.clear()
+            PAGE_CACHE.clear()
+        self.assertEqual(page.status_code, 200)
+        self.assertNotIn('ETag', page.headers)
+        self.assertEqual(stats['entries'], 0)
+
+    def test_parse_chebi_ids(self):
+        """ Test the parse_chebi_ids function ."""
+        output = parse_chebi_ids('17578, CHEBI:17579\nfoo 17578;chebi:1')
+        self.assertEqual(output, ['17578', '17579', '1'])
+
+    def test_iter_bulk_output(self):
+        """ Test the iter_bulk_output function ."""
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = FakeTransport()
+        CACHE.clear()
+        try:
+            output = list(iter_bulk_output(['17579', '17578', '1'], 'jsonl'))
+            queries = chebi2gene.TRANSPORT.queries
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+        output = [json.loads(line) for line in output]
+        self.assertEqual([entry['chebi'] for entry in output],
+            ['17579', '17578'])
+        self.assertEqual(output[0]['reactions'], {'16742': ['P3']})
+        self.assertEqual(output[1]['organisms']['P3'],
+            ['Solanum lycopersicum'])
+        # One query for the compounds and one per kind of information
+        self.assertEqual(len(queries), 4)
+
+    def test_build_index(self):
+        """ Test the build_index function and the LocalIndex class ."""
+        folder = tempfile.mkdtemp()
+        dump = os.path.join(folder, 'dump.ttl')
+        with open(dump, 'w') as stream:
+            stream.write(TURTLE)
+        CACHE.clear()
+        try:
+            build_index(os.path.join(folder, 'index'), dumps=[dump])
+            index = LocalIndex.load(os.path.join(folder, 'index'))
+            # The rows of the dumps are not cached as the endpoint's
+            cached = CACHE.stats()['memory']['entries']
+        finally:
+            shutil.rmtree(folder)
+            CACHE.clear()
+        self.assertEqual(cached, 0)
+        self.assertEqual(index.protein_of_chebi('17578'), {'16740':
+            ['http://www.ebi.ac.uk/rhea#rel/controller/UNIPROT:P1']})
+        # A loaded index is not reused when building a new one
+        original = chebi2gene.INDEX
+        chebi2gene.INDEX = LocalIndex({'version': '', 'built': 0,
+            'reactions': {'99999': {}}, 'pathways': {}, 'genes': {},
+            'organisms': {}, 'names': {}})
+        folder = tempfile.mkdtemp()
+        with open(os.path.join(folder, 'dump.ttl'), 'w') as stream:
+            stream.write(TURTLE)
+        try:
+            rebuilt = build_index(os.path.join(folder, 'index'),
+                dumps=[os.path.join(folder, 'dump.ttl')])
+        finally:
+            chebi2gene.INDEX = original
+            shutil.rmtree(folder)
+        self.assertEqual(sorted(rebuilt.reactions), ['17578'])
+        self.assertEqual(index.information({'16740': ['P1']}), (
+            {'P1': ['Carotenoid biosynthesis.']},
+            {'P1': [Gene('Solyc01g000010.1.1', 'SL2.31ch01', 10, 20,
+                'Lycopene cyclase')]},
+            {'P1': ['Arabidopsis thaliana']}))
+        search_index = SearchIndex(index.names)
+        self.assertEqual(search_index.search('Beta-CAR'), {'17578': {
+            'name': ['beta-carotene'], 'syn': ['all-trans-beta-carotene']}})
+
+    def test_get_index(self):
+        """ Test that the configured index is loaded on first use ."""
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'index')
+        with open(path, 'wb') as stream:
+            cPickle.dump({'version': GRAPHS_VERSION, 'built': 1,
+                'reactions': {'17578': {'16740': ('P1',)}}, 'pathways': {},
+                'genes': {}, 'organisms': {}, 'names': {}}, stream)
+        original = chebi2gene.INDEX
+        chebi2gene.CONFIG.set('chebi2gene', 'index_path', path)
+        chebi2gene.INDEX = chebi2gene._INDEX_NOT_LOADED
+        try:
+            proteins = get_protein_of_chebi('17578')
+            index = chebi2gene.INDEX
+        finally:
+            chebi2gene.CONFIG.remove_option('chebi2gene', 'index_path')
+            chebi2gene.INDEX = original
+            shutil.rmtree(folder)
+        self.assertEqual(proteins, {'16740': ['P1']})
+        self.assertEqual(index.built, 1)
+
+    def test_interval_index(self):
+        """ Test the IntervalIndex class and the parse_bed and parse_region
+        functions ."""
+        index = IntervalIndex([('ch01', 10, 20, 'a'), ('ch01', 1, 100, 'b'),
+            ('ch01', 30, 40, 'c'), ('ch02', 10, 20, 'd')])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.scaffolds(), ['ch01', 'ch02'])
+        self.assertEqual(index.overlapping('ch01', 20, 30),
+            [(1, 100, 'b'), (10, 20, 'a'), (30, 40, 'c')])
+        self.assertEqual(index.overlapping('ch01', 41, 50), [(1, 100, 'b')])
+        self.assertEqual(index.overlapping('ch01', 101, 200), [])
+        self.assertEqual(index.overlapping('ch03', 1, 200), [])
+
+        regions = parse_bed('track name=test\n# comment\n\n'
+            'SL2.31ch01\t9\t12\tpeak1\nSL2.31ch01 19 25\n')
+        self.assertEqual(regions.overlapping('SL2.31ch01', 10, 20),
+            [(10, 12, 'peak1'), (20, 25, 'SL2.31ch01:20-25')])
+        self.assertRaises(ValueError, parse_bed, 'SL2.31ch01\tten\t12\n')
+
+        self.assertEqual(parse_region('SL2.31ch01:1,000-2,000'),
+            ('SL2.31ch01', 1000, 2000))
+        self.assertRaises(ValueError, parse_region, 'SL2.31ch01:20-10')
+        self.assertRaises(ValueError, parse_region, 'SL2.31ch01')
+
+    def test_regions(self):
+        """ Test the region endpoint and the annotation of the batch
+        export with the regions of a BED file ."""
+        folder = tempfile.mkdtemp()
+        dump = os.path.join(folder, 'dump.ttl')
+        with open(dump, 'w') as stream:
+            stream.write(TURTLE)
+        original = chebi2gene.INDEX
+        try:
+            build_index(os.path.join(folder, 'index'), dumps=[dump])
+            chebi2gene.INDEX = LocalIndex.load(os.path.join(folder, 'index'))
+            chebi2gene.GENE_INDEX = None
+            chebi2gene.REVERSE_INDEX = None
+            client = APP.test_client()
+            output = json.loads(client.get('/region/SL2.31ch01:15-30').data)
+            self.assertEqual(output['count'], 1)
+            self.assertEqual(output['genes'], [{
+                'protein': 'P1', 'compounds': ['17578'],
+                'name': 'Solyc01g000010.1.1', 'sca': 'SL2.31ch01',
+                'start': 10, 'stop': 20, 'desc': 'Lycopene cyclase'}])
+            output = json.loads(client.get('/region/SL2.31ch01:21-30').data)
+            self.assertEqual(output['count'], 0)
+            self.assertEqual(client.get('/region/ch01').status_code, 400)
+
+            response = client.post('/batch', data={'chebi_ids': '17578',
+                'regions': (StringIO.StringIO('SL2.31ch01\t0\t10\tp1\n'),
+                    'regions.bed')})
+            rows = list(csv.reader(StringIO.StringIO(response.data)))
+            self.assertEqual(rows[0][-1], 'Regions')
+            self.assertEqual([row[-1] for row in rows if row[6] == 'Gene'],
+                ['p1'])
+            output = json.loads(''.join(iter_bulk_output(['17578'], 'jsonl',
+                parse_bed('SL2.31ch01 30 40 p2\n'))))
+            self.assertEqual(output['genes']['P1'][0]['regions'], [])
+            response = client.post('/batch', data={'chebi_ids': '17578',
+                'regions': (StringIO.StringIO('SL2.31ch01\n'), 'bad.bed')})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(get_reverse_index().lookup('Solyc01g000010'),
+                {'genes': ['Solyc01g000010.1.1'],
+                    'proteins': {'P1': {'17578': ['16740']}}})
+        finally:
+            shutil.rmtree(folder)
+            chebi2gene.INDEX = original
+            chebi2gene.GENE_INDEX = None
+            chebi2gene.REVERSE_INDEX = None
+
+    def test_gene_indexes(self):
+        """ Test that the indexes of the genes are built in the background
+        when there is no local index ."""
+        graph = rdflib.Graph()
+        graph.parse(data=TURTLE, format='turtle')
+        original = chebi2gene.TRANSPORT, chebi2gene.INDEX
+        chebi2gene.TRANSPORT = RdflibTransport(graph)
+        chebi2gene.INDEX = None
+        chebi2gene.GENE_INDEX = None
+        chebi2gene.REVERSE_INDEX = None
+        chebi2gene._GENE_INDEXES_THREAD = None
+        CACHE.clear()
+        try:
+            client = APP.test_client()
+            responses = [client.get('/region/SL2.31ch01:15-30'),
+                client.get('/gene/P1'), client.post('/reverse',
+                    data={'identifiers': 'P1'})]
+            chebi2gene.start_gene_indexes().join()
+            region = json.loads(
+                client.get('/region/SL2.31ch01:15-30').data)
+            gene = json.loads(client.get('/gene/P1').data)
+            cached = CACHE.stats()['memory']['entries']
+        finally:
+            chebi2gene.TRANSPORT, chebi2gene.INDEX = original
+            chebi2gene.GENE_INDEX = None
+            chebi2gene.REVERSE_INDEX = None
+            chebi2gene._GENE_INDEXES_THREAD = None
+            CACHE.clear()
+        self.assertEqual([response.status_code for response in responses],
+            [503, 503, 503])
+        self.assertEqual(region['count'], 1)
+        self.assertEqual(gene['proteins'], {'P1': {'17578': ['16740']}})
+        # The genes of all the proteins are not kept in the cache
+        self.assertEqual(cached, 0)
+
+    def test_reverse_index(self):
+        """ Test the ReverseIndex class and the reverse lookups ."""
+        index = ReverseIndex({
+            '17578': {'16740': ['http://www.ebi.ac.uk/rhea#UNIPROT:P1'],
+                '16741': ['http://www.ebi.ac.uk/rhea#UNIPROT:P2']},
+            '17579': {'16742': ['http://www.ebi.ac.uk/rhea#UNIPROT:P1']}},
+            {'P1': [Gene('Solyc01g000010.1.1', 'SL2.31ch01', 10, 20, 'a'),
+                Gene('Solyc01g000020.2.1', 'SL2.31ch01', 30, 40, 'b')],
+             'P3': [Gene('Solyc01g000030.1.1', 'SL2.31ch01', 50, 60, 'c')]})
+        self.assertEqual(len(index), 2)
+        expected = {'genes': ['Solyc01g000010.1.1'], 'proteins': {
+            'P1': {'17578': ['16740'], '17579': ['16742']}}}
+        self.assertEqual(index.lookup('Solyc01g000010.1.1'), expected)
+        self.assertEqual(index.lookup('solyc01g000010'), expected)
+        self.assertEqual(index.lookup('UniProt:p1')['genes'],
+            ['Solyc01g000010.1.1', 'Solyc01g000020.2.1'])
+        self.assertEqual(index.lookup('P2'), {'genes': [], 'proteins': {
+            'P2': {'17578': ['16741']}}})
+        self.assertEqual(index.lookup('Solyc01g000030'), None)
+        self.assertEqual(parse_gene_ids('P1, p1\nSolyc01g000010;'),
+            ['P1', 'Solyc01g000010'])
+
+        original = chebi2gene.REVERSE_INDEX
+        chebi2gene.REVERSE_INDEX = index
+        try:
+            client = APP.test_client()
+            output = json.loads(client.get('/gene/Solyc01g000010').data)
+            self.assertEqual(output['proteins'], expected['proteins'])
+            self.assertEqual(client.get('/gene/P9').status_code, 404)
+            response = client.post('/reverse', data={
+                'identifiers': 'Solyc01g000020 P9'})
+            rows = list(csv.reader(StringIO.StringIO(response.data)))
+            self.assertEqual(rows[0], REVERSE_CSV_HEADER)
+            self.assertEqual([row[:4] + row[5:6] for row in rows[1:]], [
+                ['Solyc01g000020', 'Solyc01g000020.2.1', 'P1', '17578',
+                    '16740'],
+                ['Solyc01g000020', 'Solyc01g000020.2.1', 'P1', '17579',
+                    '16742']])
+            output = list(iter_reverse_output(['P9'], 'jsonl'))
+            self.assertEqual(json.loads(output[0]), {'query': 'P9',
+                'genes': [], 'proteins': {}})
+        finally:
+            chebi2gene.REVERSE_INDEX = original
+
+    def test_search_index(self):
+        """ Test the SearchIndex class ."""
+        names = {
+            '17579': {'name': ['beta-carotene'],
+                'syn': ['all-trans-beta-carotene', 'provitamin A']},
+            '35309': {'name': ['(5S,6R)-beta-carotene 5,6-epoxide'],
+                'syn': ['C40H56O']},
+            '27547': {'name': ['caffeine'], 'syn': ['1,3,7-trimethylxanthine']},
+        }
+        index = SearchIndex(names)
+        self.assertEqual(index.search('BETA-car').keys(), ['17579', '35309'])
+        self.assertEqual(index.search('trans'), {})
+        self.assertEqual(index.search('trans', extended=True), {'17579': {
+            'name': ['beta-carotene'], 'syn': ['all-trans-beta-carotene']}})
+        self.assertEqual(index.search('beta', limit=1).keys(), ['17579'])
+        self.assertEqual(index.search('beta', after='17579').keys(),
+            ['35309'])
+        self.assertEqual(index.search('e', extended=True).keys(),
+            ['17579', '27547', '35309'])
+        self.assertEqual(index.prefix('CAF'),
+            [('caffeine', '27547', False)])
+        self.assertEqual(index.complete('BETA', limit=1), [{'id': '17579',
+            'name': 'beta-carotene', 'match': 'beta-carotene'}])
+        self.assertEqual(index.complete('1,3'), [{'id': '27547',
+            'name': 'caffeine', 'match': '1,3,7-trimethylxanthine'}])
+
+    def test_get_chebi_completions(self):
+        """ Test the get_chebi_completions function and the completion of
+        the front page ."""
+        original = chebi2gene.SEARCH_INDEX
+        client = APP.test_client()
+        chebi2gene.SEARCH_INDEX = None
+        AUTOCOMPLETE_CACHE.clear()
+        try:
+            # Without search index there is nothing to complete
+            page = client.get('/')
+            self.assertNotIn('/autocomplete', page.data)
+            chebi2gene.SEARCH_INDEX = SearchIndex({'27547': {
+                'name': ['caffeine'], 'syn': ['1,3,7-trimethylxanthine']}})
+            page = client.get('/')
+            self.assertIn('/autocomplete', page.data)
+            for _ in range(2):
+                output = get_chebi_completions('Caf')
+                self.assertEqual([entry['id'] for entry in output],
+                    ['27547'])
+            self.assertEqual(AUTOCOMPLETE_CACHE.hits, 1)
+        finally:
+            chebi2gene.SEARCH_INDEX = original
+            AUTOCOMPLETE_CACHE.clear()
+
+    def test_sparql_regex(self):
+        """ Test the _sparql_regex function ."""
+        self.assertEqual(chebi2gene._sparql_regex('beta-carotene'),
+            'beta\\\\-carotene')
+        self.assertEqual(chebi2gene._sparql_regex('a") . }'),
+            'a\\"\\\\) \\\\. \\\\}')
+
+    def test_search_pages(self):
+        """ Test the pagination of the searches on the sparql endpoint ."""
+        graph = rdflib.Graph()
+        graph.parse(data=TURTLE + '''
+<http://purl.obolibrary.org/obo/CHEBI_35309>
+    rdfs:label "(5S,6R)-beta-carotene 5,6-epoxide" ;
+    obo:Synonym "C40H56O", "beta,beta-carotene epoxide" .
+<http://purl.obolibrary.org/obo/CHEBI_9> rdfs:label "gamma-carotene" ;
+    obo:Synonym "g-carotene" .
+''', format='turtle')
+        original = chebi2gene.TRANSPORT
+        chebi2gene.TRANSPORT = RdflibTransport(graph)
+        CACHE.clear()
+        try:
+            output = get_exact_chebi_from_search('beta-CAROTENE', limit=1)
+            self.assertEqual(output.keys(), ['17578'])
+            output = get_exact_chebi_from_search('beta-CAROTENE', limit=1,
+                after='17578')
+            # The synonyms come in the order of the endpoint
+            output['35309']['syn'].sort()
+            self.assertEqual(output, {'35309': {
+                'name': ['(5S,6R)-beta-carotene 5,6-epoxide'],
+                'syn': ['C40H56O', 'beta,beta-carotene epoxide']}})
+            output = get_extended_chebi_from_search('beta,beta')
+            self.assertEqual(output, {'35309': {
+                'name': ['(5S,6R)-beta-carotene 5,6-epoxide'],
+                'syn': ['beta,beta-carotene epoxide']}})
+            output = get_exact_chebi_from_search('carotene')
+            self.assertEqual(output.keys(), ['9', '17578', '35309'])
+        finally:
+            chebi2gene.TRANSPORT = original
+            CACHE.clear()
+
+    def test_get_information_of_chebi(self):
+        """ Test the get_information_of_chebi function with both query
+        engines ."""
+        graph = rdflib.Graph()
+        graph.parse(data=TURTLE, format='turtle')
+        original = chebi2gene.TRANSPORT, chebi2gene.QUERY_ENGINE
+        chebi2gene.TRANSPORT = RdflibTransport(graph)
+        CACHE.clear()
+        try:
+            chebi2gene.QUERY_ENGINE = 'stepwise'
+            stepwise = get_information_of_chebi('17578')
+            chebi2gene.QUERY_ENGINE = 'joined'
+            joined = get_information_of_chebi('17578')
+            self.assertEqual(get_information_of_chebi('1'), None)
+        finally:
+            chebi2gene.TRANSPORT, chebi2gene.QUERY_ENGINE = original
+            CACHE.clear()
+        self.assertEqual(stepwise, ({'16740': ['P1']},
+            {'P1': ['Carotenoid biosynthesis.']},
+            {'P1': [Gene('Solyc01g000010.1.1', 'SL2.31ch01', 10, 20,
+                'Lycopene cyclase')]},
+            {'P1': ['Arabidopsis thaliana']}))
+        self.assertEqual(joined, stepwise)
+
+    def test_gene(self):
+        """ Test the Gene class ."""
+        gene = Gene(u'Solyc01g000010.1.1', u'SL2.31ch01', u'10', u'20',
+            u'Lycopene cyclase')
+        self.assertEqual(gene['start'], 10)
+        self.assertEqual(gene['sca'], gene.sca)
+        self.assertRaises(KeyError, gene.__getitem__, 'prot')
+        other = cPickle.loads(cPickle.dumps(gene, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(other, gene)
+        self.assertFalse(other.sca is gene.sca)
+        # The scaffolds are shared between the genes of an index
+        with chebi2gene._interning():
+            gene = Gene(u'Solyc01g000010.1.1', u'SL2.31ch01', u'10', u'20',
+                u'Lycopene cyclase')
+            other = cPickle.loads(cPickle.dumps(gene,
+                cPickle.HIGHEST_PROTOCOL))
+        self.assertTrue(other.sca is gene.sca)
+        self.assertFalse(other.desc is gene.desc)
+        self.assertFalse(hasattr(chebi2gene._STRINGS, 'table'))
+        self.assertEqual(json.loads(json.dumps(gene.as_dict())), {
+            'name': 'Solyc01g000010.1.1', 'sca': 'SL2.31ch01', 'start': 10,
+            'stop': 20, 'desc': 'Lycopene cyclase'})
+
     def test_get_exact_chebi_from_search(self):
         """ Test the get_exact_chebi_from_search function ."""
         expected = {'35309': {'name': ['(5S,6R)-beta-carotene 5,6-epoxide'],
@@ -47,26 +1296,26 @@ class Chebi2GeneTestCase(unittest.TestCase):
         """ Test the get_genes_of_proteins function ."""
         data = {'key': ['Q38933']}
         expected = {'Q38933': [
-                      {'stop': '31104596', 'start': '31103094',
-                       'sca': u'SL2.31ch04', 'name': u'Solyc04g040190.1.1',
-                       'desc': u'Beta-lycopene cyclase (AHRD V1 ***- A6YS01_SOLLC)%3B'\
+                      Gene(u'Solyc04g040190.1.1', u'SL2.31ch04', 31103094,
+                       31104596,
+                       u'Beta-lycopene cyclase (AHRD V1 ***- A6YS01_SOLLC)%3B'\
                        ' contains Interpro domain(s)  IPR010108  Lycopene cyclase%2C'\
-                       ' beta and epsilon '},
-                      {'stop': u'42291459', 'start': u'42289963',
-                       'sca': u'SL2.31ch06', 'name': u'Solyc06g074240.1.1',
-                       'desc': u'Lycopene beta-cyclase (AHRD V1 ***- B7U386_ACTCH)%3B'\
+                       ' beta and epsilon '),
+                      Gene(u'Solyc06g074240.1.1', u'SL2.31ch06', 42289963,
+                       42291459,
+                       u'Lycopene beta-cyclase (AHRD V1 ***- B7U386_ACTCH)%3B'\
                        ' contains Interpro domain(s)  IPR010108  Lycopene cyclase%2C'\
-                       ' beta and epsilon '},
-                      {'stop': u'60349655', 'start': u'60348153',
-                       'sca': u'SL2.31ch10', 'name': u'Solyc10g079480.1.1',
-                       'desc': u'Beta-lycopene cyclase (AHRD V1 ***- A6YS01_SOLLC)%3B'\
+                       ' beta and epsilon '),
+                      Gene(u'Solyc10g079480.1.1', u'SL2.31ch10', 60348153,
+                       60349655,
+                       u'Beta-lycopene cyclase (AHRD V1 ***- A6YS01_SOLLC)%3B'\
                        ' contains Interpro domain(s)  IPR010108  Lycopene cyclase%2C'\
-                       ' beta and epsilon '},
-                      {'stop': u'2291525', 'start': u'2286570',
-                       'sca': u'SL2.31ch12', 'name': u'Solyc12g008980.1.1',
-                       'desc': u'Lycopene beta cyclase (AHRD V1 **** C1N7E6_MICPS)%3B'\
+                       ' beta and epsilon '),
+                      Gene(u'Solyc12g008980.1.1', u'SL2.31ch12', 2286570,
+                       2291525,
+                       u'Lycopene beta cyclase (AHRD V1 **** C1N7E6_MICPS)%3B'\
                        ' contains Interpro domain(s)  IPR010108  Lycopene cyclase%2C'\
-                       ' beta and epsilon '}
+                       ' beta and epsilon ')
                       ]}
         output = get_genes_of_proteins(data)
         self.assertEqual(output, expected)
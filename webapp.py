@@ -0,0 +1,482 @@
+#!/usr/bin/python
+
+"""
+Web application of chebi2gene.
+
+The pages and the JSON endpoints are served by the application returned by
+create_app, the queries and the exports are done by the chebi2gene module,
+which is usable without Flask.
+"""
+
+from flask import Flask, Response, current_app, jsonify, render_template, \
+    request, redirect, url_for
+from flaskext.wtf import Form, TextField
+
+import datetime
+import functools
+import hashlib
+import json
+import re
+import time
+
+import chebi2gene
+from chebi2gene import CSV_HEADER, Gene, IndexNotReady, METRICS, \
+    RENDER_SECONDS, REQUEST_SECONDS, RequestStats, convert_to_uniprot_id, \
+    csv_line, current_stats, data_version, get_chebi_completions, \
+    get_exact_chebi_from_search, get_extended_chebi_from_search, \
+    get_genes_in_region, get_information_of_chebi, \
+    get_information_of_proteins, get_protein_of_chebi, get_reverse_index, \
+    has_search_index, iter_bulk_output, iter_csv_rows, iter_reverse_output, \
+    parse_bed, parse_chebi_ids, parse_gene_ids, parse_region, \
+    set_current_stats, stream_information_of_chebi, unique_proteins
+
+# The settings and the caches, which may be changed at run time, are read
+# from chebi2gene when they are used.
+
+
+class ChebiIDForm(Form):
+    """ Simple text field form to input the chebi identifier or the
+    name of the protein.
+    """
+    chebi_id = TextField('Chebi ID or molecule name')
+
+
+# Url rules of the views, added to the applications by create_app.
+_ROUTES = []
+
+
+def _route(rule, **options):
+    """ Decorator adding the given view, for the given url rule and
+    options as Flask.route, to the applications created by create_app.
+    """
+    def _decorator(view):
+        """ Records the view. """
+        _ROUTES.append((rule, view, options))
+        return view
+    return _decorator
+
+
+def create_app():
+    """ Returns a new Flask application serving the pages of chebi2gene.
+    """
+    app = Flask(__name__)
+    app.secret_key = chebi2gene.CONFIG.get('chebi2gene', 'secret_key')
+    app.before_request(_start_request_stats)
+    app.after_request(_finish_request_stats)
+    app.register_error_handler(IndexNotReady, _index_not_ready)
+    for rule, view, options in _ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    return app
+
+
+def _index_not_ready(err):
+    """ Answers the requests needing an index still being built. """
+    response = Response('%s, please retry later\n' % err, status=503,
+        mimetype='text/plain')
+    response.headers['Retry-After'] = '60'
+    return response
+
+
+def _render_template(template, **context):
+    """ Renders the given template as render_template, recording the
+    time spent in the statistics of the request.
+    """
+    start = time.time()
+    output = render_template(template, **context)
+    render_time = time.time() - start
+    RENDER_SECONDS.observe(template, render_time)
+    stats = current_stats()
+    if stats is not None:
+        stats.add_render(render_time)
+    return output
+
+
+def _log_request_stats(stats, endpoint, method, path, status):
+    """ Records the statistics of an answered request in the metrics
+    and, if `request_log` is set, prints them as a JSON line.
+    """
+    REQUEST_SECONDS.observe(endpoint or 'none', time.time() - stats.start)
+    if not chebi2gene.REQUEST_LOG:
+        return
+    line = stats.as_dict()
+    line.update({'time': datetime.datetime.now().isoformat(),
+        'endpoint': endpoint, 'method': method, 'path': path,
+        'status': status})
+    print 'Chebi2gene-stats %s' % json.dumps(line, sort_keys=True)
+
+
+def _iter_with_stats(iterable, stats, finish):
+    """ Returns the items of the body of a streamed response, recording
+    the queries sent while generating them in the given statistics and
+    calling finish once the body has been sent.
+    """
+    set_current_stats(stats)
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        set_current_stats(None)
+        finish()
+
+
+def _start_request_stats():
+    """ Starts recording the statistics of the request. """
+    set_current_stats(RequestStats())
+
+
+def _finish_request_stats(response):
+    """ Adds the Server-Timing header to the response and logs the
+    statistics of the request, after its body has been generated for the
+    streamed responses.
+    """
+    stats = current_stats()
+    if stats is None:
+        return response
+    set_current_stats(None)
+    args = (stats, request.endpoint, request.method, request.path,
+        response.status_code)
+    if response.is_streamed:
+        response.response = _iter_with_stats(response.response, stats,
+            lambda: _log_request_stats(*args))
+    else:
+        response.headers['Server-Timing'] = stats.server_timing()
+        _log_request_stats(*args)
+    return response
+
+
+@_route('/metrics')
+def metrics():
+    """ Returns the metrics of the application in the Prometheus text
+    format.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n',
+        mimetype='text/plain; version=0.0.4')
+
+
+@_route('/', methods=['GET', 'POST'])
+def index():
+    """ Shows the front page.
+    All the content of this page is in the index.html file under the
+    templates directory. The file is full html and has no templating
+    logic within.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    form = ChebiIDForm(csrf_enabled=False)
+    if form.validate_on_submit():
+        try:
+            int(form.chebi_id.data)
+            return redirect(url_for('show_chebi',
+                chebi_id=form.chebi_id.data))
+        except ValueError:
+            return redirect(url_for('search_chebi',
+                name=form.chebi_id.data))
+    # The names are only completed from a search index
+    return _render_template('index.html', form=form,
+        autocomplete=has_search_index())
+
+
+def _search_page(name, extended):
+    """ Renders one page of the results of a search, the page is given
+    by the `after` and `limit` arguments of the request.
+    """
+    after = request.args.get('after')
+    if after is not None and not after.isdigit():
+        after = None
+    limit = request.args.get('limit', chebi2gene.SEARCH_LIMIT, type=int)
+    limit = max(1, min(limit, chebi2gene.SEARCH_LIMIT))
+    if extended:
+        molecules = get_extended_chebi_from_search(name, limit=limit + 1,
+            after=after)
+    else:
+        molecules = get_exact_chebi_from_search(name, limit=limit + 1,
+            after=after)
+    next_url = None
+    if molecules and len(molecules) > limit:
+        molecules.popitem()
+        next_url = url_for(request.endpoint, name=name, limit=limit,
+            after=molecules.keys()[-1])
+    elif not extended and not after and molecules and len(molecules) == 1:
+        return redirect(url_for('show_chebi',
+                chebi_id=molecules.keys()[0]))
+    return _render_template('search.html', data=molecules, search=name,
+        extended=extended, next_url=next_url)
+
+
+@_route('/autocomplete')
+def autocomplete():
+    """ Returns, as JSON, the compounds having a name or a synonym
+    starting with the `q` argument of the request.
+    At most `limit` (default 10) compounds are returned.
+    """
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    return jsonify(query=request.args.get('q', ''),
+        results=get_chebi_completions(request.args.get('q', ''), limit))
+
+
+@_route('/search/<name>')
+def search_chebi(name):
+    """ Search the CHEBI database for the name given.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    return _search_page(name, extended=False)
+
+
+@_route('/fullsearch/<name>')
+def search_chebi_extended(name):
+    """ Search the CHEBI database for the name given including the
+    synonyms.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    return _search_page(name, extended=True)
+
+
+def _iter_page_cached(iterable, key, mimetype):
+    """ Returns the items of the body of a streamed response and keeps
+    the whole body in PAGE_CACHE once it has been sent, if it is small
+    enough and none of the queries behind it failed.
+    """
+    body = []
+    size = 0
+    for data in iterable:
+        if body is not None:
+            size += len(data)
+            if size > chebi2gene.PAGE_CACHE_MAX_BODY:
+                body = None
+            else:
+                body.append(data)
+        yield data
+    stats = current_stats()
+    if body is not None and (stats is None or not stats.failures):
+        _cache_page(key, ''.join(body), mimetype)
+
+
+def _cache_page(key, body, mimetype):
+    """ Keeps the given body in PAGE_CACHE and returns its entry. """
+    entry = (body, mimetype, hashlib.sha1(body).hexdigest(),
+        datetime.datetime.utcnow().replace(microsecond=0))
+    if len(body) <= chebi2gene.PAGE_CACHE_MAX_BODY:
+        chebi2gene.PAGE_CACHE.set(key, entry)
+    return entry
+
+
+def _cached_page(view):
+    """ Decorator keeping the pages returned by the given view, which
+    takes a chebi identifier, in PAGE_CACHE for the current version of
+    the data.
+
+    The pages are sent with an ETag and a Last-Modified header and the
+    conditional requests are answered with a 304 status. Streamed pages
+    are sent without them the first time, while they are generated.
+    The pages for which a query failed are not kept. The request is
+    logged here so that the pages answered from the cache are logged too.
+    """
+
+    @functools.wraps(view)
+    def _wrapped(chebi_id):
+        """ Answers the request from PAGE_CACHE or with the view. """
+        print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+            request.remote_addr, request.url)
+        key = (request.endpoint, chebi_id, data_version())
+        entry = chebi2gene.PAGE_CACHE.get(key)
+        if entry is None:
+            response = current_app.make_response(view(chebi_id))
+            stats = current_stats()
+            # Incomplete pages are sent as they are, but not kept
+            if response.status_code != 200 or (stats is not None
+                    and stats.failures and not response.is_streamed):
+                return response
+            if response.is_streamed:
+                response.response = _iter_page_cached(response.response,
+                    key, response.mimetype)
+                return response
+            entry = _cache_page(key, response.get_data(), response.mimetype)
+        body, mimetype, etag, last_modified = entry
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response.make_conditional(request)
+    return _wrapped
+
+
+@_route('/chebi/<chebi_id>')
+@_cached_page
+def show_chebi(chebi_id):
+    """ Shows the front page.
+    All the content of this page is in the index.html file under the
+    templates directory. The file is full html and has no templating
+    logic within.
+    With `progressive_page` set, only the reactions are retrieved and the
+    information of each protein is loaded from protein_fragments.
+    """
+    if chebi2gene.PROGRESSIVE_PAGE:
+        proteins = get_protein_of_chebi(chebi_id)
+        if proteins:
+            proteins = convert_to_uniprot_id(proteins)
+        return _render_template('output.html', progressive=True,
+            proteins=proteins or [], count=len(unique_proteins(
+                proteins or {})), chebi=chebi_id,
+            fragment_proteins=FRAGMENT_PROTEINS)
+    information = get_information_of_chebi(chebi_id)
+    if not information:
+        return _render_template('output.html', proteins=[],
+        pathways=None, genes=None, organisms=None, chebi=chebi_id)
+    proteins, pathways, genes, organisms = information
+    return _render_template('output.html', proteins=proteins,
+        pathways=pathways, genes=genes, organisms=organisms,
+        chebi=chebi_id)
+
+
+# Maximum number of proteins whose information is asked in one request
+# by the progressive page of a compound.
+FRAGMENT_PROTEINS = 200
+
+
+@_route('/proteins')
+def protein_fragments():
+    """ Returns, as JSON, the pathways, genes and organisms of the proteins
+    given as `id` arguments, loaded by the progressive page of a
+    compound.
+    """
+    proteins = unique_proteins({None: request.args.getlist('id')})
+    if not proteins or len(proteins) > FRAGMENT_PROTEINS or not all(
+            [re.match(r'[\w.-]+\Z', protein) for protein in proteins]):
+        return Response('Give between 1 and %s uniprot identifiers\n'
+            % FRAGMENT_PROTEINS, status=400, mimetype='text/plain')
+    pathways, genes, organisms = get_information_of_proteins(
+        {None: proteins})
+    output = {}
+    for protein in proteins:
+        output[protein] = {'pathways': pathways.get(protein, []),
+            'genes': [gene.as_dict() if isinstance(gene, Gene) else gene
+                for gene in genes.get(protein, [])],
+            'organisms': organisms.get(protein, [])}
+    return jsonify(proteins=output)
+
+
+@_route('/csv/<chebi_id>')
+@_cached_page
+def generate_csv(chebi_id):
+    """ Generate a comma separated value file containing all the
+    information.
+    The file is streamed, the rows of each protein are sent as soon as
+    its information has been retrieved.
+    """
+
+    def _generate():
+        """ Yields the lines of the csv file. """
+        yield csv_line(CSV_HEADER)
+        # Regenerate the informations
+        proteins, information = stream_information_of_chebi(chebi_id)
+        if not proteins:
+            return
+        try:
+            for row in iter_csv_rows(chebi_id, proteins, information):
+                yield csv_line(row)
+        finally:
+            information.close()
+
+    return Response(_generate(), mimetype='application/excel')
+
+
+@_route('/batch', methods=['POST'])
+def generate_batch():
+    """ Generate a single file containing the information of several
+    compounds.
+    The chebi identifiers are read from the `chebi_ids` field and from
+    the uploaded `file`, the output is a csv file or, if the `format`
+    field is `jsonl`, one JSON object per line and per compound.
+    The genes are annotated with the regions, of the BED file uploaded as
+    `regions`, that they overlap.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    text = request.form.get('chebi_ids', '')
+    if 'file' in request.files:
+        text = '%s\n%s' % (text, request.files['file'].read())
+    chebi_ids = parse_chebi_ids(text)
+    if not chebi_ids:
+        return Response('No chebi identifier given\n', status=400,
+            mimetype='text/plain')
+    regions = None
+    if 'regions' in request.files:
+        try:
+            regions = parse_bed(request.files['regions'].read())
+        except ValueError, err:
+            return Response('%s\n' % err, status=400, mimetype='text/plain')
+    output_format = request.form.get('format', 'csv')
+    if output_format == 'jsonl':
+        mimetype = 'application/x-ndjson'
+    else:
+        output_format = 'csv'
+        mimetype = 'application/excel'
+    return Response(iter_bulk_output(chebi_ids, output_format, regions),
+        mimetype=mimetype)
+
+
+@_route('/region/<region>')
+def show_region(region):
+    """ Returns, as JSON, the genes linked to a compound which overlap
+    the given `scaffold:start-stop` region, with their protein and
+    compounds. At most `limit` genes are returned, `count` gives the
+    number of genes overlapping the region.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    try:
+        scaffold, start, stop = parse_region(region)
+        limit = int(request.args.get('limit', 1000))
+    except ValueError, err:
+        return Response('%s\n' % err, status=400, mimetype='text/plain')
+    genes = get_genes_in_region(scaffold, start, stop)
+    return jsonify(region={'scaffold': scaffold, 'start': start,
+        'stop': stop}, count=len(genes), genes=genes[:max(limit, 0)])
+
+
+@_route('/gene/<identifier>')
+def show_gene(identifier):
+    """ Returns, as JSON, the compounds and reactions of a gene, given by
+    its name, or of a protein, given by its uniprot identifier.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    found = get_reverse_index().lookup(identifier)
+    if found is None:
+        response = jsonify(query=identifier, genes=[], proteins={})
+        response.status_code = 404
+        return response
+    return jsonify(query=identifier, **found)
+
+
+@_route('/reverse', methods=['POST'])
+def generate_reverse():
+    """ Generate a single file containing the compounds of several genes
+    or proteins.
+    The identifiers are read from the `identifiers` field and from the
+    uploaded `file`, the output is a csv file or, if the `format` field
+    is `jsonl`, one JSON object per line and per identifier.
+    """
+    print 'Chebi2gene %s -- %s -- %s' % (datetime.datetime.now(),
+        request.remote_addr, request.url)
+    text = request.form.get('identifiers', '')
+    if 'file' in request.files:
+        text = '%s\n%s' % (text, request.files['file'].read())
+    identifiers = parse_gene_ids(text)
+    if not identifiers:
+        return Response('No gene or protein identifier given\n',
+            status=400, mimetype='text/plain')
+    output_format = request.form.get('format', 'csv')
+    if output_format == 'jsonl':
+        mimetype = 'application/x-ndjson'
+    else:
+        output_format = 'csv'
+        mimetype = 'application/excel'
+    # Answered before the output starts if the index is not ready
+    get_reverse_index()
+    return Response(iter_reverse_output(identifiers, output_format),
+        mimetype=mimetype)
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+"""
+Production launcher of chebi2gene.
+
+When gevent is installed, the standard library is patched before
+chebi2gene is imported so that every request is served by a greenlet and
+the queries sent to the sparql endpoint wait for its answers without
+blocking the process: a single process then holds many requests in flight
+while the endpoint works. Without gevent, the requests are served by
+threads.
+
+Run it with:
+
+    python wsgi.py --host 0.0.0.0 --port 8080
+
+or give `wsgi:application` to any WSGI server, for example:
+
+    gunicorn -k gevent -w 4 wsgi:application
+"""
+
+if __name__ == '__main__':
+    try:
+        from gevent import monkey
+        # Must happen before anything creates sockets, threads or locks
+        monkey.patch_all()
+    except ImportError:
+        pass
+
+import argparse
+import sys
+
+import chebi2gene
+import webapp
+
+
+# The WSGI application.
+application = webapp.create_app()
+
+
+def main(argv):
+    """ Runs the web application with gevent or, if it is not installed,
+    with a threaded server.
+
+    @param argv, a list of strings, the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Run the chebi2gene web '
+        'application.')
+    parser.add_argument('--host', default='127.0.0.1',
+        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+        help='Port to listen on (default: 8080)')
+    parser.add_argument('--max-connections', type=int,
+        default=int(chebi2gene._config('max_connections', 1000)),
+        help='Maximum number of requests served at the same time (default: '
+        'max_connections of the configuration or 1000)')
+    args = parser.parse_args(argv)
+
+    # Load the indexes before the first request, the ones of the genes
+    # are built in the background when there is no local index
+    if chebi2gene.get_index() is None:
+        chebi2gene.start_gene_indexes()
+    chebi2gene.get_search_index()
+    try:
+        from gevent import monkey
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+    except ImportError:
+        monkey = None
+    if monkey is None or not monkey.is_module_patched('socket'):
+        from werkzeug.serving import run_simple
+        print >> sys.stderr, 'gevent is not in use, serving with threads'
+        run_simple(args.host, args.port, application, threaded=True)
+        return
+    server = WSGIServer((args.host, args.port), application,
+        spawn=Pool(args.max_connections))
+    print >> sys.stderr, 'Serving on http://%s:%s/' % (args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])